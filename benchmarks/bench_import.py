@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Benchmark the cost of `import extproxy`, each sample is measured in a new
+interpreter, minus the median startup time of the interpreter.
+
+    eager       import extproxy, which applies monkey patch
+    deferred    import extproxy with EXTPROXY_DEFER_PATCH=1
+    deferred+urllib
+                then import urllib.request, which applies monkey patch
+
+Results are printed, or written by `-o`, as JSON. Used as a guard of the
+gain, exits with status 1 if a check fails, eg: a module of `LAZY_MODULES`
+has been imported, or an import is slower than in a stored baseline:
+
+    python benchmarks/bench_import.py [--max-deferred-ms 5]
+        [--baseline benchmarks/import_baseline.json [--tolerance 1.25]]
+
+The baseline is the output of `-o`, measured on the same machine.
+"""
+
+import argparse
+import ast
+import json
+import os
+import platform
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+%s
+elapsed = time.perf_counter() - start
+print(repr(%s))
+"""
+
+CASES = {
+    "eager": ("import extproxy", {}),
+    "deferred": ("import extproxy", {"EXTPROXY_DEFER_PATCH": "1"}),
+    "deferred+urllib": ("import extproxy; import urllib.request",
+                        {"EXTPROXY_DEFER_PATCH": "1"})
+}
+
+# Modules which should not be imported by `import extproxy`, the SOCKS
+# client and the optional engines are imported on first use
+LAZY_MODULES = ("extproxy.socks_client", "extproxy.forwarder",
+                "extproxy.tls_in_tls", "extproxy.http2", "extproxy.group",
+                "extproxy.keepalive", "extproxy.batch", "extproxy.aio",
+                "extproxy.ktls", "concurrent.futures", "json", "asyncio")
+
+
+def run(code, env, result="elapsed"):
+    environ = dict(os.environ, PYTHONPATH=ROOT)
+    environ.pop("EXTPROXY_DEFER_PATCH", None)
+    # Measure with the byte code caches
+    environ.pop("PYTHONDONTWRITEBYTECODE", None)
+    environ.update(env)
+    output = subprocess.check_output(
+            [sys.executable, "-c", _SCRIPT % (code, result)], env=environ)
+    return ast.literal_eval(output.decode())
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def bench(number):
+    # Warm up the byte code caches
+    for code, env in CASES.values():
+        run(code, env)
+    baseline = median([run("pass", {}) for _ in range(number)])
+    results = {}
+    for name, (code, env) in sorted(CASES.items()):
+        samples = [run(code, env) - baseline for _ in range(number)]
+        results[name] = {
+            "median_ms": median(samples) * 1e3,
+            "min_ms": min(samples) * 1e3
+        }
+        sys.stderr.write("%-16s %8.2f ms\n" % (name,
+                                                results[name]["median_ms"]))
+    return results
+
+def lazy_modules_imported():
+    """Return the modules of `LAZY_MODULES` imported by `import extproxy`."""
+    return run("import extproxy", {},
+               "[name for name in %r if name in sys.modules]"
+               % (LAZY_MODULES,))
+
+def compare_baseline(results, path, tolerance, slack_ms=1):
+    """Return the failures of the cases which are slower than in the
+    baseline by more than the ratio `tolerance`, plus `slack_ms` for the
+    cases which take less than a millisecond. The minimums are compared,
+    they are less noisy than the medians."""
+    with open(path) as fp:
+        baseline = json.load(fp)["import"]
+    failures = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        expected = baseline[name]["min_ms"]
+        if result["min_ms"] > expected * tolerance + slack_ms:
+            failures.append("%s import %.2f ms > baseline %.2f ms * %.2f"
+                            % (name, result["min_ms"], expected, tolerance))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=20,
+                        help="samples of each case")
+    parser.add_argument("--max-deferred-ms", type=float,
+                        help="fail if the deferred import is slower")
+    parser.add_argument("--baseline",
+                        help="fail if slower than this result of -o")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="the allowed ratio to the baseline")
+    parser.add_argument("-o", "--output", help="write JSON to this file")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "args": vars(args)
+        },
+        "import": bench(args.number),
+        "lazy_modules_imported": lazy_modules_imported()
+    }
+    failures = ["%s has been imported" % name
+                for name in results["lazy_modules_imported"]]
+    deferred = results["import"]["deferred"]["median_ms"]
+    if args.max_deferred_ms is not None and deferred > args.max_deferred_ms:
+        failures.append("deferred import %.2f ms > %.2f ms"
+                        % (deferred, args.max_deferred_ms))
+    if args.baseline:
+        failures.extend(compare_baseline(results["import"], args.baseline,
+                                         args.tolerance))
+    results["failures"] = failures
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(output + "\n")
+    else:
+        print(output)
+    for failure in failures:
+        sys.stderr.write("FAIL: %s\n" % failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
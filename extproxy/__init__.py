@@ -15,6 +15,8 @@ Usage:
 
 
     # Import extproxy, auto apply monkey patching by `extproxy.patch_items`
+    # Or set EXTPROXY_DEFER_PATCH=1 to defer it until `urllib.request` is
+    # imported or an attribute is used, requires Python 3.7 and above
     import extproxy
 
 
@@ -72,8 +74,79 @@ Usage:
 __version__ = "1.0.3"
 __author__ = "SeaHOH<seahoh@gmail.com>"
 
-from .extra import *
-
-__all__ = ["__version__", "set_https_proxy", "patch_items", "restore_items"]
-
-patch_items()
+import os
+import sys
+
+__all__ = ["__version__", "set_https_proxy", "https_proxy_session_stats",
+           "set_socks_proxy", "enable_forwarder", "disable_forwarder",
+           "active_tunnels", "set_proxy_limits", "proxy_limits_stats",
+           "set_ktls", "set_tls_in_tls_mode", "ProxyGroup", "TransportProfile",
+           "set_warm_pool", "remove_warm_pool", "load_proxy_capabilities",
+           "save_proxy_capabilities", "patch_items", "reload_proxy_bypass",
+           "set_origin_session_cache", "origin_session_stats", "set_dns_cache",
+           "clear_dns_cache", "add_metrics_hook", "remove_metrics_hook",
+           "enable_metrics", "disable_metrics", "get_metrics",
+           "reinit_after_fork", "prefork", "restore_items"]
+
+if sys.version_info[0] >= 3:
+    __all__.append("fetch_many")
+
+def _load():
+    """Import the implementation and apply monkey patch, it is safe to be
+    called again."""
+    _remove_patch_hook()
+    from . import extra
+    # The classes of optional engines are got from extra on first use, py37
+    namespace = vars(extra)
+    globals().update((name, namespace[name]) for name in extra.__all__
+                     if name in namespace)
+    extra.patch_items()
+
+def __getattr__(name):
+    # Deferred patching, py37
+    if name in __all__:
+        _load()
+        from . import extra
+        value = globals()[name] = getattr(extra, name)
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class _PatchOnImport(object):
+    """A meta path finder, applies monkey patch after `urllib.request` has
+    been imported."""
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != "urllib.request":
+            return
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return
+        exec_module = spec.loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            _load()
+
+        spec.loader.exec_module = exec_and_patch
+        return spec
+
+_patch_hook = None
+
+def _remove_patch_hook():
+    try:
+        sys.meta_path.remove(_patch_hook)
+    except ValueError:
+        pass
+
+if os.environ.get("EXTPROXY_DEFER_PATCH") and sys.version_info >= (3, 7) \
+        and "urllib.request" not in sys.modules:
+    _patch_hook = _PatchOnImport()
+    sys.meta_path.insert(0, _patch_hook)
+else:
+    _load()
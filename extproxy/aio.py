@@ -0,0 +1,231 @@
+"""Open asyncio streams through HTTP, HTTPS and SOCKS proxies.
+
+TLS connections through HTTPS proxies (TLS-in-TLS) are handled by asyncio's
+`start_tls`, no forwarding threads are used. That needs Python >= 3.11, the
+other proxy types need Python >= 3.7.
+"""
+
+import asyncio
+import socket
+import ssl as _ssl
+import struct
+import sys
+
+from .capabilities import proxy_capabilities
+from .happy_eyeballs import CONNECTION_ATTEMPT_DELAY
+from .https import _get_proxy_context
+from .proxy_info import DEFAULT_PORTS, get_proxy_info
+from .resolver import resolver
+from .socks import _get_socks_settings
+from .socks_client import (
+    SOCKS4, SOCKS4Error, GeneralProxyError, SOCKS5_ADDRESS_LENGTHS,
+    socks4_request, socks5_greeting, socks5_auth, socks5_request,
+    socks4_parse_reply, socks5_parse_method, socks5_parse_auth,
+    socks5_parse_reply, socks5_parse_address)
+from .tunnel import connect_request, parse_connect_response
+from .util import is_ipv4
+
+
+__all__ = ["open_connection"]
+
+_DEFAULT_LIMIT = 2 ** 16
+
+
+async def open_connection(host, port, proxy=None, ssl=None,
+                          server_hostname=None, ssl_handshake_timeout=None,
+                          limit=_DEFAULT_LIMIT, **kwds):
+    """Open a connection to (host, port) through a proxy, return a pair of
+    (reader, writer), like `asyncio.open_connection`.
+
+    host, port
+        The destination address.
+
+    optional:
+
+    proxy
+        A proxy of string, or an `urlparse` result, eg:
+            http://127.0.0.1:8080
+            https://id:pw@127.0.0.1:8443
+            socks5://127.0.0.1:1080
+            socks5+unix:///run/egress.sock
+        HTTPS proxies use the SSL contexts set by `set_https_proxy`.
+        If it is None, connect to destination directly.
+    ssl
+        True or a `ssl.SSLContext` object, to wrap the tunnel with TLS.
+    server_hostname
+        The hostname to match destination's cert, default is `host`.
+    ssl_handshake_timeout, limit
+        See `asyncio.open_connection`.
+    kwds
+        Passed to `loop.create_connection` which connects to proxy, eg:
+        local_addr, happy_eyeballs_delay. Ignored by Unix socket proxies.
+    """
+
+    if ssl is True:
+        ssl = _ssl.create_default_context()
+    if server_hostname is None and ssl:
+        server_hostname = host.strip("[]")
+    if proxy is None:
+        return await asyncio.open_connection(
+            host, port, ssl=ssl or None, server_hostname=server_hostname,
+            ssl_handshake_timeout=ssl_handshake_timeout, limit=limit, **kwds)
+
+    proxy = get_proxy_info(proxy)
+    if proxy.type == "socks":
+        connect = _connect_socks
+    elif proxy.scheme in ("http", "https"):
+        connect = _connect_http
+    else:
+        raise ValueError("Unsupported proxy scheme: %r" % proxy.scheme)
+
+    reader, writer = await connect(proxy, host, port, limit, kwds)
+    try:
+        if ssl:
+            writer = await _start_tls(reader, writer, ssl, server_hostname,
+                                      ssl_handshake_timeout)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+async def _open_proxy_connection(proxy, limit, kwds):
+    context = server_hostname = None
+    if proxy.type == "https":
+        context = _get_proxy_context(proxy)
+        server_hostname = proxy.hostname
+    if proxy.unix_path:
+        # kwds are the options of TCP connections
+        return await asyncio.open_unix_connection(
+            proxy.unix_path, ssl=context, server_hostname=server_hostname,
+            limit=limit)
+    if sys.version_info >= (3, 8):
+        # Happy Eyeballs, like the blocking connections
+        kwds = dict(kwds)
+        kwds.setdefault("happy_eyeballs_delay", CONNECTION_ATTEMPT_DELAY)
+    return await asyncio.open_connection(
+        proxy.hostname, proxy.port or DEFAULT_PORTS[proxy.scheme], ssl=context,
+        server_hostname=server_hostname, limit=limit, **kwds)
+
+async def _start_tls(reader, writer, context, server_hostname,
+                     ssl_handshake_timeout):
+    try:
+        start_tls = writer.start_tls
+    except AttributeError:  # Python < 3.11
+        pass
+    else:
+        await start_tls(context, server_hostname=server_hostname,
+                        ssl_handshake_timeout=ssl_handshake_timeout)
+        return writer
+
+    loop = asyncio.get_running_loop()
+    protocol = writer.transport.get_protocol()
+    transport = await loop.start_tls(
+        writer.transport, protocol, context, server_hostname=server_hostname,
+        ssl_handshake_timeout=ssl_handshake_timeout)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    protocol._stream_writer = writer
+    return writer
+
+async def _connect_http(proxy, host, port, limit, kwds):
+    reader, writer = await _open_proxy_connection(proxy, limit, kwds)
+    try:
+        headers = None
+        if proxy.proxy_auth:
+            headers = {"Proxy-Authorization": proxy.proxy_auth}
+        writer.write(connect_request((host, port), headers))
+        try:
+            response = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            raise OSError("Tunnel connection failed: connection closed")
+        except asyncio.LimitOverrunError:
+            raise OSError("Tunnel connection failed: response too long")
+        parse_connect_response(response)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+async def _resolve(host, port, family=socket.AF_UNSPEC):
+    infos = resolver.cached(host, port, family)
+    if infos is None:
+        loop = asyncio.get_running_loop()
+        infos = await loop.run_in_executor(None, resolver.getaddrinfo, host,
+                                           port, family)
+    return infos[0][4][0]
+
+async def _socks_read_exact(reader, count):
+    try:
+        return await reader.readexactly(count)
+    except asyncio.IncompleteReadError:
+        raise GeneralProxyError("Connection closed unexpectedly")
+
+async def _socks_read_reply(reader, proxy_type):
+    if proxy_type == SOCKS4:
+        return socks4_parse_reply(await _socks_read_exact(reader, 8))
+    atyp = socks5_parse_reply(await _socks_read_exact(reader, 4))
+    if atyp == 0x03:
+        length = struct.unpack("B", await _socks_read_exact(reader, 1))[0]
+    else:
+        length = SOCKS5_ADDRESS_LENGTHS[atyp]
+    addr = socks5_parse_address(atyp, await _socks_read_exact(reader, length))
+    port = struct.unpack(">H", await _socks_read_exact(reader, 2))[0]
+    return addr, port
+
+async def _negotiate_socks(reader, writer, proxy, host, port, rdns):
+    username, password = proxy.username, proxy.password
+    host = host.strip("[]")
+    if not rdns and not is_ipv4(host) and ":" not in host:
+        # Resolve locally without blocking the event loop
+        family = socket.AF_INET if proxy.proxy_type == SOCKS4 else \
+                 socket.AF_UNSPEC
+        host = await _resolve(host, port, family)
+
+    if proxy.proxy_type == SOCKS4:
+        writer.write(socks4_request(host, port, rdns, username))
+        return await _socks_read_reply(reader, SOCKS4), None
+
+    request = socks5_request(host, port, rdns)
+    optimistic, _, _ = _get_socks_settings(proxy)
+    if optimistic:
+        data = socks5_greeting(username, password, True)
+        if username and password:
+            data += socks5_auth(username, password)
+        writer.write(data + request)
+        method = socks5_parse_method(await _socks_read_exact(reader, 2),
+                                     username, password)
+        if method == 0x02:
+            socks5_parse_auth(await _socks_read_exact(reader, 2))
+    else:
+        writer.write(socks5_greeting(username, password))
+        method = socks5_parse_method(await _socks_read_exact(reader, 2),
+                                     username, password)
+        if method == 0x02:
+            writer.write(socks5_auth(username, password))
+            socks5_parse_auth(await _socks_read_exact(reader, 2))
+        writer.write(request)
+    return await _socks_read_reply(reader, proxy.proxy_type), method
+
+async def _connect_socks(proxy, host, port, limit, kwds):
+    proxy_key = proxy.key
+    rdns = proxy.rdns and proxy_capabilities.get(proxy_key, "rdns", True)
+    while True:
+        reader, writer = await _open_proxy_connection(proxy, limit, kwds)
+        try:
+            _, method = await _negotiate_socks(reader, writer, proxy, host,
+                                               port, rdns)
+        except SOCKS4Error as e:
+            writer.close()
+            if rdns and e.status == 0x5b and not is_ipv4(host):
+                # Maybe that SOCKS4 server doesn't support remote resolving
+                # Disable rdns and try again
+                rdns = False
+                proxy_capabilities.set(proxy_key, "rdns", False)
+            else:
+                raise
+        except BaseException:
+            writer.close()
+            raise
+        else:
+            if method is not None:
+                proxy_capabilities.set(proxy_key, "auth_method", method)
+            return reader, writer
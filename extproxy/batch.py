@@ -0,0 +1,149 @@
+"""Fetch many URLs concurrently through proxies, requires Python 3."""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.error import HTTPError
+from urllib.request import Request, ProxyHandler, build_opener
+
+from .compat import mtime
+from .keepalive import ConnectionPool, KeepAliveHTTPHandler, \
+                       KeepAliveHTTPSHandler
+
+
+__all__ = ["fetch_many"]
+
+
+class FetchResult(namedtuple("FetchResult", ["url", "proxy", "status",
+                                             "headers", "body", "error",
+                                             "elapsed"])):
+    """The result of a URL fetched by `fetch_many`, status, headers and body
+    are None if error is not an `HTTPError`."""
+
+    __slots__ = ()
+
+
+class _ProxySlot(object):
+    __slots__ = ("proxy", "opener", "active")
+
+    def __init__(self, proxy, opener):
+        self.proxy = proxy
+        self.opener = opener
+        self.active = 0
+
+
+def _build_opener(proxy, pool, context):
+    if proxy is None:
+        # System/python environment variables
+        proxy_handler = ProxyHandler()
+    else:
+        proxy_handler = ProxyHandler({"http": proxy, "https": proxy})
+    return build_opener(proxy_handler, KeepAliveHTTPHandler(pool=pool),
+                        KeepAliveHTTPSHandler(context=context, pool=pool))
+
+def _fetch(slot, url, timeout):
+    if isinstance(url, Request):
+        full_url = url.full_url
+    else:
+        full_url = url
+    start = mtime()
+    try:
+        response = slot.opener.open(url, timeout=timeout)
+        try:
+            body = response.read()
+        finally:
+            response.close()
+        return FetchResult(full_url, slot.proxy, response.status,
+                           response.headers, body, None, mtime() - start)
+    except HTTPError as e:
+        try:
+            body = e.read()
+        except Exception:
+            body = None
+        finally:
+            e.close()
+        return FetchResult(full_url, slot.proxy, e.code, e.headers, body, e,
+                           mtime() - start)
+    except Exception as e:
+        return FetchResult(full_url, slot.proxy, None, None, None, e,
+                           mtime() - start)
+
+def _select_slot(slots, start, per_proxy_limit):
+    """Return the least busy slot which is under the limit, or None."""
+    selected = None
+    for i in range(len(slots)):
+        slot = slots[(start + i) % len(slots)]
+        if per_proxy_limit is not None and slot.active >= per_proxy_limit:
+            continue
+        if selected is None or slot.active < selected.active:
+            selected = slot
+    return selected
+
+def fetch_many(urls, proxies=None, concurrency=16, per_proxy_limit=None,
+               timeout=30, context=None):
+    """Fetch URLs concurrently, yield `FetchResult` in order of completion.
+    The connections are kept alive and reused by the workers.
+
+    urls
+        An iterable of URL strings or `Request` objects, it is consumed
+        lazily, only when a worker and a proxy are available, and while the
+        results are being consumed.
+
+    optional:
+
+    proxies
+        A proxy of string, a list of proxies or `ProxyGroup` objects, eg:
+            ["socks5://127.0.0.1:1080", "https://127.0.0.1:8443"]
+        Each URL is sent through the least busy proxy. If it is None, use
+        the proxies of system/python environment variables.
+    concurrency
+        The max count of concurrent requests.
+    per_proxy_limit
+        The max count of concurrent requests through a proxy, requests
+        wait for a free proxy if all proxies are busy.
+    timeout
+        The timeout of each request.
+    context
+        A `ssl.SSLContext` object used to connect to HTTPS URLs.
+    """
+    if proxies is None or not isinstance(proxies, (list, tuple)):
+        proxies = [proxies]
+    if not proxies:
+        raise ValueError("no proxy given")
+    if concurrency < 1 or (per_proxy_limit is not None and
+                           per_proxy_limit < 1):
+        raise ValueError("concurrency and per_proxy_limit must be positive")
+    pool = ConnectionPool(maxsize=concurrency,
+                          maxsize_per_key=per_proxy_limit or concurrency)
+    slots = [_ProxySlot(proxy, _build_opener(proxy, pool, context))
+             for proxy in proxies]
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = {}
+    urls = iter(urls)
+    exhausted = False
+    start = 0
+    try:
+        while True:
+            while not exhausted and len(pending) < concurrency:
+                slot = _select_slot(slots, start, per_proxy_limit)
+                if slot is None:
+                    # Backpressure, all proxies are busy
+                    break
+                try:
+                    url = next(urls)
+                except StopIteration:
+                    exhausted = True
+                    break
+                start += 1
+                slot.active += 1
+                pending[executor.submit(_fetch, slot, url, timeout)] = slot
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future).active -= 1
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+        pool.clear()
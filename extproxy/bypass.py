@@ -0,0 +1,166 @@
+"""A precompiled and cached replacement of urllib's proxy_bypass."""
+
+import os
+import socket
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+from .compat import proxy_bypass as _proxy_bypass
+from .fork import register_child_hook
+
+
+__all__ = ["reload_proxy_bypass"]
+
+# Platforms which read bypass settings from system, besides environment
+_system_bypass = sys.platform == "darwin" or os.name == "nt"
+
+
+def _ip_to_int(host):
+    """Return (family, int) of an IP address string, or None."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, host)
+        except (socket.error, ValueError, UnicodeError):
+            continue
+        high, low = struct.unpack(">QQ", packed.rjust(16, b"\0"))
+        return family, high << 64 | low
+
+
+class BypassMatcher(object):
+    """Match hosts against a compiled `no_proxy` value.
+
+    Names are kept in a trie of reversed labels, so `example.com` matches
+    `example.com` and `www.example.com`, like urllib does. CIDR ranges, eg:
+    `10.0.0.0/8`, match IP addresses as numbers.
+    """
+
+    def __init__(self, no_proxy):
+        self.all = no_proxy.strip() == "*"
+        self.trie = {}
+        self.ranges = []
+        for name in no_proxy.split(","):
+            name = name.strip().lstrip(".").lower()
+            if not name:
+                continue
+            if "/" in name:
+                self._add_range(name)
+            else:
+                self._add_name(name)
+                if _ip_to_int(name.strip("[]")) is not None:
+                    self._add_range(name.strip("[]") + "/128")
+
+    def _add_name(self, name):
+        node = self.trie
+        for label in reversed(name.split(".")):
+            node = node.setdefault(label, {})
+        node[None] = True
+
+    def _add_range(self, cidr):
+        address, _, prefix = cidr.partition("/")
+        ip = _ip_to_int(address.strip("[]"))
+        try:
+            prefix = int(prefix)
+        except ValueError:
+            ip = None
+        if ip is None:
+            self._add_name(cidr)
+            return
+        family, value = ip
+        bits = 32 if family == socket.AF_INET else 128
+        prefix = min(prefix, bits)
+        mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+        self.ranges.append((family, value & mask, mask))
+
+    def _match_name(self, name):
+        node = self.trie
+        for label in reversed(name.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    def __call__(self, host):
+        if self.all:
+            return True
+        host = host.lower()
+        hostonly, sep, port = host.rpartition(":")
+        if not sep or not port.isdigit() or (
+                ":" in hostonly and not hostonly.startswith("[")):
+            # No port, or an IPv6 address without brackets
+            hostonly = host
+        if self._match_name(hostonly) or (
+                hostonly != host and self._match_name(host)):
+            return True
+        if self.ranges:
+            ip = _ip_to_int(hostonly.strip("[]"))
+            if ip is not None:
+                family, value = ip
+                for range_family, network, mask in self.ranges:
+                    if family == range_family and value & mask == network:
+                        return True
+        return False
+
+
+class ProxyBypass(object):
+    """Cache proxy bypass decisions per host in a bounded LRU, the cache is
+    invalidated when `no_proxy` environment changes or by `reload`.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._env = None
+        self._matcher = None
+
+    def reload(self):
+        with self._lock:
+            self._cache.clear()
+            self._env = None
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _get_matcher(self, env):
+        no_proxy = env[0] if env[0] is not None else env[1]
+        if no_proxy:
+            return BypassMatcher(no_proxy)
+        if _system_bypass:
+            return _proxy_bypass
+
+    def __call__(self, host):
+        env = os.environ.get("no_proxy"), os.environ.get("NO_PROXY")
+        with self._lock:
+            if env != self._env:
+                self._cache.clear()
+                self._env = env
+                self._matcher = self._get_matcher(env)
+            matcher = self._matcher
+            if matcher is None:
+                return False
+            try:
+                bypass = self._cache.pop(host)
+            except KeyError:
+                pass
+            else:
+                self._cache[host] = bypass
+                return bypass
+        bypass = bool(matcher(host))
+        with self._lock:
+            self._cache[host] = bypass
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return bypass
+
+
+proxy_bypass = ProxyBypass()
+register_child_hook(proxy_bypass._after_fork)
+
+def reload_proxy_bypass():
+    """Drop cached proxy bypass decisions, eg: after system proxy settings
+    have been changed."""
+    proxy_bypass.reload()
@@ -0,0 +1,107 @@
+"""A thread-safe store of discovered proxy capabilities, with TTLs."""
+
+import os
+import threading
+import time
+
+from .fork import register_child_hook
+
+
+__all__ = ["load_proxy_capabilities", "save_proxy_capabilities"]
+
+
+class CapabilityStore(object):
+    """Per-proxy capabilities, eg: whether a SOCKS4 server supports remote
+    resolving, expire after `ttl` seconds.
+
+    Known capabilities:
+
+        rdns            SOCKS4 server supports remote resolving
+        auth_method     SOCKS5 server chosen authentication method
+        tls_version     HTTPS proxy negotiated TLS version
+        session_ticket  HTTPS proxy issues TLS session tickets
+        address_family  Address family of proxy host which connects first
+    """
+
+    def __init__(self, ttl=3600*24):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, proxy, name, default=None):
+        with self._lock:
+            try:
+                value, expire = self._items[proxy][name]
+            except KeyError:
+                return default
+            if expire < time.time():
+                del self._items[proxy][name]
+                return default
+            return value
+
+    def set(self, proxy, name, value, ttl=None):
+        expire = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._items.setdefault(proxy, {})[name] = value, expire
+
+    def discard(self, proxy, name=None):
+        with self._lock:
+            if name is None:
+                self._items.pop(proxy, None)
+            else:
+                self._items.get(proxy, {}).pop(name, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def items(self):
+        now = time.time()
+        with self._lock:
+            return dict((proxy, dict((name, value)
+                                     for name, (value, expire)
+                                     in capabilities.items() if expire > now))
+                        for proxy, capabilities in self._items.items())
+
+    def load(self, path):
+        """Merge unexpired capabilities from a file saved by `save`."""
+        import json
+        with open(path, "r") as fp:
+            items = json.load(fp)
+        now = time.time()
+        with self._lock:
+            for proxy, capabilities in items.items():
+                for name, (value, expire) in capabilities.items():
+                    if expire > now:
+                        self._items.setdefault(proxy, {})[name] = value, expire
+
+    def save(self, path):
+        with self._lock:
+            items = dict((proxy, dict(capabilities))
+                         for proxy, capabilities in self._items.items())
+        import json
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "w") as fp:
+            json.dump(items, fp)
+        try:
+            os.replace(tmp_path, path)
+        except AttributeError:  # py2
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp_path, path)
+
+
+proxy_capabilities = CapabilityStore()
+register_child_hook(proxy_capabilities._after_fork)
+
+def load_proxy_capabilities(path):
+    """Load discovered proxy capabilities from a file, so that a restarted
+    process does not need to discover them again."""
+    proxy_capabilities.load(path)
+
+def save_proxy_capabilities(path):
+    """Save discovered proxy capabilities to a file."""
+    proxy_capabilities.save(path)
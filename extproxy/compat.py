@@ -2,24 +2,14 @@
 
 from __future__ import absolute_import, print_function
 
+import socket
 import sys
 
 PY3 = sys.version_info.major == 3
 
-def socks_warning():
-    print("Pleaes install PySocks to support SOCKS proxy: "
-          "`pip install PySocks`", file=sys.stderr)
-
-try:
-    import socks
-except ImportError as e:
-    if "win_inet_pton" in str(e):
-        from . import socket_inet_p
-        sys.modules['win_inet_pton'] = socket_inet_p
-        import socks
-    else:
-        socks_warning()
-        socks = None
+if not hasattr(socket, "inet_pton"):
+    # Patch socket module, py2 on Windows
+    from . import socket_inet_p
 
 if PY3:
     from urllib.request import Request, ProxyHandler, proxy_bypass
@@ -27,11 +17,16 @@ if PY3:
         from urllib.request import splittype
     except ImportError:  # py38
         from urllib.request import _splittype as splittype
-    from urllib.parse import urlparse
-    from http.client import HTTPConnection
+    from urllib.request import _parse_proxy
+    from urllib.parse import urlparse, unquote
+    from http.client import HTTPConnection, responses
     from time import perf_counter as mtime
+    import selectors
 else:
     from urllib2 import Request, ProxyHandler, proxy_bypass, splittype
+    from urllib2 import _parse_proxy
+    from urllib import unquote
     from urlparse import urlparse
-    from httplib import HTTPConnection
+    from httplib import HTTPConnection, responses
     from time import time as mtime
+    selectors = None
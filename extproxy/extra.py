@@ -1,19 +1,99 @@
 #!/usr/bin/env python
-"""Monkey patching build-in modules to support extra proxy types."""
+"""Monkey patching build-in modules to support extra proxy types.
 
-from .compat import (socks_warning, proxy_bypass, splittype, urlparse,
-                     Request, ProxyHandler, HTTPConnection)
-from .https import set_https_proxy, _set_tunnel_https
-from .socks import SOCKS_PROXY_TYPES, _set_tunnel_socks
+The optional engines, eg: the forwarder, proxy groups, kTLS, are imported on
+first use, like the SOCKS client.
+"""
+
+import sys
+
+from . import metrics
+from .bypass import proxy_bypass, reload_proxy_bypass
+from .compat import PY3, Request, ProxyHandler, HTTPConnection
+from .capabilities import load_proxy_capabilities, save_proxy_capabilities
+from .fork import reinit_after_fork, prefork
+from .limits import set_proxy_limits, proxy_limits_stats
+from .https import (set_https_proxy, https_proxy_session_stats, set_ktls,
+                    _set_tunnel_https)
+from .pool import set_warm_pool, remove_warm_pool
+from .proxy_info import ProxyInfo, get_proxy_info
+from .metrics import (add_metrics_hook, remove_metrics_hook, enable_metrics,
+                      disable_metrics, get_metrics)
+from .origin_sessions import set_origin_session_cache, origin_session_stats
+from .resolver import set_dns_cache, clear_dns_cache
+from .socks import set_socks_proxy, _set_tunnel_socks
 from .ssl_wrap_socket import _wrap_socket
+from .transport import TransportProfile
+from .util import loaded_module
 from ssl import SSLContext
 
 
-__all__ = ["set_https_proxy", "patch_items", "restore_items"]
+__all__ = ["set_https_proxy", "https_proxy_session_stats", "set_socks_proxy",
+           "enable_forwarder", "disable_forwarder", "active_tunnels",
+           "set_proxy_limits", "proxy_limits_stats", "set_ktls",
+           "set_tls_in_tls_mode", "ProxyGroup", "TransportProfile",
+           "set_warm_pool", "remove_warm_pool", "load_proxy_capabilities",
+           "save_proxy_capabilities", "patch_items", "reload_proxy_bypass",
+           "set_origin_session_cache", "origin_session_stats", "set_dns_cache",
+           "clear_dns_cache", "add_metrics_hook", "remove_metrics_hook",
+           "enable_metrics", "disable_metrics", "get_metrics",
+           "reinit_after_fork", "prefork", "restore_items"]
+
+if PY3:
+    __all__.append("fetch_many")
+
+    def fetch_many(*args, **kwargs):
+        """Fetch URLs concurrently, yield `FetchResult` in order of
+        completion, see `extproxy.batch.fetch_many`, which is imported on
+        the first call."""
+        from .batch import fetch_many
+        return fetch_many(*args, **kwargs)
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        if name == "ProxyGroup":
+            from .group import ProxyGroup
+            return ProxyGroup
+        raise AttributeError("module %r has no attribute %r"
+                             % (__name__, name))
+else:
+    from .group import ProxyGroup
+
+def enable_forwarder(shards=1, **kwargs):
+    """Forward socket pairs of TLS-over-HTTPS-proxy connections with shared
+    event loop threads, see `extproxy.forwarder.enable_forwarder`."""
+    from .forwarder import enable_forwarder
+    enable_forwarder(shards, **kwargs)
+
+def disable_forwarder():
+    """Go back to using a new thread per connection. Registered tunnels
+    continue working until closed."""
+    forwarder = loaded_module("forwarder")
+    if forwarder is not None:
+        forwarder.disable_forwarder()
+
+def active_tunnels():
+    """Return the count of active tunnels of the forwarder."""
+    forwarder = loaded_module("forwarder")
+    if forwarder is None:
+        return 0
+    return forwarder.active_tunnels()
+
+def set_tls_in_tls_mode(mode):
+    """Used to set how to wrap a SSLSocket to an HTTPS proxy again, see
+    `extproxy.tls_in_tls.set_tls_in_tls_mode`."""
+    from .tls_in_tls import set_tls_in_tls_mode
+    set_tls_in_tls_mode(mode)
+
+def _is_group(proxy):
+    group = loaded_module("group")
+    return group is not None and isinstance(proxy, group.ProxyGroup)
 
 def _set_proxy(self, host, type):
-    if ":/" in host:
+    if isinstance(host, ProxyInfo) or _is_group(host):
         self._tunnel_host = host, type, self._tunnel_host
+    elif ":/" in host:
+        self._tunnel_host = get_proxy_info(host), type, self._tunnel_host
     else:
         _set_proxy.orig(self, host, type)
 
@@ -21,22 +101,32 @@ def _proxy_open(self, req, proxy, type):
     if req.host and proxy_bypass(req.host):
         return
 
-    proxy_type = splittype(proxy)[0]
+    if _is_group(proxy):
+        # Select a proxy when connecting, tunnel all request types
+        req.set_proxy(proxy, "group")
+        return
+
+    proxy = get_proxy_info(proxy)
 
-    if proxy_type == "https":
-        _proxy = "http" + proxy[5:]                #
-        _proxy_open.orig(self, req, _proxy, type)  # HTTP proxy setting
+    if proxy.hostport is not None and req.type in ("http", "https"):
+        # HTTP proxy setting, same as the origin
+        if proxy.proxy_auth:
+            req.add_header("Proxy-authorization", proxy.proxy_auth)
+        req.set_proxy(proxy.hostport, "http")
+        if proxy.type == "https":
+            req.set_proxy(proxy, "https")
+        return
+
+    if proxy.type == "https":
+        _proxy_open.orig(self, req, proxy.http_url, type)  # HTTP proxy setting
         req.set_proxy(proxy, "https")
         return
 
-    if proxy_type in SOCKS_PROXY_TYPES:
-        if SOCKS_PROXY_TYPES[proxy_type] is None:
-            socks_warning()
-        else:
-            req.set_proxy(proxy, "socks")
-            return
+    if proxy.type == "socks":
+        req.set_proxy(proxy, "socks")
+        return
 
-    return _proxy_open.orig(self, req, proxy, type)
+    return _proxy_open.orig(self, req, proxy.url, type)
 
 def _set_tunnel(self, host, port=None, headers=None):
     try:
@@ -47,15 +137,23 @@ def _set_tunnel(self, host, port=None, headers=None):
     if self.sock:
         raise RuntimeError("Can't set up tunnel for established connection")
 
-    proxy = urlparse(proxy)
-    if type == "https":
-        _set_tunnel_https(self, proxy)
+    if type == "group":
+        from .group import _set_tunnel_group
+        _set_tunnel_group(self, proxy)
+    elif type == "https":
+        _set_tunnel_https(self, get_proxy_info(proxy))
     elif type == "socks":
-        _set_tunnel_socks(self, proxy)
+        _set_tunnel_socks(self, get_proxy_info(proxy))
 
     if tunnel_host:
         # Go on setting the HTTP tunnel, if need
         _set_tunnel.orig(self, tunnel_host, port, headers)
+        if metrics.enabled and type != "group":
+            _time_tunnel(self, get_proxy_info(proxy).key)
+
+def _time_tunnel(self, proxy_key):
+    tunnel = self._tunnel
+    self._tunnel = lambda: metrics.timed("http_connect", proxy_key, tunnel)
 
 _items_to_patch = (
     (Request,         "set_proxy",   _set_proxy),
@@ -0,0 +1,47 @@
+"""Keep extproxy working in the children of `os.fork`, eg: the workers of
+pre-fork servers and multiprocessing pools.
+
+A child has only the thread which called fork, so the state which is used by
+the other threads of the parent is reset in it: the pools of connections,
+the forwarder and the HTTP/2 connections, the DNS lookups in flight, the
+tunnel counts of limits, the counters of stats and all locks. The sockets of
+the parent are dropped, not closed, the parent keeps using them.
+
+The configuration and the warm caches, the parsed proxies, SSL contexts and
+their CA certs, TLS sessions, DNS results and proxy capabilities, are kept,
+shared with the parent copy-on-write.
+"""
+
+import os
+
+
+__all__ = ["reinit_after_fork", "prefork"]
+
+_child_hooks = []
+
+
+def register_child_hook(hook):
+    """Call hook() in the child after fork, the hooks are called in the
+    order of registration, modules register theirs when they are imported,
+    after the modules they depend on."""
+    _child_hooks.append(hook)
+
+def reinit_after_fork():
+    """Reset the per-process state of extproxy in the child of fork. It is
+    called automatically with Python 3.7 and above, otherwise it should be
+    called first in the child, eg: by the `post_fork` hook of gunicorn.
+    """
+    for hook in _child_hooks:
+        hook()
+
+def prefork():
+    """Used to warm up extproxy in the parent before forking workers. It
+    builds the SSL contexts of the set HTTPS proxies, so that the workers
+    share them and the loaded CA certs, instead of loading them each on the
+    first connection.
+    """
+    from .https import build_https_contexts
+    build_https_contexts()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reinit_after_fork)
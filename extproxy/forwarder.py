@@ -0,0 +1,500 @@
+"""A shared selector based forwarding engine, used instead of one thread per
+forwarded socket pair."""
+
+import heapq
+import socket
+import ssl
+import threading
+from collections import deque
+
+from . import ktls, metrics
+from .compat import selectors, mtime
+from .fork import register_child_hook
+from .limits import new_throttle
+from .transport import get_profile, set_quickack
+from .util import socketpair
+
+
+__all__ = ["enable_forwarder", "disable_forwarder", "active_tunnels"]
+
+_forwarder = None
+# The arguments of the enabled `Forwarder`, used to create it again in the
+# child of fork
+_forwarder_settings = None
+_forwarder_lock = threading.Lock()
+
+_would_block = (ssl.SSLWantReadError, ssl.SSLWantWriteError,
+                BlockingIOError, InterruptedError) if selectors else ()
+
+
+class BufferPool(object):
+    """A pool of reusable fixed size buffers."""
+
+    def __init__(self, bufsize, maxfree=16):
+        self.bufsize = bufsize
+        self.maxfree = maxfree
+        self._free = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return memoryview(bytearray(self.bufsize))
+
+    def release(self, buf):
+        with self._lock:
+            if len(self._free) < self.maxfree:
+                self._free.append(buf)
+
+
+class TimerWheel(object):
+    """A hashed timer wheel, used to check idle tunnels once per tick.
+
+    Deadlines are checked lazily, the owner refreshes the deadline of an
+    entry on activity and the wheel reschedules it when its slot expires.
+    """
+
+    def __init__(self, tick, slots=64):
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._current = int(mtime() / tick)
+
+    def schedule(self, entry, deadline):
+        index = max(int(deadline / self.tick), self._current + 1)
+        self._slots[index % len(self._slots)].add(entry)
+
+    def discard(self, entry):
+        for slot in self._slots:
+            slot.discard(entry)
+
+    def advance(self, now):
+        """Return the entries whose deadline has been passed."""
+        expired = []
+        target = int(now / self.tick)
+        nslots = len(self._slots)
+        while self._current < target:
+            self._current += 1
+            slot = self._slots[self._current % nslots]
+            if not slot:
+                continue
+            entries = list(slot)
+            slot.clear()
+            for entry in entries:
+                if entry.deadline <= now:
+                    expired.append(entry)
+                else:
+                    self.schedule(entry, entry.deadline)
+        return expired
+
+
+class _Tunnel(object):
+    __slots__ = ("local", "remote", "outbuf", "local_eof", "deadline",
+                 "closed", "proxy", "sent", "received", "pipes", "timeout",
+                 "bufsize", "max_bufsize", "quickack", "throttle",
+                 "paused_until")
+
+    def __init__(self, local, remote, timeout, bufsize, max_bufsize,
+                 quickack=False):
+        self.local = local
+        self.remote = remote
+        self.outbuf = {local: None, remote: None}
+        self.local_eof = False
+        self.timeout = timeout
+        self.deadline = mtime() + timeout
+        self.closed = False
+        # The read size, which grows up to max_bufsize
+        self.bufsize = bufsize
+        self.max_bufsize = max_bufsize
+        self.quickack = quickack
+        # The rate limits, reading is paused until paused_until if they
+        # have been exceeded
+        self.throttle = None
+        self.paused_until = 0
+        # The proxy of a traced tunnel, and the forwarded bytes
+        self.proxy = None
+        self.sent = self.received = 0
+        # The kTLS offloaded directions, maps source socket to SplicePipe
+        self.pipes = None
+
+    def peer(self, sock):
+        return self.remote if sock is self.local else self.local
+
+    def close(self):
+        self.closed = True
+        self.local.close()
+        self.remote.close()
+        if self.pipes:
+            for pipe in self.pipes.values():
+                pipe.close()
+
+
+class _ForwarderLoop(object):
+    """One event loop thread, which forwards data for many tunnels."""
+
+    def __init__(self, pool, timeout, tick):
+        self.pool = pool
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        self.wheel = TimerWheel(tick)
+        self.tunnels = set()
+        # A heap of the paused tunnels, (paused_until, id, tunnel)
+        self._paused = []
+        self._incoming = deque()
+        self._stopping = False
+        self._wakeup_r, self._wakeup_w = socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._buf = None
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run,
+                                        name="extproxy-forwarder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.tunnels) + len(self._incoming)
+
+    def add(self, local, remote):
+        self._incoming.append((local, remote))
+        self._wakeup()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except socket.error:
+            pass
+
+    def _run(self):
+        self._buf = pooled = self.pool.acquire()
+        try:
+            while not (self._stopping and not self):
+                events = self.selector.select(self._select_timeout())
+                for key, mask in events:
+                    tunnel = key.data
+                    if tunnel is None:
+                        self._drain_wakeup()
+                        continue
+                    if tunnel.closed:
+                        continue
+                    try:
+                        if mask & selectors.EVENT_WRITE:
+                            self._on_writable(tunnel, key.fileobj)
+                        if mask & selectors.EVENT_READ and not tunnel.closed:
+                            self._on_readable(tunnel, key.fileobj,
+                                              self._buf)
+                    except Exception:
+                        self._close(tunnel)
+                    else:
+                        if not tunnel.closed:
+                            self._update(tunnel)
+                while self._incoming:
+                    self._register(*self._incoming.popleft())
+                now = mtime()
+                if self._paused:
+                    self._resume(now)
+                for tunnel in self.wheel.advance(now):
+                    self._close(tunnel)
+        finally:
+            self.pool.release(pooled)
+            for tunnel in list(self.tunnels):
+                self._close(tunnel)
+            self.selector.close()
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def _register(self, local, remote):
+        local.setblocking(False)
+        remote.setblocking(False)
+        profile = get_profile(remote)
+        bufsize = profile.bufsize or self.pool.bufsize
+        tunnel = _Tunnel(local, remote, profile.idle_timeout or self.timeout,
+                         bufsize, max(profile.max_bufsize or bufsize, bufsize),
+                         profile.quickack)
+        if tunnel.max_bufsize > len(self._buf):
+            # The read buffer is shared, it fits the largest tunnel
+            self._buf = memoryview(bytearray(tunnel.max_bufsize))
+        tx, rx = ktls.offloaded(remote)
+        if tx or rx:
+            tunnel.pipes = {}
+            if tx:
+                tunnel.pipes[local] = ktls.SplicePipe()
+            if rx:
+                tunnel.pipes[remote] = ktls.SplicePipe()
+        tunnel.throttle = new_throttle(metrics.proxy_key_of(remote))
+        if metrics.enabled:
+            tunnel.proxy = metrics.proxy_key_of(remote) or ""
+            metrics.emit("tunnel_open", tunnel.proxy, 1)
+        self.tunnels.add(tunnel)
+        self.selector.register(local, selectors.EVENT_READ, tunnel)
+        self.selector.register(remote, selectors.EVENT_READ, tunnel)
+        self.wheel.schedule(tunnel, tunnel.deadline)
+        # SSLSocket() may hold decrypted data which select() can not see.
+        if getattr(remote, "pending", None) and remote.pending():
+            try:
+                self._on_readable(tunnel, remote, self._buf)
+            except Exception:
+                self._close(tunnel)
+            else:
+                if not tunnel.closed:
+                    self._update(tunnel)
+
+    def _close(self, tunnel):
+        if tunnel.closed:
+            return
+        for sock in (tunnel.local, tunnel.remote):
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        self.tunnels.discard(tunnel)
+        self.wheel.discard(tunnel)
+        tunnel.close()
+        if tunnel.proxy is not None:
+            metrics.emit("tunnel_close", tunnel.proxy, 1)
+            metrics.emit("bytes_sent", tunnel.proxy, tunnel.sent)
+            metrics.emit("bytes_received", tunnel.proxy, tunnel.received)
+
+    def _update(self, tunnel):
+        for sock in (tunnel.local, tunnel.remote):
+            events = 0
+            if tunnel.outbuf[sock] is not None:
+                events |= selectors.EVENT_WRITE
+            if tunnel.outbuf[tunnel.peer(sock)] is None and \
+                    not tunnel.paused_until and not (
+                    sock is tunnel.local and tunnel.local_eof):
+                events |= selectors.EVENT_READ
+            try:
+                key = self.selector.get_key(sock)
+            except KeyError:
+                if events:
+                    self.selector.register(sock, events, tunnel)
+            else:
+                if not events:
+                    self.selector.unregister(sock)
+                elif key.events != events:
+                    self.selector.modify(sock, events, tunnel)
+
+    def _send(self, tunnel, sock, data):
+        try:
+            sent = sock.send(data)
+        except _would_block:
+            sent = 0
+        if sent < len(data):
+            tunnel.outbuf[sock] = memoryview(bytes(data[sent:]))
+            return False
+        tunnel.outbuf[sock] = None
+        return True
+
+    def _flush_pipe(self, tunnel, sock, pipe):
+        try:
+            pipe.splice_to(sock)
+        except _would_block:
+            pass
+        tunnel.outbuf[sock] = pipe if pipe.pending else None
+
+    def _on_writable(self, tunnel, sock):
+        data = tunnel.outbuf[sock]
+        if isinstance(data, ktls.SplicePipe):
+            self._flush_pipe(tunnel, sock, data)
+        elif data is not None:
+            self._send(tunnel, sock, data)
+
+    def _on_data(self, tunnel, sock, ndata):
+        """Return False at EOF."""
+        if not ndata:
+            if sock is tunnel.remote:
+                self._close(tunnel)
+            else:
+                tunnel.local_eof = True
+            return False
+        tunnel.deadline = mtime() + tunnel.timeout
+        if sock is tunnel.local:
+            tunnel.sent += ndata
+        else:
+            tunnel.received += ndata
+            if tunnel.quickack:
+                set_quickack(sock)
+        if ndata >= tunnel.bufsize and tunnel.bufsize < tunnel.max_bufsize:
+            # Grow the read size for bulk transfers
+            tunnel.bufsize = min(tunnel.bufsize * 2, tunnel.max_bufsize)
+        if tunnel.throttle is not None:
+            delay = tunnel.throttle.consume(ndata)
+            if delay > 0:
+                self._pause(tunnel, delay)
+        return True
+
+    def _pause(self, tunnel, delay):
+        tunnel.paused_until = mtime() + delay
+        heapq.heappush(self._paused,
+                       (tunnel.paused_until, id(tunnel), tunnel))
+
+    def _resume(self, now):
+        while self._paused and self._paused[0][0] <= now:
+            _, _, tunnel = heapq.heappop(self._paused)
+            tunnel.paused_until = 0
+            if tunnel.closed:
+                continue
+            remote = tunnel.remote
+            try:
+                # SSLSocket() may hold decrypted data which select() can not
+                # see.
+                if getattr(remote, "pending", None) and remote.pending():
+                    self._on_readable(tunnel, remote, self._buf)
+            except Exception:
+                self._close(tunnel)
+            else:
+                if not tunnel.closed:
+                    self._update(tunnel)
+
+    def _select_timeout(self):
+        if not self._paused:
+            return self.wheel.tick
+        return max(min(self._paused[0][0] - mtime(), self.wheel.tick), 0)
+
+    def _splice(self, tunnel, sock, pipe):
+        """Move data to the peer in kernel, return False if the data should
+        be read in user space."""
+        try:
+            ndata = pipe.splice_from(sock, tunnel.bufsize)
+        except _would_block:
+            return True
+        except OSError as e:
+            if e.errno in ktls.UNSUPPORTED_ERRNOS:
+                del tunnel.pipes[sock]
+                pipe.close()
+            elif e.errno not in ktls.RECORD_ERRNOS:
+                raise
+            return False
+        if self._on_data(tunnel, sock, ndata):
+            other = tunnel.peer(sock)
+            tunnel.outbuf[other] = pipe
+            self._flush_pipe(tunnel, other, pipe)
+        return True
+
+    def _on_readable(self, tunnel, sock, buf):
+        if tunnel.paused_until:
+            return
+        other = tunnel.peer(sock)
+        pipe = tunnel.pipes and tunnel.pipes.get(sock)
+        # SSLSocket() may hold data which has been read by OpenSSL
+        if pipe and tunnel.outbuf[other] is None and not (
+                getattr(sock, "pending", None) and sock.pending()):
+            if self._splice(tunnel, sock, pipe):
+                return
+        while tunnel.outbuf[other] is None:
+            try:
+                ndata = sock.recv_into(buf, tunnel.bufsize)
+            except _would_block:
+                return
+            if not self._on_data(tunnel, sock, ndata):
+                return
+            if not self._send(tunnel, other, buf[:ndata]):
+                return
+            if tunnel.paused_until or not (getattr(sock, "pending", None) and
+                                           sock.pending()):
+                return
+
+
+class Forwarder(object):
+    """Forward data between socket pairs with a few event loop threads.
+
+    shards
+        The number of event loop threads.
+    bufsize
+        The size of read buffers, one buffer is shared by all tunnels of a
+        event loop thread, it grows for the tunnels whose `TransportProfile`
+        has a larger max_bufsize.
+    timeout
+        Close tunnels which have been idle for this many seconds, unless
+        the `TransportProfile` of the proxy sets idle_timeout.
+    tick
+        The resolution of idle checks, in seconds.
+
+    The data of kTLS offloaded proxy connections is moved with `os.splice`.
+    """
+
+    def __init__(self, shards=1, bufsize=1024*32, timeout=60, tick=4):
+        if selectors is None:
+            raise RuntimeError("the forwarder requires module selectors")
+        self.pool = BufferPool(bufsize)
+        self.loops = [_ForwarderLoop(self.pool, timeout, tick)
+                      for _ in range(shards)]
+
+    def register(self, local, remote):
+        min(self.loops, key=len).add(local, remote)
+
+    def active_tunnels(self):
+        return sum(len(loop) for loop in self.loops)
+
+    def stop(self):
+        """Stop after the registered tunnels have been closed."""
+        for loop in self.loops:
+            loop.stop()
+
+
+def enable_forwarder(shards=1, **kwargs):
+    """Forward socket pairs of TLS-over-HTTPS-proxy connections with shared
+    event loop threads, instead of a new thread per connection.
+
+    shards
+        The number of event loop threads.
+
+    optional:
+
+    bufsize, timeout, tick
+        See `Forwarder`.
+    """
+    global _forwarder, _forwarder_settings
+    with _forwarder_lock:
+        if _forwarder is not None:
+            _forwarder.stop()
+        _forwarder = Forwarder(shards, **kwargs)
+        _forwarder_settings = shards, kwargs
+
+def disable_forwarder():
+    """Go back to using a new thread per connection. Registered tunnels
+    continue working until closed."""
+    global _forwarder, _forwarder_settings
+    with _forwarder_lock:
+        if _forwarder is not None:
+            _forwarder.stop()
+            _forwarder = None
+        _forwarder_settings = None
+
+def get_forwarder():
+    global _forwarder
+    if _forwarder is None and _forwarder_settings is not None:
+        # Dropped in the child of fork, create it again on first use
+        with _forwarder_lock:
+            if _forwarder is None and _forwarder_settings is not None:
+                shards, kwargs = _forwarder_settings
+                _forwarder = Forwarder(shards, **kwargs)
+    return _forwarder
+
+def active_tunnels():
+    """Return the count of active tunnels of the forwarder."""
+    forwarder = _forwarder
+    if forwarder is None:
+        return 0
+    return forwarder.active_tunnels()
+
+def _after_fork():
+    global _forwarder, _forwarder_lock
+    # The event loop threads of the parent do not exist in the child, the
+    # forwarder is created again by `get_forwarder`
+    _forwarder_lock = threading.Lock()
+    _forwarder = None
+
+register_child_hook(_after_fork)
@@ -0,0 +1,317 @@
+"""Select proxies from a group by latency, with failover, circuit breakers
+and hedged connects."""
+
+import threading
+import weakref
+
+from . import happy_eyeballs, metrics
+from .compat import mtime
+from .fork import register_child_hook
+from .https import _create_https_connection
+from .limits import limited_connect
+from .origin_sessions import mark_tunnel
+from .proxy_info import get_proxy_info
+from .socks import _create_socks_connection
+from .transport import DEFAULT_PROFILE
+from .tunnel import TunnelError, http_connect
+
+
+__all__ = ["ProxyGroup"]
+
+# The statuses of refused CONNECT requests, which are caused by destination
+_DESTINATION_STATUSES = (400, 403, 404)
+
+_groups = weakref.WeakSet()
+
+
+def connect_proxy(proxy, dest_pair, timeout=None, source_address=None):
+    """Open a tunnel to destination through a proxy of any supported type,
+    return the connected socket."""
+    if proxy.type == "socks":
+        return _create_socks_connection(proxy, dest_pair, timeout,
+                                        source_address)
+    if proxy.type == "https":
+        sock = _create_https_connection(proxy, timeout, source_address)
+    elif proxy.scheme == "http":
+        sock = limited_connect(proxy.key, timeout,
+                               happy_eyeballs.create_connection,
+                               (proxy.hostname, proxy.port or 80), timeout,
+                               source_address, proxy.key,
+                               happy_eyeballs.CONNECTION_ATTEMPT_DELAY, False,
+                               DEFAULT_PROFILE)
+    else:
+        raise ValueError("unsupported proxy type of proxy group: %r"
+                         % proxy.scheme)
+    try:
+        if metrics.enabled:
+            metrics.timed("http_connect", proxy.key, http_connect, sock,
+                          dest_pair, proxy.proxy_auth)
+        else:
+            http_connect(sock, dest_pair, proxy.proxy_auth)
+    except:
+        sock.close()
+        raise
+    if proxy.type is None:
+        mark_tunnel(sock, proxy.key)
+    return sock
+
+def _is_destination_error(e):
+    # The proxy works, but it can not connect to the destination
+    if isinstance(e, TunnelError):
+        # Forbidden or unknown destinations, the 5xx statuses may be
+        # failures of the proxy itself, eg: 502, 503, 504
+        return e.status in _DESTINATION_STATUSES
+    from .socks_client import SOCKS4Error, SOCKS5Error
+    if isinstance(e, SOCKS5Error):
+        return e.status in (0x02, 0x03, 0x04, 0x05, 0x06)
+    return isinstance(e, SOCKS4Error)
+
+
+class _Member(object):
+    __slots__ = ("proxy", "latency", "failures", "down_until", "probing")
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.latency = None
+        self.failures = 0
+        self.down_until = 0
+        self.probing = False
+
+    def __repr__(self):
+        return "<%s %s latency=%r failures=%d>" % (
+            self.__class__.__name__, self.proxy.url, self.latency,
+            self.failures)
+
+
+class ProxyGroup(object):
+    """A group of proxies, which can be used as a proxy of `ProxyHandler`,
+    eg: ProxyHandler({"https": ProxyGroup([proxy1, proxy2])})
+
+    Connections are always tunneled, via CONNECT for HTTP and HTTPS proxies.
+    Proxies are selected by the EWMA of connect and handshake latency.
+
+    proxies
+        A list of HTTP, HTTPS or SOCKS proxies of string.
+
+    optional:
+
+    hedge_delay
+        Race the next proxy if the connection to the first one has not
+        been established within this many seconds, default never.
+    failure_threshold
+        Mark a proxy as down after this many consecutive failures.
+    recovery_time
+        Seconds after that a down proxy is tried again by one connection.
+    alpha
+        The weight of new samples in latency EWMA.
+    """
+
+    def __init__(self, proxies, hedge_delay=None, failure_threshold=3,
+                 recovery_time=30, alpha=0.3):
+        self.members = [_Member(get_proxy_info(proxy)) for proxy in proxies]
+        if not self.members:
+            raise ValueError("proxy group is empty")
+        self.hedge_delay = hedge_delay
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        _groups.add(self)
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__,
+                            [member.proxy.url for member in self.members])
+
+    def stats(self):
+        """Return the latency and health of proxies, eg:
+        {"socks5://127.0.0.1:1080": {"latency": 0.01, "failures": 0,
+                                     "down": False}}
+        """
+        now = mtime()
+        with self._lock:
+            return dict((member.proxy.url,
+                         {"latency": member.latency,
+                          "failures": member.failures,
+                          "down": member.down_until > now})
+                        for member in self.members)
+
+    def _after_fork(self):
+        # Keep the measured latency and health
+        self._lock = threading.Lock()
+        for member in self.members:
+            member.probing = False
+
+    def candidates(self):
+        """Return the members to try, in order of preference."""
+        now = mtime()
+        up = []
+        down = []
+        probe = None
+        with self._lock:
+            for member in self.members:
+                if member.down_until <= 0:
+                    up.append(member)
+                elif member.down_until <= now and not member.probing and \
+                        probe is None:
+                    # Half-open, let one connection check it again
+                    member.probing = True
+                    probe = member
+                else:
+                    down.append(member)
+        # Proxies without samples sort first, so that they are measured
+        up.sort(key=lambda member: member.latency or 0)
+        if probe is not None:
+            up.insert(0, probe)
+        if not up:
+            # All are down, try the one which recovers soonest
+            down.sort(key=lambda member: member.down_until)
+            up = down[:1]
+        return up
+
+    def record_latency(self, member, latency):
+        with self._lock:
+            self._update_latency(member, latency)
+
+    def record_success(self, member, latency):
+        with self._lock:
+            self._update_latency(member, latency)
+            member.failures = 0
+            member.down_until = 0
+            member.probing = False
+
+    def _update_latency(self, member, latency):
+        if member.latency is None:
+            member.latency = latency
+        else:
+            member.latency += self.alpha * (latency - member.latency)
+
+    def record_failure(self, member):
+        with self._lock:
+            member.failures += 1
+            member.probing = False
+            if member.failures >= self.failure_threshold or \
+                    member.down_until > 0:
+                member.down_until = mtime() + self.recovery_time
+
+    def _connect(self, member, dest_pair, timeout, source_address):
+        start = mtime()
+        try:
+            sock = connect_proxy(member.proxy, dest_pair, timeout,
+                                 source_address)
+        except Exception as e:
+            if not _is_destination_error(e):
+                self.record_failure(member)
+            raise
+        self.record_success(member, mtime() - start)
+        return sock
+
+    def create_connection(self, dest_pair, timeout=None, source_address=None):
+        """Open a tunnel to destination through the best proxy, fail over to
+        the others."""
+        candidates = self.candidates()
+        if self.hedge_delay is None or len(candidates) == 1:
+            error = None
+            for member in candidates:
+                try:
+                    return self._connect(member, dest_pair, timeout,
+                                         source_address)
+                except Exception as e:
+                    error = e
+                    if _is_destination_error(e):
+                        break
+            raise error
+        return _HedgedConnect(self, candidates, dest_pair, timeout,
+                              source_address).run()
+
+
+class _HedgedConnect(object):
+    """Connect to the candidates in threads, start the next one when the
+    previous one fails or is slow, return the first established tunnel."""
+
+    def __init__(self, group, candidates, dest_pair, timeout, source_address):
+        self.group = group
+        self.candidates = list(candidates)
+        self.args = dest_pair, timeout, source_address
+        self.results = []
+        self.pending = 0
+        self.started = {}
+        self.done = False
+        self.cond = threading.Condition()
+
+    def _start_next(self):
+        member = self.candidates.pop(0)
+        self.pending += 1
+        self.started[member] = mtime()
+        thread = threading.Thread(target=self._attempt, args=(member,),
+                                  name="extproxy-hedged-connect")
+        thread.daemon = True
+        thread.start()
+
+    def _attempt(self, member):
+        try:
+            result = self.group._connect(member, *self.args), None
+        except Exception as e:
+            result = None, e
+        with self.cond:
+            self.pending -= 1
+            self.started.pop(member, None)
+            if not self.done:
+                self.results.append(result)
+                self.cond.notify()
+                return
+        # Lost the race
+        if result[0] is not None:
+            result[0].close()
+
+    def run(self):
+        hedge_delay = self.group.hedge_delay
+        error = None
+        with self.cond:
+            self._start_next()
+            while True:
+                if not self.results:
+                    if self.candidates:
+                        deadline = mtime() + hedge_delay
+                        while not self.results and mtime() < deadline:
+                            self.cond.wait(deadline - mtime())
+                        if not self.results:
+                            self._start_next()
+                            continue
+                    elif self.pending:
+                        self.cond.wait()
+                        continue
+                    else:
+                        break
+                sock, e = self.results.pop(0)
+                if sock is not None:
+                    self.done = True
+                    for other, _ in self.results:
+                        if other is not None:
+                            other.close()
+                    # The losers are slower than that at least
+                    now = mtime()
+                    for member, start in self.started.items():
+                        self.group.record_latency(member, now - start)
+                    return sock
+                error = e
+                if _is_destination_error(e):
+                    # Other proxies would fail too
+                    self.candidates = []
+                elif self.candidates:
+                    self._start_next()
+            self.done = True
+        raise error
+
+
+def _set_tunnel_group(self, group):
+    def create_connection(dest_pair, timeout=None, source_address=None,
+                          group=group):
+        return group.create_connection(dest_pair, timeout, source_address)
+
+    self._create_connection = create_connection
+
+def _after_fork():
+    for group in list(_groups):
+        group._after_fork()
+
+register_child_hook(_after_fork)
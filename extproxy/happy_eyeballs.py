@@ -0,0 +1,196 @@
+"""Connect to proxy hosts with Happy Eyeballs (RFC 8305), race the resolved
+addresses and alternate address families."""
+
+import errno
+import os
+import select
+import socket
+import sys
+
+from . import metrics
+from .capabilities import proxy_capabilities
+from .compat import mtime, selectors
+from .resolver import getaddrinfo
+
+
+# RFC 8305 recommended Connection Attempt Delay
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+_CONNECT_IN_PROGRESS = set([0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                            errno.EAGAIN, 10035])  # 10035: WSAEWOULDBLOCK
+
+# Linux 4.11 and above, connect() returns at once if a TFO cookie of the
+# server is cached, then the first write is sent with SYN
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", None)
+if TCP_FASTOPEN_CONNECT is None and sys.platform.startswith("linux"):
+    TCP_FASTOPEN_CONNECT = 30
+
+
+def sort_addrinfos(infos, family=None):
+    """Return `getaddrinfo` results in order of attempts, the addresses of
+    `family` (default the first one's) first, then alternate families."""
+    if not infos:
+        return infos
+    if family is None or not any(info[0] == family for info in infos):
+        family = infos[0][0]
+    preferred = [info for info in infos if info[0] == family]
+    others = [info for info in infos if info[0] != family]
+    result = []
+    while preferred or others:
+        if preferred:
+            result.append(preferred.pop(0))
+        if others:
+            result.append(others.pop(0))
+    return result
+
+def _set_fast_open(sock):
+    if TCP_FASTOPEN_CONNECT is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+    except socket.error:
+        # Unsupported by the kernel
+        pass
+
+def _connect(info, timeout, source_address, fast_open=False, profile=None):
+    af, socktype, proto, _, sa = info
+    sock = socket.socket(af, socktype, proto)
+    try:
+        if fast_open:
+            _set_fast_open(sock)
+        if profile is not None:
+            profile.apply(sock)
+        sock.settimeout(timeout)
+        if source_address:
+            sock.bind(source_address)
+        sock.connect(sa)
+    except:
+        sock.close()
+        raise
+    return sock
+
+def _start_connect(info, source_address, fast_open=False, profile=None):
+    af, socktype, proto, _, sa = info
+    sock = socket.socket(af, socktype, proto)
+    try:
+        if fast_open:
+            _set_fast_open(sock)
+        if profile is not None:
+            profile.apply(sock)
+        sock.setblocking(False)
+        if source_address:
+            sock.bind(source_address)
+        err = sock.connect_ex(sa)
+        if err not in _CONNECT_IN_PROGRESS:
+            raise socket.error(err, os.strerror(err))
+    except:
+        sock.close()
+        raise
+    return sock
+
+def _wait_connected(socks, timeout):
+    """Return the sockets which have connected or failed."""
+    if selectors is None:
+        _, writable, exceptional = select.select([], socks, socks, timeout)
+        return set(writable) | set(exceptional)
+    # Unlike select(), works with file descriptors above FD_SETSIZE
+    selector = selectors.DefaultSelector()
+    try:
+        for sock in socks:
+            selector.register(sock, selectors.EVENT_WRITE)
+        return [key.fileobj for key, _ in selector.select(timeout)]
+    finally:
+        selector.close()
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                      source_address=None, key=None,
+                      delay=CONNECTION_ATTEMPT_DELAY, fast_open=False,
+                      profile=None):
+    """Like `socket.create_connection`, but start the attempt to the next
+    address after `delay`, if the previous attempts have not connected.
+    The first connected socket wins, the others are closed.
+
+    key
+        The key of the proxy, used to remember the address family which
+        wins, later connections try it first.
+    fast_open
+        Whether to use TCP Fast Open if the kernel supports it, the first
+        address wins at once if a TFO cookie of it has been cached.
+    profile
+        A `TransportProfile` object, its socket options are set before
+        connecting.
+    """
+    if metrics.enabled:
+        return metrics.timed("connect", key, _create_connection, address,
+                             timeout, source_address, key, delay, fast_open,
+                             profile)
+    return _create_connection(address, timeout, source_address, key, delay,
+                              fast_open, profile)
+
+def _create_connection(address, timeout, source_address, key, delay,
+                       fast_open, profile):
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    host, port = address
+    infos = getaddrinfo(host, port)
+    if len(infos) == 1:
+        return _connect(infos[0], timeout, source_address, fast_open,
+                        profile)
+
+    families = set(info[0] for info in infos)
+    family = None
+    if key is not None and len(families) > 1:
+        family = proxy_capabilities.get(key, "address_family")
+    infos = sort_addrinfos(infos, family)
+
+    deadline = None if timeout is None else mtime() + timeout
+    pending = {}
+    error = None
+    winner = None
+    next_start = 0
+    try:
+        while True:
+            now = mtime()
+            if infos and (not pending or now >= next_start):
+                info = infos.pop(0)
+                try:
+                    pending[_start_connect(info, source_address,
+                                           fast_open, profile)] = info[0]
+                except socket.error as e:
+                    error = e
+                    continue
+                next_start = now + delay
+            if not pending:
+                break
+            if deadline is not None and now >= deadline:
+                error = socket.timeout("timed out")
+                break
+            waits = []
+            if infos:
+                waits.append(next_start - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            for sock in _wait_connected(list(pending),
+                                        max(min(waits), 0) if waits else None):
+                af = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0 and winner is None:
+                    winner = sock, af
+                else:
+                    sock.close()
+                    if err:
+                        error = socket.error(err, os.strerror(err))
+            if winner is not None:
+                break
+    finally:
+        # Cancel the losers
+        for sock in pending:
+            sock.close()
+
+    if winner is None:
+        raise error
+    sock, af = winner
+    if key is not None and len(families) > 1 and af != family:
+        proxy_capabilities.set(key, "address_family", af)
+    sock.settimeout(timeout)
+    return sock
@@ -0,0 +1,618 @@
+"""Multiplex tunnels through HTTPS proxies over shared HTTP/2 connections,
+each tunnel is a CONNECT stream (RFC 9113, section 8.5).
+
+The package `h2` is imported on first use, it requires Python 3.
+"""
+
+import errno
+import socket
+import ssl
+import threading
+from collections import deque
+
+from .compat import mtime, responses, selectors
+from .fork import register_child_hook
+from .limits import release_lease
+from .origin_sessions import mark_tunnel
+from .tunnel import TunnelError, connect_authority
+from .util import socketpair
+
+
+# The receive windows, sized for throughput: a stream can receive 4 MiB
+# which has not been read, all streams of a connection 32 MiB
+STREAM_WINDOW = 1 << 22
+CONNECTION_WINDOW = 1 << 25
+# Larger frames take less work per byte
+MAX_FRAME_SIZE = 1 << 18
+# The max count of concurrent streams per connection, if the proxy allows
+MAX_STREAMS = 100
+# The max count of connections per proxy
+MAX_CONNECTIONS = 4
+# Close connections which have carried no stream for this many seconds
+IDLE_TIMEOUT = 60
+# Writers wait while this many bytes have not been sent
+_MAX_OUTGOING = 1 << 20
+# The max bytes of received TLS records, which are handed over at once
+_RECV_BATCH = 1 << 18
+
+# Connection-specific headers are not allowed in HTTP/2
+_HOP_HEADERS = frozenset(["connection", "host", "keep-alive",
+                          "proxy-connection", "te", "transfer-encoding",
+                          "upgrade"])
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def h2_available():
+    """Whether HTTP/2 tunnels are supported, it requires the package h2, and
+    ssl with ALPN and MemoryBIO."""
+    if not (getattr(ssl, "HAS_ALPN", False) and hasattr(ssl, "MemoryBIO")):
+        return False
+    try:
+        import h2
+    except ImportError:
+        return False
+    return True
+
+
+class _ConnectionGone(socket.error):
+    """The connection can not open new streams."""
+
+
+class StreamRefusedError(socket.error):
+    """The proxy has not processed the CONNECT request, by REFUSED_STREAM or
+    GOAWAY, it can be retried (RFC 9113, section 8.7)."""
+
+
+class H2Stream(object):
+    """A tunnel through an HTTP/2 connection to proxy, a socket-like object
+    which `http.client` and `TLSInTLSSocket` run over.
+    """
+
+    _extproxy_releases_lease = True
+
+    def __init__(self, conn, stream_id):
+        self._conn = conn
+        self.stream_id = stream_id
+        self.status = None
+        self._chunks = deque()
+        # The offset of read data in the first chunk
+        self._offset = 0
+        self._eof = False
+        self._error = None
+        self._timeout = None
+        self._io_refs = 0
+        self._closed = False
+
+    def _check(self):
+        """Raise the error of the stream, or of the tunnel request, must be
+        called with the lock of the connection."""
+        error = self._error or self._conn.error
+        if error is not None:
+            raise error
+        if self.status is not None and not 200 <= self.status < 300:
+            raise TunnelError(self.status, responses.get(self.status, ""))
+
+    def _deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self._timeout
+        return None if timeout is None else mtime() + timeout
+
+    def wait_response(self, timeout=None):
+        """Wait for the response of the CONNECT request, raise
+        `TunnelError` if it is refused."""
+        conn = self._conn
+        deadline = self._deadline(timeout)
+        with conn.cond:
+            while self.status is None:
+                self._check()
+                if self._eof:
+                    raise socket.error("Tunnel connection failed: "
+                                       "stream closed")
+                conn._wait(deadline)
+            self._check()
+
+    def _read(self, n):
+        conn = self._conn
+        deadline = self._deadline()
+        with conn.cond:
+            # The response of a CONNECT request which has not been waited
+            while self.status is None or not self._chunks:
+                self._check()
+                if self._eof:
+                    if self.status is None:
+                        raise socket.error("Tunnel connection failed: "
+                                           "stream closed")
+                    return b""
+                conn._wait(deadline)
+            self._check()
+            chunk = self._chunks[0]
+            offset = self._offset
+            data = chunk[offset:offset + n]
+            if offset + n < len(chunk):
+                self._offset = offset + n
+            else:
+                self._chunks.popleft()
+                self._offset = 0
+            # Refill the receive windows
+            conn._h2.acknowledge_received_data(len(data), self.stream_id)
+            wakeup = conn._collect()
+        if wakeup:
+            conn._wakeup()
+        return data
+
+    def recv(self, buflen=1024, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to recv()")
+        return self._read(buflen)
+
+    def recv_into(self, buffer, nbytes=None, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to "
+                             "recv_into()")
+        if not nbytes:
+            nbytes = len(buffer)
+        data = self._read(nbytes)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def send(self, data, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to send()")
+        conn = self._conn
+        h2 = conn._h2
+        deadline = self._deadline()
+        with conn.cond:
+            while True:
+                if self._closed:
+                    raise socket.error(errno.EBADF, "Bad file descriptor")
+                self._check()
+                if len(conn._outgoing) < _MAX_OUTGOING:
+                    # The send windows of the stream and the connection
+                    window = h2.local_flow_control_window(self.stream_id)
+                    if window > 0:
+                        break
+                conn._wait(deadline)
+            size = min(len(data), window, h2.max_outbound_frame_size)
+            h2.send_data(self.stream_id, bytes(data[:size]))
+            wakeup = conn._collect()
+        if wakeup:
+            conn._wakeup()
+        return size
+
+    def sendall(self, data, flags=0):
+        with memoryview(data) as view, view.cast("B") as byte_view:
+            amount = len(byte_view)
+            count = 0
+            while count < amount:
+                count += self.send(byte_view[count:], flags)
+
+    def shutdown(self, how):
+        if how != socket.SHUT_RD:
+            self._conn._end_stream(self)
+
+    def is_alive(self):
+        """Whether the tunnel has not been closed by the peer."""
+        with self._conn.cond:
+            return self._error is None and self._conn.error is None and \
+                   (bool(self._chunks) or not self._eof)
+
+    def settimeout(self, timeout):
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def setblocking(self, flag):
+        self._timeout = None if flag else 0.0
+
+    def setsockopt(self, *args):
+        # TCP options are set by http.client, they are of the connection
+        pass
+
+    def close(self):
+        self._closed = True
+        if self._io_refs <= 0:
+            self._conn._close_stream(self)
+
+    def _decref_socketios(self):
+        if self._io_refs > 0:
+            self._io_refs -= 1
+        if self._closed:
+            self.close()
+
+    def makefile(self, *args, **kwargs):
+        # Used by http.client for plain HTTP requests over the tunnel
+        from .tls_in_tls import TLSInTLSSocket
+        return TLSInTLSSocket.makefile(self, *args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "<%s %d over %r>" % (self.__class__.__name__, self.stream_id,
+                                    self._conn)
+
+
+class H2ProxyConnection(object):
+    """An HTTP/2 connection to proxy, which carries the tunnels as CONNECT
+    streams. The I/O is done by a thread of the connection, the streams
+    wait for it.
+    """
+
+    def __init__(self, sock, key):
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+        from h2.settings import SettingCodes
+        self.sock = sock
+        self.key = key
+        self.streams = {}
+        self.cond = threading.Condition()
+        # An error which has closed the connection
+        self.error = None
+        # Whether new streams can not be opened
+        self.goaway = False
+        self._idle_since = mtime()
+        self._outgoing = bytearray()
+        self._h2 = H2Connection(H2Configuration(client_side=True,
+                                                header_encoding="latin-1"))
+        self._h2.initiate_connection()
+        self._h2.update_settings({
+            SettingCodes.ENABLE_PUSH: 0,
+            SettingCodes.INITIAL_WINDOW_SIZE: STREAM_WINDOW,
+            SettingCodes.MAX_FRAME_SIZE: MAX_FRAME_SIZE,
+        })
+        self._h2.increment_flow_control_window(
+                CONNECTION_WINDOW - self._h2.inbound_flow_control_window)
+        self._collect()
+        self._wakeup_r, self._wakeup_w = socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        sock.setblocking(False)
+        self._thread = threading.Thread(target=self._run,
+                                        name="extproxy-http2")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.streams)
+
+    def is_usable(self):
+        return self.error is None and not self.goaway
+
+    def has_free_stream(self):
+        max_streams = self._h2.remote_settings.max_concurrent_streams
+        return len(self.streams) < min(max_streams, MAX_STREAMS)
+
+    def open_stream(self, dest_pair, headers=None, timeout=None):
+        """Send a CONNECT request to destination, return a `H2Stream`, its
+        response is waited by `H2Stream.wait_response` or the first read.
+        """
+        request = [(":method", "CONNECT"),
+                   (":authority", connect_authority(dest_pair))]
+        for name, value in (headers or {}).items():
+            name = name.lower()
+            if name not in _HOP_HEADERS:
+                request.append((name, value))
+        deadline = None if timeout is None else mtime() + timeout
+        with self.cond:
+            while True:
+                if not self.is_usable():
+                    raise _ConnectionGone("HTTP/2 connection to proxy %s is "
+                                          "closing" % self.key)
+                if self.has_free_stream():
+                    break
+                self._wait(deadline)
+            stream_id = self._h2.get_next_available_stream_id()
+            self._h2.send_headers(stream_id, request)
+            stream = self.streams[stream_id] = H2Stream(self, stream_id)
+            self._collect()
+        self._wakeup()
+        stream.settimeout(timeout)
+        return stream
+
+    def _wait(self, deadline):
+        """Wait for the I/O thread, must be called with the lock."""
+        if deadline is None:
+            self.cond.wait()
+            return
+        remaining = deadline - mtime()
+        if remaining <= 0:
+            raise socket.timeout("timed out")
+        self.cond.wait(remaining)
+
+    def _collect(self):
+        """Move the data to send from h2 to the I/O thread, must be called
+        with the lock, return whether the thread needs a wakeup."""
+        data = self._h2.data_to_send()
+        if data:
+            self._outgoing += data
+            return True
+        return False
+
+    def _wakeup(self):
+        try:
+            self._wakeup_w.send(b"\0")
+        except socket.error:
+            pass
+
+    def _end_stream(self, stream):
+        from h2.exceptions import ProtocolError
+        with self.cond:
+            try:
+                self._h2.end_stream(stream.stream_id)
+            except ProtocolError:
+                # Has been ended or reset
+                return
+            self._collect()
+        self._wakeup()
+
+    def _close_stream(self, stream):
+        from h2.errors import ErrorCodes
+        from h2.exceptions import ProtocolError
+        with self.cond:
+            if self.streams.pop(stream.stream_id, None) is None:
+                return
+            try:
+                if stream._eof:
+                    self._h2.end_stream(stream.stream_id)
+                else:
+                    self._h2.reset_stream(stream.stream_id,
+                                          ErrorCodes.CANCEL)
+            except ProtocolError:
+                # Has been closed
+                pass
+            # Give back the receive window of the unread data
+            unread = sum(len(data) for data in stream._chunks) - \
+                     stream._offset
+            stream._chunks.clear()
+            if unread:
+                self._h2.acknowledge_received_data(unread, stream.stream_id)
+            if not self.streams:
+                self._idle_since = mtime()
+            self._collect()
+            self.cond.notify_all()
+        self._wakeup()
+        release_lease(stream)
+
+    def _handle_events(self, events):
+        from h2.errors import ErrorCodes
+        from h2.events import ConnectionTerminated, DataReceived, \
+                              ResponseReceived, StreamEnded, StreamReset
+        for event in events:
+            stream = self.streams.get(getattr(event, "stream_id", None))
+            if isinstance(event, DataReceived):
+                # The padding is not data of the stream
+                unused = event.flow_controlled_length
+                if stream is not None and event.data:
+                    stream._chunks.append(event.data)
+                    unused -= len(event.data)
+                if unused:
+                    self._h2.acknowledge_received_data(unused,
+                                                       event.stream_id)
+            elif isinstance(event, ResponseReceived):
+                if stream is not None:
+                    stream.status = int(dict(event.headers)[":status"])
+            elif isinstance(event, StreamEnded):
+                if stream is not None:
+                    stream._eof = True
+            elif isinstance(event, StreamReset):
+                if stream is None:
+                    continue
+                if event.error_code == ErrorCodes.REFUSED_STREAM and \
+                        stream.status is None:
+                    stream._error = StreamRefusedError(
+                            errno.ECONNREFUSED, "HTTP/2 stream refused by "
+                            "proxy")
+                else:
+                    stream._error = socket.error(
+                            errno.ECONNRESET, "HTTP/2 stream reset by proxy, "
+                            "error code %d" % event.error_code)
+            elif isinstance(event, ConnectionTerminated):
+                self.goaway = True
+                last_stream_id = event.last_stream_id
+                for stream in self.streams.values():
+                    if last_stream_id is None:
+                        stream._error = socket.error(
+                                errno.ECONNRESET, "HTTP/2 connection is "
+                                "going away, error code %d" % event.error_code)
+                    elif stream.stream_id > last_stream_id:
+                        # Has not been processed
+                        stream._error = StreamRefusedError(
+                                errno.ECONNREFUSED, "HTTP/2 connection is "
+                                "going away, error code %d" % event.error_code)
+        self.cond.notify_all()
+
+    def _receive(self):
+        """Read the available TLS records, raise if the proxy closed the
+        connection."""
+        closed = False
+        while True:
+            # Hand over the received TLS records in batches
+            chunks = []
+            size = 0
+            while size < _RECV_BATCH:
+                try:
+                    data = self.sock.recv(65536)
+                except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                    break
+                if not data:
+                    closed = True
+                    break
+                chunks.append(data)
+                size += len(data)
+            if chunks:
+                with self.cond:
+                    self._handle_events(self._h2.receive_data(
+                            chunks[0] if len(chunks) == 1
+                            else b"".join(chunks)))
+                    self._collect()
+            if closed:
+                raise socket.error("HTTP/2 connection closed by proxy")
+            if size < _RECV_BATCH:
+                return
+
+    def _send(self):
+        with self.cond:
+            # Not less than the last failed write, which must be retried
+            data = bytes(self._outgoing[:65536])
+        try:
+            sent = self.sock.send(data)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        with self.cond:
+            del self._outgoing[:sent]
+            if len(self._outgoing) < _MAX_OUTGOING:
+                self.cond.notify_all()
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
+        selector.register(self.sock, selectors.EVENT_READ)
+        registered = selectors.EVENT_READ
+        error = None
+        try:
+            while True:
+                timeout = None
+                with self.cond:
+                    if not self.streams:
+                        timeout = self._idle_since + IDLE_TIMEOUT - mtime()
+                        if timeout <= 0:
+                            # Idle, no stream is going to be lost
+                            self.goaway = True
+                            self._h2.close_connection()
+                            self._collect()
+                            break
+                    events = selectors.EVENT_READ
+                    if self._outgoing:
+                        events |= selectors.EVENT_WRITE
+                if events != registered:
+                    selector.modify(self.sock, events)
+                    registered = events
+                for key, mask in selector.select(timeout):
+                    if key.fileobj is self._wakeup_r:
+                        self._drain_wakeup()
+                        continue
+                    if mask & selectors.EVENT_WRITE:
+                        self._send()
+                    if mask & selectors.EVENT_READ:
+                        self._receive()
+            try:
+                self.sock.send(bytes(self._outgoing))
+            except (socket.error, ValueError):
+                pass
+        except Exception as e:
+            error = e
+        finally:
+            self._close(error)
+            selector.close()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_r.recv(1024):
+                pass
+        except socket.error:
+            pass
+
+    def _close(self, error):
+        if error is None:
+            error = socket.error("HTTP/2 connection to proxy closed")
+        elif not isinstance(error, socket.error):
+            error = socket.error("HTTP/2 connection to proxy failed: %r"
+                                 % error)
+        with self.cond:
+            self.error = error
+            self.goaway = True
+            self.cond.notify_all()
+        self.sock.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def __repr__(self):
+        return "<%s %s streams=%d>" % (self.__class__.__name__, self.key,
+                                       len(self.streams))
+
+
+class _ConnectionPool(object):
+    """The HTTP/2 connections to a proxy."""
+
+    def __init__(self):
+        self.conns = []
+        self.connecting = 0
+        self.cond = threading.Condition()
+
+    def get(self, max_connections):
+        """Return the least busy connection, or None if the caller should
+        make a new one, then it must call `connected`."""
+        with self.cond:
+            while True:
+                self.conns = [conn for conn in self.conns
+                              if conn.is_usable()]
+                conn = min(self.conns, key=len) if self.conns else None
+                if conn is not None and conn.has_free_stream():
+                    return conn
+                if len(self.conns) + self.connecting < max_connections:
+                    self.connecting += 1
+                    return
+                if conn is not None:
+                    # Wait for a free stream of it
+                    return conn
+                self.cond.wait()
+
+    def connected(self, conn):
+        with self.cond:
+            self.connecting -= 1
+            if conn is not None:
+                self.conns.append(conn)
+            self.cond.notify_all()
+
+
+def open_h2_tunnel(proxy, dest_pair, headers, timeout, connect,
+                   max_connections=MAX_CONNECTIONS):
+    """Open a tunnel to destination as a stream of the HTTP/2 connections to
+    proxy, return a `H2Stream`. If the proxy does not select "h2" by ALPN
+    on a new connection, return the socket connected to proxy by connect(),
+    which is used as HTTP/1.1.
+    """
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    key = proxy.normal_netloc
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, _ConnectionPool())
+    while True:
+        conn = pool.get(max_connections)
+        if conn is None:
+            sock = None
+            try:
+                sock = connect()
+                if sock.selected_alpn_protocol() != "h2":
+                    return sock
+                conn = H2ProxyConnection(sock, proxy.key)
+            except:
+                if sock is not None:
+                    sock.close()
+                raise
+            finally:
+                pool.connected(conn)
+        try:
+            stream = conn.open_stream(dest_pair, headers, timeout)
+        except _ConnectionGone:
+            continue
+        mark_tunnel(stream, proxy.key)
+        return stream
+
+def _after_fork():
+    global _pools_lock
+    # The connections are served by the I/O threads of the parent
+    _pools_lock = threading.Lock()
+    _pools.clear()
+
+register_child_hook(_after_fork)
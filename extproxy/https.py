@@ -2,18 +2,43 @@
 
 import socket
 import ssl
+import threading
+import time
 
+from . import happy_eyeballs, metrics
+from .capabilities import proxy_capabilities
 from .compat import urlparse
+from .fork import register_child_hook
+from .limits import limited_connect, release_lease
+from .pool import get_warm_pool, _warm_pool_connectors
+from .proxy_info import ProxyInfo, get_proxy_info, iter_proxy_infos
+from .transport import DEFAULT_PROFILE
+from .tunnel import connect_request, parse_connect_response
+from .util import AF_UNIX, create_unix_connection
 
 
 _https_proxy_contexts = {}
+_https_proxy_ssl_contexts = {}
+_https_proxy_h2_contexts = {}
+_https_proxy_sessions = {}
+_https_proxy_session_stats = {}
+_https_proxy_settings = {}
+_https_proxy_lock = threading.Lock()
 
-def set_https_proxy(proxy, check_hostname=None, cafile=None, context=None):
+_session_support = hasattr(ssl, "SSLSession")
+# Used to create `_ProxySSLSocket` without setting `sslsocket_class` of the
+# contexts, which may be given by the caller, Python 3.7 and above
+_proxy_socket_support = _session_support and hasattr(ssl.SSLSocket, "_create")
+
+def set_https_proxy(proxy, check_hostname=None, cafile=None, context=None,
+                    fast_open=False, optimistic=False, profile=None,
+                    http2=False):
     """Used to set HTTPS proxy's SSL context.
 
     proxy
         A HTTPS proxy of string, eg: https://id:pw@127.0.0.1:8443
-        The scheme name will be ignored.
+        The scheme name will be ignored, except a "+unix" suffix, eg:
+            https+unix:///run/proxy.sock
     
     optional:
 
@@ -25,14 +50,99 @@ def set_https_proxy(proxy, check_hostname=None, cafile=None, context=None):
         A `ssl.SSLContext` object, see the docs for more informations:
             https://docs.python.org/2/library/ssl.html#ssl-contexts
             https://docs.python.org/3/library/ssl.html#ssl-contexts
+    fast_open
+        Whether to connect with TCP Fast Open, then the TLS ClientHello is
+        sent with SYN once the proxy has given a TFO cookie, only on Linux.
+    optimistic
+        Whether to send the CONNECT request and the data through the
+        tunnel, eg: the ClientHello to destination, without waiting for the
+        response. The response is read before the data from destination,
+        a refused CONNECT raises the same error. Only for the servers which
+        are known to support that, requires Python 3.7 and above.
+    profile
+        A `TransportProfile` object, the socket options of connections to
+        the proxy and the settings of forwarded tunnels through it.
+    http2
+        Whether to open tunnels as CONNECT streams, multiplexed over a few
+        shared HTTP/2 connections to the proxy, if it selects "h2" by ALPN,
+        else the tunnels fall back to HTTP/1.1. An integer is the max count
+        of the connections, True means 4. A stream refused by the proxy is
+        retried as a CONNECT request over HTTP/1.1, unless `optimistic`.
+        Plain HTTP requests still use HTTP/1.1 connections. The HTTP/2
+        connections use a copy of a given `context`, without its client
+        certificate, the given one is not changed. Requires Python 3 and
+        package h2.
     """
+    if http2:
+        from .http2 import h2_available
+        if not h2_available():
+            raise RuntimeError("HTTP/2 tunnels require the package h2, and "
+                               "ssl with ALPN and MemoryBIO")
 
-    if not isinstance(proxy, tuple):
+    if not isinstance(proxy, (tuple, ProxyInfo)):
         proxy = urlparse(proxy)
+    if proxy.scheme.endswith("+unix"):
+        proxy = get_proxy_info(proxy)
     netloc = _get_normal_netloc(proxy)
-    _https_proxy_contexts[netloc] = check_hostname, cafile, context
+    address = netloc.rpartition("@")[-1]
+    with _https_proxy_lock:
+        _https_proxy_contexts[netloc] = check_hostname, cafile, context
+        _https_proxy_settings[netloc] = (fast_open, optimistic, profile,
+                                         http2)
+        # Rebuild SSL contexts and drop sessions of this proxy on next use
+        for cache in (_https_proxy_ssl_contexts, _https_proxy_h2_contexts,
+                      _https_proxy_sessions):
+            for key in list(cache):
+                if key.rpartition("@")[-1] == address:
+                    cache.pop(key, None)
+        for info in iter_proxy_infos():
+            if info.key == address:
+                info.context = None
+
+def set_ktls(enabled=True):
+    """Used to enable kernel TLS offload of HTTPS proxy connections, it is
+    enabled by default if supported: Linux with module tls, Python 3.12 and
+    above, OpenSSL built with kTLS. The forwarder moves the data of offloaded
+    connections with `os.splice`. Contexts given to `set_https_proxy` are
+    not changed, set `ssl.OP_ENABLE_KTLS` of them instead. Return whether
+    kTLS is supported.
+    """
+    from . import ktls
+    with _https_proxy_lock:
+        ktls.enabled = enabled and ktls.supported
+        # Rebuild SSL contexts on next use
+        _https_proxy_ssl_contexts.clear()
+        _https_proxy_h2_contexts.clear()
+        for info in iter_proxy_infos():
+            info.context = None
+    return ktls.supported
+
+def https_proxy_session_stats():
+    """Return the counts of HTTPS proxy TLS session resumption, eg:
+    {"127.0.0.1:8443": {"hits": 9, "misses": 1}}
+    """
+    with _https_proxy_lock:
+        return dict((netloc, {"hits": hits, "misses": misses})
+                    for netloc, (hits, misses)
+                    in _https_proxy_session_stats.items())
+
+def build_https_contexts():
+    """Build the SSL contexts of the set HTTPS proxies now, instead of on
+    their first connections."""
+    with _https_proxy_lock:
+        settings = dict((netloc, _https_proxy_settings.get(netloc))
+                        for netloc in _https_proxy_contexts)
+    for netloc, netloc_settings in settings.items():
+        _get_https_context(netloc, None)
+        if netloc_settings and netloc_settings[3]:
+            _get_h2_context(netloc, None)
+    for info in iter_proxy_infos():
+        if info.type == "https":
+            _get_proxy_context(info)
 
 def _get_normal_netloc(proxy):
+    if getattr(proxy, "unix_path", None):
+        return proxy.normal_netloc
     if proxy.port is None:
         return proxy.netloc + ":443"
     else:
@@ -44,6 +154,9 @@ def _create_https_context(check_hostname, cafile, context):
         # Enable PHA for TLS 1.3 connections if available
         if getattr(context, "post_handshake_auth", None) is not None:
             context.post_handshake_auth = True
+        # A given context is used as it is
+        from . import ktls
+        ktls.set_context_option(context)
     if cafile is not None:
         context.load_verify_locations(cafile)
     will_verify = context.verify_mode != ssl.CERT_NONE
@@ -56,20 +169,303 @@ def _create_https_context(check_hostname, cafile, context):
         context.check_hostname = check_hostname
     return context
 
+def _get_https_settings(proxy):
+    """Return (fast_open, optimistic, profile, http2) of a proxy."""
+    settings = _https_proxy_settings.get(proxy.normal_netloc)
+    if settings is None:
+        settings = _https_proxy_settings.get(
+                proxy.key, (False, False, DEFAULT_PROFILE, False))
+    return settings
+
+def _get_context_parms(netloc, proxy):
+    context_parms = _https_proxy_contexts.get(netloc)
+    if context_parms is None:
+        context_parms = _https_proxy_contexts.get(netloc.rpartition("@")[-1])
+    if context_parms is None:
+        set_https_proxy(proxy)
+        context_parms = _https_proxy_contexts[netloc]
+    return context_parms
+
+def _get_https_context(netloc, proxy):
+    context = _https_proxy_ssl_contexts.get(netloc)
+    if context is None:
+        context = _create_https_context(*_get_context_parms(netloc, proxy))
+        _https_proxy_ssl_contexts[netloc] = context
+    return context
+
+def _copy_context(context):
+    """Copy the verification settings of a SSL context to a new one, the
+    certificate chain can not be read back, so it is not copied."""
+    new_context = ssl.SSLContext(context.protocol)
+    new_context.options = context.options
+    new_context.verify_flags = context.verify_flags
+    if hasattr(context, "minimum_version"):
+        new_context.minimum_version = context.minimum_version
+        new_context.maximum_version = context.maximum_version
+    if getattr(context, "post_handshake_auth", None) is not None:
+        new_context.post_handshake_auth = context.post_handshake_auth
+    cadata = context.get_ca_certs(binary_form=True)
+    if cadata:
+        new_context.load_verify_locations(cadata=b"".join(cadata))
+    elif context.verify_mode != ssl.CERT_NONE:
+        new_context.load_default_certs()
+    new_context.check_hostname = False
+    new_context.verify_mode = context.verify_mode
+    new_context.check_hostname = context.check_hostname
+    return new_context
+
+def _get_h2_context(netloc, proxy):
+    context = _https_proxy_h2_contexts.get(netloc)
+    if context is None:
+        check_hostname, cafile, context = _get_context_parms(netloc, proxy)
+        if context is not None:
+            # Do not offer "h2" by the given context, which is used by the
+            # HTTP/1.1 connections and maybe the caller
+            context = _copy_context(context)
+        context = _create_https_context(check_hostname, cafile, context)
+        context.set_alpn_protocols(["h2", "http/1.1"])
+        _https_proxy_h2_contexts[netloc] = context
+    return context
+
+def _get_proxy_context(proxy):
+    context = proxy.context
+    if context is None:
+        context = proxy.context = _get_https_context(proxy.normal_netloc, proxy)
+    return context
+
+def _get_session(netloc, context):
+    context_session = _https_proxy_sessions.get(netloc)
+    if context_session is None:
+        return
+    session_context, session = context_session
+    if session_context is not context or (
+            session.time + session.timeout < time.time()):
+        _https_proxy_sessions.pop(netloc, None)
+        return
+    return session
+
+def _store_session(netloc, sock):
+    try:
+        session = sock.session
+        if session is None or (sock.version() == "TLSv1.3" and
+                               not session.has_ticket):
+            return
+    except (AttributeError, ValueError):
+        return
+    _https_proxy_sessions[netloc] = sock.context, session
+    if session.has_ticket:
+        proxy_capabilities.set(netloc.rpartition("@")[-1], "session_ticket",
+                               True)
+
+def _count_session(netloc, reused):
+    with _https_proxy_lock:
+        stats = _https_proxy_session_stats.setdefault(netloc, [0, 0])
+        stats[not reused] += 1
+
+def _wrap_proxy_socket(context, sock, **kwargs):
+    if _proxy_socket_support:
+        return _ProxySSLSocket._create(sock=sock, context=context, **kwargs)
+    return context.wrap_socket(sock, **kwargs)
+
+if _session_support:
+    class _ProxySSLSocket(ssl.SSLSocket):
+        """Store TLSv1.3 sessions, which tickets arrive after handshake,
+        when proxy connections are closed."""
+        _extproxy_netloc = None
+        _extproxy_releases_lease = True
+        # The received response of a optimistic CONNECT request, None if
+        # it has been read
+        _extproxy_response = None
+        # The data after the response
+        _extproxy_buffer = b""
+
+        def _real_close(self):
+            if self._extproxy_netloc is not None and self._sslobj:
+                _store_session(self._extproxy_netloc, self)
+            release_lease(self)
+            ssl.SSLSocket._real_close(self)
+
+        def _read_connect_response(self):
+            while self._extproxy_response is not None:
+                data = ssl.SSLSocket.recv(self, 8192)
+                if not data:
+                    raise socket.error("Tunnel connection failed: "
+                                       "connection closed")
+                self._extproxy_response += data
+                extra = parse_connect_response(self._extproxy_response)
+                if extra is not None:
+                    self._extproxy_response = None
+                    self._extproxy_buffer = extra
+
+        def recv(self, buflen=1024, flags=0):
+            if self._extproxy_response is not None:
+                self._read_connect_response()
+            if self._extproxy_buffer and not flags:
+                data = self._extproxy_buffer[:buflen]
+                self._extproxy_buffer = self._extproxy_buffer[buflen:]
+                return data
+            return ssl.SSLSocket.recv(self, buflen, flags)
+
+        def recv_into(self, buffer, nbytes=None, flags=0):
+            if self._extproxy_response is not None:
+                self._read_connect_response()
+            if self._extproxy_buffer and not flags:
+                if not nbytes:
+                    nbytes = len(buffer)
+                data = self._extproxy_buffer[:nbytes]
+                self._extproxy_buffer = self._extproxy_buffer[nbytes:]
+                buffer[:len(data)] = data
+                return len(data)
+            return ssl.SSLSocket.recv_into(self, buffer, nbytes, flags)
+
+        def pending(self):
+            return len(self._extproxy_buffer) + ssl.SSLSocket.pending(self)
+
+        def setsockopt(self, level, *args):
+            # Connections to Unix socket proxies have no TCP options, which
+            # are set by http.client
+            if level != socket.IPPROTO_TCP or self.family != AF_UNIX:
+                ssl.SSLSocket.setsockopt(self, level, *args)
+
+def connect_pending(sock):
+    """Whether the response of a optimistic CONNECT request over the
+    connection to HTTPS proxy has not been read."""
+    return getattr(sock, "_extproxy_response", None) is not None
+
+def _connect_https_proxy(proxy, timeout=None, source_address=None,
+                         dest_pair=None, context=None):
+    fast_open, _, profile, _ = _get_https_settings(proxy)
+    if proxy.unix_path:
+        # No TCP, the profile only sets forwarded tunnels
+        sock = create_unix_connection(proxy.unix_path, timeout, proxy.key)
+    else:
+        if dest_pair is None:
+            dest_pair = proxy.hostname, proxy.port or 443
+        sock = happy_eyeballs.create_connection(
+                dest_pair, timeout, source_address, proxy.key,
+                fast_open=fast_open, profile=profile or DEFAULT_PROFILE)
+
+    netloc = proxy.normal_netloc
+    if context is None:
+        context = _get_proxy_context(proxy)
+    kwargs = {"server_hostname": proxy.hostname}
+    if _session_support:
+        kwargs["session"] = _get_session(netloc, context)
+    try:
+        if metrics.enabled:
+            sock = metrics.timed("tls_handshake", proxy.key,
+                                 _wrap_proxy_socket, context, sock, **kwargs)
+        else:
+            sock = _wrap_proxy_socket(context, sock, **kwargs)
+    except:
+        sock.close()
+        raise
+    sock._extproxy_netloc = netloc
+    sock._extproxy_profile = profile
+    proxy_capabilities.set(proxy.key, "tls_version", sock.version())
+    if not _session_support:
+        return sock
+
+    _count_session(netloc, sock.session_reused)
+    _store_session(netloc, sock)
+    return sock
+
+_warm_pool_connectors["https"] = _connect_https_proxy
+
+def _create_https_connection(proxy, timeout=None, source_address=None,
+                             dest_pair=None):
+    return limited_connect(proxy.key, timeout, _get_https_connection, proxy,
+                           timeout, source_address, dest_pair)
+
+def _get_https_connection(proxy, timeout, source_address, dest_pair):
+    pool = get_warm_pool(proxy)
+    if pool is not None and source_address is None:
+        sock = pool.get(timeout)
+        if sock is not None:
+            return sock
+    return _connect_https_proxy(proxy, timeout, source_address, dest_pair)
+
+def _create_h2_connection(self, proxy, timeout, source_address, dest_pair,
+                          http2, optimistic):
+    if self._tunnel_host is None:
+        # Plain HTTP requests are sent to proxy over HTTP/1.1
+        return _create_https_connection(proxy, timeout, source_address,
+                                        dest_pair)
+    return limited_connect(proxy.key, timeout, _get_h2_tunnel, self, proxy,
+                           timeout, source_address, dest_pair, http2,
+                           optimistic)
+
+def _get_h2_tunnel(self, proxy, timeout, source_address, dest_pair, http2,
+                   optimistic):
+    from .http2 import (MAX_CONNECTIONS, H2Stream, StreamRefusedError,
+                        open_h2_tunnel)
+
+    def connect():
+        context = _get_h2_context(proxy.normal_netloc, proxy)
+        return _connect_https_proxy(proxy, timeout, source_address,
+                                    context=context)
+
+    max_connections = MAX_CONNECTIONS if http2 is True else http2
+    sock = open_h2_tunnel(proxy, (self._tunnel_host, self._tunnel_port),
+                          self._tunnel_headers, timeout, connect,
+                          max_connections)
+    if not isinstance(sock, H2Stream):
+        # Tunnel by CONNECT requests over HTTP/1.1, until it expires
+        proxy_capabilities.set(proxy.key, "http2", False)
+    elif not optimistic:
+        # Else the response is read by the first read, then a refused
+        # stream fails the request
+        try:
+            sock.wait_response()
+        except StreamRefusedError:
+            # Eg: the proxy has too many streams, tunnel by a CONNECT
+            # request over HTTP/1.1 this time
+            sock.close()
+            sock = _get_https_connection(proxy, timeout, source_address,
+                                         dest_pair)
+    return sock
+
 def _set_tunnel_https(self, proxy):
-    def create_connection(dest_pair, timeout=None, source_address=None,
-                          proxy=proxy):
-        sock = socket.create_connection(dest_pair, timeout, source_address)
-        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-
-        netloc = _get_normal_netloc(proxy)
-        context_parms = _https_proxy_contexts.get(netloc)
-        if context_parms is None:
-            context_parms = _https_proxy_contexts.get(netloc.rpartition("@")[-1])
-        if context_parms is None:
-            set_https_proxy(proxy)
-            context_parms = _https_proxy_contexts[netloc]
-        return _create_https_context(*context_parms).wrap_socket(
-                    sock, server_hostname=proxy.hostname)
+    _, optimistic, _, http2 = _get_https_settings(proxy)
+    if http2 and proxy_capabilities.get(proxy.key, "http2", True):
+        def create_connection(dest_pair, timeout=None, source_address=None,
+                              proxy=proxy):
+            return _create_h2_connection(self, proxy, timeout,
+                                         source_address, dest_pair, http2,
+                                         optimistic)
+    else:
+        def create_connection(dest_pair, timeout=None, source_address=None,
+                              proxy=proxy):
+            return _create_https_connection(proxy, timeout, source_address,
+                                            dest_pair)
 
     self._create_connection = create_connection
+    if optimistic and _session_support:
+        self._tunnel = lambda: _tunnel_optimistic(self)
+    if http2:
+        tunnel = self._tunnel
+        self._tunnel = lambda: _tunnel_h2(self, tunnel)
+
+def _tunnel_h2(self, tunnel):
+    from .http2 import H2Stream
+    if not isinstance(self.sock, H2Stream):
+        return tunnel()
+
+def _tunnel_optimistic(self):
+    """Like `HTTPConnection._tunnel`, but do not wait for the response,
+    which is read by the first read from the tunnel."""
+    sock = self.sock
+    if not isinstance(sock, _ProxySSLSocket):
+        # Python 3.6, without `SSLSocket._create()`
+        return self.__class__._tunnel(self)
+    sock.sendall(connect_request((self._tunnel_host, self._tunnel_port),
+                                 self._tunnel_headers))
+    sock._extproxy_response = b""
+
+def _after_fork():
+    global _https_proxy_lock
+    # Keep the SSL contexts and sessions, the stats are per process
+    _https_proxy_lock = threading.Lock()
+    _https_proxy_session_stats.clear()
+
+register_child_hook(_after_fork)
@@ -0,0 +1,320 @@
+"""urllib handlers which keep connections alive, through HTTP, HTTPS and SOCKS
+proxies, requires Python 3.
+
+`AbstractHTTPHandler.do_open` closes the connection after each response, for
+a tunneled connection that throws away the proxy connection, the tunnel and
+the TLS connection to destination. These handlers put the connection into a
+pool instead, when its response has been read, then the next request to the
+same destination through the same proxy reuses it.
+"""
+
+import socket
+import ssl
+import threading
+import weakref
+from collections import deque
+from http.client import HTTPResponse, BadStatusLine
+from urllib.error import URLError
+from urllib.request import HTTPHandler, HTTPSHandler
+
+from .compat import mtime
+from .fork import register_child_hook
+from .http2 import H2Stream
+from .pool import is_alive
+from .tls_in_tls import TLSInTLSSocket
+
+
+__all__ = ["ConnectionPool", "KeepAliveHTTPHandler", "KeepAliveHTTPSHandler"]
+
+# The methods which can be retried on a new connection, if the idle
+# connection has been closed by the server
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "TRACE", "PUT",
+                                "DELETE"])
+
+_STALE_ERRORS = (ConnectionError, BadStatusLine, ssl.SSLEOFError,
+                 ssl.SSLZeroReturnError)
+
+_pools = weakref.WeakSet()
+
+
+def is_connection_alive(conn):
+    """Whether a idle `HTTPConnection` can be reused."""
+    sock = conn.sock
+    if sock is None:
+        return False
+    try:
+        if getattr(sock, "pending", None) and sock.pending():
+            # Unexpected data of an idle connection
+            return False
+    except (socket.error, ValueError):
+        return False
+    if isinstance(sock, TLSInTLSSocket):
+        # Check the connection to proxy
+        sock = sock._sock
+    if isinstance(sock, H2Stream):
+        return sock.is_alive()
+    return is_alive(sock)
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of idle connections, per key.
+
+    maxsize
+        The max count of idle connections.
+    maxsize_per_key
+        The max count of idle connections of a key, eg: a destination
+        through a proxy.
+    max_idle
+        Close the connections which have been idle for this many seconds.
+    check
+        A function which returns whether a idle connection can be reused.
+    """
+
+    def __init__(self, maxsize=32, maxsize_per_key=4, max_idle=30,
+                 check=None):
+        self.maxsize = maxsize
+        self.maxsize_per_key = maxsize_per_key
+        self.max_idle = max_idle
+        self.check = check or is_connection_alive
+        self._idle = {}
+        self._count = 0
+        self._hits = self._misses = 0
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def __len__(self):
+        return self._count
+
+    def _expire(self, idle, now, closing):
+        while idle and now - idle[0][0] >= self.max_idle:
+            closing.append(idle.popleft()[1])
+            self._count -= 1
+
+    def get(self, key):
+        """Return a idle connection of key, or None if none is available."""
+        closing = []
+        try:
+            while True:
+                with self._lock:
+                    idle = self._idle.get(key)
+                    if idle:
+                        self._expire(idle, mtime(), closing)
+                    if not idle:
+                        self._idle.pop(key, None)
+                        self._misses += 1
+                        return
+                    # The most recently used connection is the most likely
+                    # to be alive
+                    _, conn = idle.pop()
+                    self._count -= 1
+                    if not idle:
+                        del self._idle[key]
+                if self.check(conn):
+                    with self._lock:
+                        self._hits += 1
+                    return conn
+                closing.append(conn)
+        finally:
+            for conn in closing:
+                conn.close()
+
+    def put(self, key, conn):
+        closing = []
+        now = mtime()
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle is None:
+                idle = self._idle[key] = deque()
+            self._expire(idle, now, closing)
+            idle.append((now, conn))
+            self._count += 1
+            if len(idle) > self.maxsize_per_key:
+                closing.append(idle.popleft()[1])
+                self._count -= 1
+            while self._count > self.maxsize:
+                # Evict the oldest idle connection
+                oldest = min(self._idle, key=lambda k: self._idle[k][0][0])
+                idle = self._idle[oldest]
+                closing.append(idle.popleft()[1])
+                self._count -= 1
+                if not idle:
+                    del self._idle[oldest]
+        for conn in closing:
+            conn.close()
+
+    def stats(self):
+        """Return the counts of idle connections and reuses, eg:
+        {"idle": 2, "hits": 9, "misses": 1}
+        """
+        with self._lock:
+            return {"idle": self._count, "hits": self._hits,
+                    "misses": self._misses}
+
+    def _after_fork(self):
+        # Drop the connections of the parent, closing them may write to
+        # connections which are used by the parent
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._count = 0
+        self._hits = self._misses = 0
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle = [conn for conns in self._idle.values()
+                         for _, conn in conns]
+            self._idle.clear()
+            self._count = 0
+        for conn in idle:
+            conn.close()
+
+
+class _KeepAliveResponse(HTTPResponse):
+    _extproxy_release = None
+
+    def _release(self, reuse):
+        release, self._extproxy_release = self._extproxy_release, None
+        if release is not None:
+            release(reuse)
+
+    def _close_conn(self):
+        HTTPResponse._close_conn(self)
+        self._release(not self.will_close)
+
+    def close(self):
+        if self.fp is not None and (self.chunked or self.length != 0):
+            # The body has not been read completely
+            self._release(False)
+        HTTPResponse.close(self)
+
+
+def _is_stale_error(e):
+    if isinstance(e, URLError):
+        e = e.reason
+    return isinstance(e, _STALE_ERRORS)
+
+
+class _KeepAliveMixin(object):
+
+    def _init_pool(self, pool):
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+
+    def _release_func(self, key, conn):
+        def release(reuse):
+            if reuse and conn.sock is not None:
+                self.pool.put(key, conn)
+            else:
+                conn.close()
+        return release
+
+    def _request(self, conn, req, headers):
+        try:
+            conn.request(req.get_method(), req.selector, req.data, headers,
+                         encode_chunked=req.has_header("Transfer-encoding"))
+        except OSError as err:  # timeout error
+            raise URLError(err)
+        return conn.getresponse()
+
+    def do_open(self, http_class, req, **http_conn_args):
+        """Like `AbstractHTTPHandler.do_open`, but get the connection from
+        pool, and put it back after the response has been read."""
+        host = req.host
+        if not host:
+            raise URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for k, v in req.headers.items()
+                       if k not in headers)
+        headers = dict((name.title(), val) for name, val in headers.items())
+        tunnel_headers = {}
+        proxy_auth_hdr = "Proxy-Authorization"
+        if req._tunnel_host and proxy_auth_hdr in headers:
+            # Proxy-Authorization should not be sent to origin server
+            tunnel_headers[proxy_auth_hdr] = headers.pop(proxy_auth_hdr)
+
+        # `_tunnel_host` includes the proxy descriptor which has been set by
+        # `Request.set_proxy`, and the destination
+        key = (http_class, host, req._tunnel_host,
+               tunnel_headers.get(proxy_auth_hdr),
+               tuple(sorted(http_conn_args.items())))
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if reused:
+                conn.timeout = timeout = req.timeout
+                if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    timeout = socket.getdefaulttimeout()
+                try:
+                    conn.sock.settimeout(timeout)
+                except (socket.error, ValueError):
+                    conn.close()
+                    continue
+            else:
+                conn = http_class(host, timeout=req.timeout, **http_conn_args)
+                conn.response_class = _KeepAliveResponse
+                if req._tunnel_host:
+                    conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                r = self._request(conn, req, headers)
+            except Exception as e:
+                conn.close()
+                if reused and _is_stale_error(e) and \
+                        req.get_method() in IDEMPOTENT_METHODS:
+                    # The server has closed the idle connection, retry
+                    continue
+                raise
+            break
+
+        if not r.will_close:
+            r._extproxy_release = self._release_func(key, conn)
+        r.url = req.get_full_url()
+        r.msg = r.reason
+        return r
+
+    def close(self):
+        """Close the idle connections."""
+        self.pool.clear()
+
+
+class KeepAliveHTTPHandler(_KeepAliveMixin, HTTPHandler):
+    """A `HTTPHandler` which keeps connections alive, eg:
+        build_opener(ProxyHandler({"http": "socks5://127.0.0.1:1080"}),
+                     KeepAliveHTTPHandler())
+
+    pool
+        A `ConnectionPool` object, can be shared with other handlers.
+    """
+
+    def __init__(self, debuglevel=None, pool=None):
+        args = () if debuglevel is None else (debuglevel,)
+        HTTPHandler.__init__(self, *args)
+        self._init_pool(pool)
+
+
+class KeepAliveHTTPSHandler(_KeepAliveMixin, HTTPSHandler):
+    """A `HTTPSHandler` which keeps connections alive, its idle connections
+    are keyed by the SSL context and the proxy.
+
+    pool
+        A `ConnectionPool` object, can be shared with other handlers.
+    """
+
+    def __init__(self, debuglevel=None, context=None, check_hostname=None,
+                 pool=None):
+        args = () if debuglevel is None else (debuglevel,)
+        kwargs = {"context": context}
+        if check_hostname is not None:
+            # Removed in py312
+            kwargs["check_hostname"] = check_hostname
+        HTTPSHandler.__init__(self, *args, **kwargs)
+        self._init_pool(pool)
+
+
+def _after_fork():
+    for pool in list(_pools):
+        pool._after_fork()
+
+register_child_hook(_after_fork)
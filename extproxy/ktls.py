@@ -0,0 +1,86 @@
+"""Kernel TLS (kTLS) offload of HTTPS proxy connections, and forwarding of
+offloaded connections with `os.splice`, the data is not copied to user space.
+
+kTLS requires Linux with module tls, Python 3.12 and above (which has
+`ssl.OP_ENABLE_KTLS`) and OpenSSL 3 built with kTLS. OpenSSL enables it in
+the handshake only if the kernel supports the negotiated cipher, otherwise the
+connection works as usual, so that offload is checked per connection.
+"""
+
+import errno
+import os
+import socket
+import ssl
+import sys
+
+
+OP_ENABLE_KTLS = getattr(ssl, "OP_ENABLE_KTLS", 0)
+
+# linux/tls.h
+SOL_TLS = 282
+TLS_TX = 1
+TLS_RX = 2
+
+supported = bool(OP_ENABLE_KTLS) and hasattr(os, "splice") and \
+            sys.platform.startswith("linux")
+enabled = supported
+
+_SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | \
+                getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+# splice() from a kTLS socket fails if a record is not application data, eg:
+# TLS 1.3 session ticket, alert, these records are read by OpenSSL instead
+RECORD_ERRNOS = set([errno.EINVAL, errno.EIO, errno.EBADMSG])
+# The sockets do not support splice()
+UNSUPPORTED_ERRNOS = set([errno.ENOSYS, errno.EOPNOTSUPP,
+                          getattr(errno, "ENOTSUP", errno.EOPNOTSUPP)])
+
+
+def set_context_option(context):
+    if not OP_ENABLE_KTLS:
+        return
+    if enabled:
+        context.options |= OP_ENABLE_KTLS
+    elif context.options & OP_ENABLE_KTLS:
+        context.options &= ~OP_ENABLE_KTLS
+
+def _has_crypto_info(sock, optname):
+    try:
+        sock.getsockopt(SOL_TLS, optname, 256)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+def offloaded(sock):
+    """Return whether sending and receiving of a SSLSocket are offloaded to
+    kernel, as (tx, rx)."""
+    if not enabled or not isinstance(sock, ssl.SSLSocket):
+        return False, False
+    return _has_crypto_info(sock, TLS_TX), _has_crypto_info(sock, TLS_RX)
+
+
+class SplicePipe(object):
+    """A pipe which moves data from a socket to another in kernel, `pending`
+    is the count of bytes in pipe."""
+
+    __slots__ = ("r", "w", "pending")
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.pending = 0
+
+    def splice_from(self, sock, size):
+        """Return the count of bytes moved into pipe, 0 at EOF."""
+        ndata = os.splice(sock.fileno(), self.w, size, flags=_SPLICE_FLAGS)
+        self.pending += ndata
+        return ndata
+
+    def splice_to(self, sock):
+        sent = os.splice(self.r, sock.fileno(), self.pending,
+                         flags=_SPLICE_FLAGS)
+        self.pending -= sent
+        return sent
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
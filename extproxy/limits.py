@@ -0,0 +1,297 @@
+"""Limit the bandwidth and the concurrent tunnels of proxies, so that bulk
+transfers do not starve latency critical requests through the same proxy.
+
+Rates are enforced by the forwarders of TLS-over-HTTPS-proxy connections,
+the counts of tunnels by the connect paths of all proxy types. A tunnel
+holds its slot until its socket has been closed or collected.
+"""
+
+import socket
+import threading
+import weakref
+
+from .compat import mtime
+from .fork import register_child_hook
+from .proxy_info import get_proxy_info
+
+
+__all__ = ["set_proxy_limits", "proxy_limits_stats"]
+
+_proxy_limits = {}
+_proxy_limits_lock = threading.Lock()
+_leases = weakref.WeakKeyDictionary()
+_leased_classes = {}
+
+
+class TunnelLimitError(socket.error):
+    """No tunnel slot of the proxy is available."""
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket, tokens are bytes.
+
+    rate
+        The tokens added per second.
+    burst
+        The max count of tokens, default one second of rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._time = mtime()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """Take n tokens, return the seconds to wait before going on. The
+        tokens may go negative, the debt is paid by later refills."""
+        with self._lock:
+            now = mtime()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._time) * self.rate)
+            self._time = now
+            self._tokens -= n
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / float(self.rate)
+
+
+class ProxyLimits(object):
+    """The limits of a proxy, and the counts of its tunnels."""
+
+    def __init__(self, key):
+        self.key = key
+        self.rate = self.tunnel_rate = self.burst = None
+        self.max_tunnels = self.max_waiting = self.wait_timeout = None
+        self.bucket = None
+        self.active = self.waiting = self.rejected = 0
+        self.cond = threading.Condition()
+
+    def update(self, rate, tunnel_rate, burst, max_tunnels, max_waiting,
+               wait_timeout):
+        with self.cond:
+            self.rate = rate
+            self.tunnel_rate = tunnel_rate
+            self.burst = burst
+            self.bucket = TokenBucket(rate, burst) if rate else None
+            self.max_tunnels = max_tunnels
+            self.max_waiting = max_waiting
+            self.wait_timeout = wait_timeout
+            # The cap may have been raised
+            self.cond.notify_all()
+
+    def copy(self):
+        """Return new limits with the same settings, and no tunnels."""
+        limits = ProxyLimits(self.key)
+        limits.update(self.rate, self.tunnel_rate, self.burst,
+                      self.max_tunnels, self.max_waiting, self.wait_timeout)
+        return limits
+
+    def _reject(self, reason):
+        self.rejected += 1
+        raise TunnelLimitError("Tunnel limit of proxy %s: %s"
+                               % (self.key, reason))
+
+    def acquire(self, timeout=None):
+        """Wait for a tunnel slot, return a `Lease` of it."""
+        with self.cond:
+            if self.max_tunnels is not None and \
+                    self.active >= self.max_tunnels:
+                if self.max_waiting is not None and \
+                        self.waiting >= self.max_waiting:
+                    self._reject("too many waiting connections")
+                if self.wait_timeout is not None:
+                    timeout = self.wait_timeout
+                elif timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                    timeout = socket.getdefaulttimeout()
+                deadline = None if timeout is None else mtime() + timeout
+                self.waiting += 1
+                try:
+                    while self.max_tunnels is not None and \
+                            self.active >= self.max_tunnels:
+                        if deadline is None:
+                            self.cond.wait()
+                            continue
+                        remaining = deadline - mtime()
+                        if remaining <= 0:
+                            self._reject("timed out waiting for a slot")
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+        return Lease(self)
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {"active": self.active, "waiting": self.waiting,
+                    "rejected": self.rejected}
+
+
+class Lease(object):
+    """A tunnel slot, released once, explicitly or when it is collected."""
+
+    __slots__ = ("limits",)
+
+    def __init__(self, limits):
+        self.limits = limits
+
+    def release(self):
+        limits, self.limits = self.limits, None
+        if limits is not None:
+            limits.release()
+
+    __del__ = release
+
+
+class Throttle(object):
+    """The rate limits of a forwarded tunnel, shared with the other tunnels
+    through the proxy, and of its own."""
+
+    __slots__ = ("limits", "bucket")
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.bucket = None
+
+    def consume(self, n):
+        """Count n forwarded bytes, return the seconds to pause the
+        tunnel."""
+        limits = self.limits
+        delay = 0
+        bucket = limits.bucket
+        if bucket is not None:
+            delay = bucket.consume(n)
+        rate = limits.tunnel_rate
+        if rate:
+            bucket = self.bucket
+            if bucket is None or bucket.rate != rate:
+                # The limits have been adjusted
+                bucket = self.bucket = TokenBucket(rate, limits.burst)
+            delay = max(delay, bucket.consume(n))
+        return delay
+
+
+def set_proxy_limits(proxy, rate=None, tunnel_rate=None, burst=None,
+                     max_tunnels=None, max_waiting=None, wait_timeout=None):
+    """Used to limit the bandwidth and the concurrent tunnels of a proxy.
+    It can be called again to adjust the limits at runtime, the new limits
+    apply to the active tunnels too, call it with no limit to remove them.
+    The limits apply to the tunnels which are opened after the first call.
+    The counts of tunnels are per process, a child of fork starts with none.
+
+    proxy
+        A proxy of string, eg: https://127.0.0.1:8443
+
+    optional:
+
+    rate
+        The max bytes per second of all forwarded tunnels through the
+        proxy, both directions.
+    tunnel_rate
+        The max bytes per second of each forwarded tunnel.
+    burst
+        The bytes which can be forwarded at once, default one second of
+        the rate.
+    max_tunnels
+        The max count of concurrent tunnels through the proxy, new
+        connections wait for a free slot.
+    max_waiting
+        The max count of connections waiting for a slot, the others fail
+        at once with `TunnelLimitError`.
+    wait_timeout
+        The max seconds to wait for a slot, default the connect timeout.
+    """
+    key = get_proxy_info(proxy).key
+    with _proxy_limits_lock:
+        limits = _proxy_limits.get(key)
+        if limits is None:
+            limits = _proxy_limits[key] = ProxyLimits(key)
+    limits.update(rate, tunnel_rate, burst, max_tunnels, max_waiting,
+                  wait_timeout)
+
+def proxy_limits_stats():
+    """Return the counts of tunnels per limited proxy, eg:
+    {"127.0.0.1:8443": {"active": 8, "waiting": 2, "rejected": 0}}
+    """
+    with _proxy_limits_lock:
+        limits = list(_proxy_limits.values())
+    return dict((item.key, item.stats()) for item in limits)
+
+def limited_connect(key, timeout, connect, *args):
+    """Return connect(*args) in a tunnel slot of the proxy, the slot is held
+    by the returned socket."""
+    limits = _proxy_limits.get(key)
+    if limits is None:
+        return connect(*args)
+    lease = limits.acquire(timeout)
+    try:
+        sock = connect(*args)
+    except:
+        lease.release()
+        raise
+    _hold_lease(sock, lease)
+    return sock
+
+def move_lease(sock, new_sock):
+    """Move the tunnel slot to the socket which wraps and detaches sock."""
+    if _leases:
+        lease = _leases.pop(sock, None)
+        if lease is not None:
+            _hold_lease(new_sock, lease)
+
+def _hold_lease(sock, lease):
+    _leases[sock] = lease
+    cls = sock.__class__
+    if not getattr(cls, "_extproxy_releases_lease", False):
+        # Release the slot when the socket is closed, not collected
+        sock.__class__ = _leased_class(cls)
+
+def _leased_class(cls):
+    """Return the subclass of a socket class, which releases the tunnel slot
+    of its socket when it is closed."""
+    leased = _leased_classes.get(cls)
+    if leased is not None:
+        return leased
+    # The socket is closed by _real_close after its files, py2 by close
+    name = "_real_close" if hasattr(cls, "_real_close") else "close"
+    close = getattr(cls, name)
+
+    def release_and_close(self, *args):
+        release_lease(self)
+        close(self, *args)
+
+    namespace = {"__slots__": (), "__module__": cls.__module__,
+                 "_extproxy_releases_lease": True, name: release_and_close}
+    leased = type(cls.__name__, (cls,), namespace)
+    return _leased_classes.setdefault(cls, leased)
+
+def release_lease(sock):
+    if _leases:
+        lease = _leases.pop(sock, None)
+        if lease is not None:
+            lease.release()
+
+def new_throttle(key):
+    """Return a `Throttle` of a new tunnel through the proxy, or None if the
+    proxy is not limited."""
+    limits = _proxy_limits.get(key) if key else None
+    if limits is not None:
+        return Throttle(limits)
+
+def _after_fork():
+    global _proxy_limits_lock, _leases
+    # The tunnels of the parent must not release the slots of the child
+    for lease in list(_leases.values()):
+        lease.limits = None
+    _leases = weakref.WeakKeyDictionary()
+    _proxy_limits_lock = threading.Lock()
+    for key, limits in list(_proxy_limits.items()):
+        _proxy_limits[key] = limits.copy()
+
+register_child_hook(_after_fork)
@@ -0,0 +1,232 @@
+"""Metrics and tracing hooks of proxy connections.
+
+The instrumented code checks `enabled` before measuring anything, so that
+it costs almost nothing if no hooks are added.
+
+Hooks are called as hook(event, proxy, value), proxy is the host:port of
+the proxy, events:
+
+    connect          seconds of TCP connecting to proxy
+    tls_handshake    seconds of TLS handshake with HTTPS proxy
+    socks_negotiate  seconds of SOCKS negotiation
+    http_connect     seconds of CONNECT request via HTTP/HTTPS proxy
+    error            "stage:ExceptionName" of a failed stage
+    rdns_fallback    1, SOCKS4 server doesn't support remote resolving
+    tunnel_open      1, a forwarded tunnel has been opened
+    tunnel_close     1, a forwarded tunnel has been closed
+    bytes_sent       bytes forwarded to proxy, when a tunnel is closed
+    bytes_received   bytes forwarded from proxy, when a tunnel is closed
+"""
+
+import threading
+
+from .compat import mtime
+from .fork import register_child_hook
+
+
+__all__ = ["add_metrics_hook", "remove_metrics_hook", "enable_metrics",
+           "disable_metrics", "get_metrics"]
+
+LATENCY_EVENTS = ("connect", "tls_handshake", "socks_negotiate",
+                  "http_connect")
+
+# Upper bounds of histogram buckets, from 0.5ms to about 33s
+HISTOGRAM_BOUNDS = tuple(0.0005 * 2 ** i for i in range(17))
+
+enabled = False
+_hooks = ()
+_hooks_lock = threading.Lock()
+_aggregator = None
+
+
+def add_metrics_hook(hook):
+    """Add a function which is called as hook(event, proxy, value)."""
+    global enabled, _hooks
+    with _hooks_lock:
+        if hook not in _hooks:
+            _hooks += (hook,)
+        enabled = True
+
+def remove_metrics_hook(hook):
+    global enabled, _hooks
+    with _hooks_lock:
+        _hooks = tuple(h for h in _hooks if h is not hook)
+        enabled = bool(_hooks)
+
+def emit(event, proxy, value):
+    for hook in _hooks:
+        try:
+            hook(event, proxy, value)
+        except Exception:
+            pass
+
+def timed(event, proxy, func, *args, **kwargs):
+    """Call func, emit its duration as `event`, or its exception."""
+    start = mtime()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        emit("error", proxy, "%s:%s" % (event, e.__class__.__name__))
+        raise
+    emit(event, proxy, mtime() - start)
+    return result
+
+def proxy_key_of(sock):
+    """Return the proxy host:port of a socket connected to HTTPS proxy."""
+    netloc = getattr(sock, "_extproxy_netloc", None)
+    if netloc:
+        return netloc.rpartition("@")[-1]
+
+
+class Histogram(object):
+    """A fixed buckets histogram of latency."""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        i = 0
+        for bound in HISTOGRAM_BOUNDS:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket which contains percentile q."""
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(HISTOGRAM_BOUNDS):
+                    return min(HISTOGRAM_BOUNDS[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max
+        }
+
+
+class _ProxyMetrics(object):
+    __slots__ = ("latency", "errors", "bytes_sent", "bytes_received",
+                 "tunnels", "active_tunnels", "rdns_fallbacks")
+
+    def __init__(self):
+        self.latency = {}
+        self.errors = {}
+        self.bytes_sent = self.bytes_received = 0
+        self.tunnels = self.active_tunnels = self.rdns_fallbacks = 0
+
+
+class MetricsAggregator(object):
+    """A hook which aggregates the events per proxy."""
+
+    def __init__(self):
+        self._proxies = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event, proxy, value):
+        with self._lock:
+            metrics = self._proxies.get(proxy)
+            if metrics is None:
+                metrics = self._proxies[proxy] = _ProxyMetrics()
+            if event in LATENCY_EVENTS:
+                histogram = metrics.latency.get(event)
+                if histogram is None:
+                    histogram = metrics.latency[event] = Histogram()
+                histogram.add(value)
+            elif event == "error":
+                metrics.errors[value] = metrics.errors.get(value, 0) + 1
+            elif event == "bytes_sent":
+                metrics.bytes_sent += value
+            elif event == "bytes_received":
+                metrics.bytes_received += value
+            elif event == "tunnel_open":
+                metrics.tunnels += 1
+                metrics.active_tunnels += 1
+            elif event == "tunnel_close":
+                metrics.active_tunnels = max(metrics.active_tunnels - 1, 0)
+            elif event == "rdns_fallback":
+                metrics.rdns_fallbacks += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict((proxy, {
+                "latency": dict((event, histogram.summary())
+                                for event, histogram
+                                in metrics.latency.items()),
+                "errors": dict(metrics.errors),
+                "bytes_sent": metrics.bytes_sent,
+                "bytes_received": metrics.bytes_received,
+                "tunnels": metrics.tunnels,
+                "active_tunnels": metrics.active_tunnels,
+                "rdns_fallbacks": metrics.rdns_fallbacks
+            }) for proxy, metrics in self._proxies.items())
+
+    def reset(self):
+        with self._lock:
+            self._proxies.clear()
+
+    def _after_fork(self):
+        # The metrics are per process
+        self._lock = threading.Lock()
+        self._proxies.clear()
+
+
+def enable_metrics():
+    """Start aggregating the metrics of proxies, see `get_metrics`."""
+    global _aggregator
+    with _hooks_lock:
+        if _aggregator is None:
+            _aggregator = MetricsAggregator()
+    add_metrics_hook(_aggregator)
+
+def disable_metrics():
+    """Stop aggregating the metrics of proxies, and drop them."""
+    global _aggregator
+    with _hooks_lock:
+        aggregator, _aggregator = _aggregator, None
+    if aggregator is not None:
+        remove_metrics_hook(aggregator)
+
+def get_metrics():
+    """Return the aggregated metrics per proxy, eg:
+    {"127.0.0.1:1080": {
+        "latency": {"connect": {"count": 9, "mean": 0.001, "p50": 0.001,
+                                "p90": 0.002, "p99": 0.002, "max": 0.002},
+                    "socks_negotiate": {...}},
+        "errors": {"connect:ConnectionRefusedError": 1},
+        "bytes_sent": 0, "bytes_received": 0,
+        "tunnels": 0, "active_tunnels": 0, "rdns_fallbacks": 0}}
+    """
+    aggregator = _aggregator
+    if aggregator is None:
+        return {}
+    return aggregator.snapshot()
+
+def _after_fork():
+    global _hooks_lock
+    _hooks_lock = threading.Lock()
+    if _aggregator is not None:
+        _aggregator._after_fork()
+
+register_child_hook(_after_fork)
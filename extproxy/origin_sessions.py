@@ -0,0 +1,145 @@
+"""Resume TLS sessions to origin servers, for the TLS connections which are
+wrapped over tunnels through proxies.
+
+Sessions are cached per (proxy, server_hostname), stored when the handshake
+has been done and again when the connection is closed, because TLSv1.3
+session tickets arrive after handshake.
+"""
+
+import ssl
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from .fork import register_child_hook
+from .metrics import proxy_key_of
+
+
+__all__ = ["set_origin_session_cache", "origin_session_stats"]
+
+# SSLContext.sslsocket_class and SSLSocket._create() are py37
+_session_support = hasattr(ssl, "SSLSession") and \
+                   hasattr(ssl.SSLSocket, "_create")
+
+_tunnel_proxies = weakref.WeakKeyDictionary()
+
+
+class SessionCache(object):
+    """A bounded LRU of TLS sessions, which expire after their lifetime
+    hints (`SSLSession.timeout`)."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, context):
+        with self._lock:
+            context_session = self._sessions.get(key)
+            if context_session is None:
+                return
+            session_context, session = context_session
+            if session_context is not context or (
+                    session.time + session.timeout < time.time()):
+                del self._sessions[key]
+                return
+            self._sessions.pop(key)
+            self._sessions[key] = context_session
+            return session
+
+    def put(self, key, context, session):
+        with self._lock:
+            if self.maxsize <= 0:
+                return
+            self._sessions.pop(key, None)
+            self._sessions[key] = context, session
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def count(self, key, reused):
+        proxy, server_hostname = key
+        with self._lock:
+            stats = self._stats.setdefault(proxy, {}).setdefault(
+                    server_hostname, [0, 0])
+            stats[not reused] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict((proxy, dict((server_hostname, {"hits": hits,
+                                                        "misses": misses})
+                                     for server_hostname, (hits, misses)
+                                     in servers.items()))
+                        for proxy, servers in self._stats.items())
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def _after_fork(self):
+        # Keep the sessions, the stats are per process
+        self._lock = threading.Lock()
+        self._stats = {}
+
+
+origin_sessions = SessionCache()
+register_child_hook(origin_sessions._after_fork)
+
+def set_origin_session_cache(maxsize=256):
+    """Used to set the cache of TLS sessions to origin servers, which are
+    connected through proxies.
+
+    optional:
+
+    maxsize
+        The max count of cached sessions, 0 to disable the cache.
+    """
+    origin_sessions.maxsize = maxsize
+    origin_sessions.clear()
+
+def origin_session_stats():
+    """Return the counts of origin TLS session resumption per proxy, eg:
+    {"127.0.0.1:1080": {"example.com": {"hits": 9, "misses": 1}}}
+    """
+    return origin_sessions.stats()
+
+def mark_tunnel(sock, proxy_key):
+    """Mark a socket as a tunnel through the proxy."""
+    _tunnel_proxies[sock] = proxy_key
+
+def get_session_key(sock, server_hostname):
+    """Return the key of cached sessions, if sock is a tunnel through a
+    proxy, else None."""
+    if not (_session_support and server_hostname and origin_sessions.maxsize):
+        return
+    proxy_key = proxy_key_of(sock) or _tunnel_proxies.get(sock)
+    if proxy_key:
+        return proxy_key, server_hostname
+
+def get_session(key, context):
+    return origin_sessions.get(key, context)
+
+def store_session(key, sock):
+    try:
+        session = sock.session
+        if session is None or (sock.version() == "TLSv1.3" and
+                               not session.has_ticket):
+            return
+    except (AttributeError, ValueError):
+        return
+    origin_sessions.put(key, sock.context, session)
+
+def handshaked(key, sock):
+    origin_sessions.count(key, sock.session_reused)
+    store_session(key, sock)
+
+
+if _session_support:
+    class OriginSSLSocket(ssl.SSLSocket):
+        _extproxy_session_key = None
+
+        def _real_close(self):
+            if self._extproxy_session_key is not None and self._sslobj:
+                store_session(self._extproxy_session_key, self)
+            ssl.SSLSocket._real_close(self)
@@ -0,0 +1,182 @@
+"""Keep warm connections to proxies, which are connected and handshaked in
+the background."""
+
+import socket
+import threading
+from collections import deque
+
+from .compat import mtime
+from .fork import register_child_hook
+from .proxy_info import get_proxy_info
+from .util import is_readable
+
+
+__all__ = ["set_warm_pool", "remove_warm_pool"]
+
+# Connect and handshake functions of proxy types, set by proxy modules,
+# connector(proxy, timeout) -> socket
+_warm_pool_connectors = {}
+_warm_pools = {}
+# The arguments of `WarmPool` by pool key, used to start the pools again in
+# the child of fork
+_warm_pool_settings = {}
+_warm_pools_lock = threading.Lock()
+
+def set_warm_pool(proxy, size=4, max_idle=30, check=None, timeout=10):
+    """Used to keep warm connections to a HTTPS or SOCKS proxy.
+
+    proxy
+        A HTTPS or SOCKS proxy of string, eg: socks5://127.0.0.1:1080
+
+    optional:
+
+    size
+        The count of connections to keep, 0 to remove the pool.
+    max_idle
+        Close connections which have been idle for this many seconds.
+    check
+        A function which checks the liveness of a connection on checkout,
+        check(sock) -> bool, default check whether the connection has been
+        closed by the proxy.
+    timeout
+        The timeout of background connecting.
+    """
+    proxy = get_proxy_info(proxy)
+    if proxy.scheme not in _warm_pool_connectors:
+        raise ValueError("unsupported proxy type of warm pool: %r"
+                         % proxy.scheme)
+    key = _get_pool_key(proxy)
+    with _warm_pools_lock:
+        pool = _warm_pools.pop(key, None)
+        _warm_pool_settings.pop(key, None)
+        if pool is not None:
+            pool.close()
+        if size > 0:
+            connector = _warm_pool_connectors[proxy.scheme]
+            settings = (lambda: connector(proxy, timeout), size, max_idle,
+                        check)
+            _warm_pool_settings[key] = settings
+            _warm_pools[key] = WarmPool(*settings)
+
+def remove_warm_pool(proxy):
+    """Close the warm connections to a proxy, and stop keeping them."""
+    set_warm_pool(proxy, size=0)
+
+def get_warm_pool(proxy):
+    if not _warm_pool_settings:
+        return
+    key = _get_pool_key(get_proxy_info(proxy))
+    pool = _warm_pools.get(key)
+    if pool is None and key in _warm_pool_settings:
+        # Dropped in the child of fork, start it again on first use
+        with _warm_pools_lock:
+            pool = _warm_pools.get(key)
+            settings = _warm_pool_settings.get(key)
+            if pool is None and settings is not None:
+                pool = _warm_pools[key] = WarmPool(*settings)
+    return pool
+
+def _get_pool_key(proxy):
+    return proxy.scheme + "://" + proxy.normal_netloc
+
+def is_alive(sock):
+    """Whether a idle connection has not been closed by the peer."""
+    try:
+        if not is_readable(sock):
+            return True
+        # Readable, peek the low layer, SSLSocket may have received TLSv1.3
+        # session tickets.
+        return bool(socket.socket.recv(sock, 1, socket.MSG_PEEK))
+    except Exception:
+        return False
+
+
+class WarmPool(object):
+    """A pool of idle connections, which keeps `size` connections in the
+    background via `connect`.
+    """
+
+    def __init__(self, connect, size, max_idle, check=None):
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.check = check or is_alive
+        self._idle = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        thread = threading.Thread(target=self._fill, name="extproxy-warm-pool")
+        thread.daemon = True
+        thread.start()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def get(self, timeout=None):
+        """Return a warm connection, or None if none is available."""
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        while True:
+            with self._cond:
+                if not self._idle:
+                    return
+                idle_time, sock = self._idle.popleft()
+                self._cond.notify()
+            if mtime() - idle_time < self.max_idle and self.check(sock):
+                sock.settimeout(timeout)
+                return sock
+            sock.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify()
+        for _, sock in idle:
+            sock.close()
+
+    def _expire(self):
+        expired = []
+        now = mtime()
+        with self._cond:
+            while self._idle and now - self._idle[0][0] >= self.max_idle:
+                expired.append(self._idle.popleft()[1])
+        for sock in expired:
+            sock.close()
+
+    def _fill(self):
+        retry_delay = 0
+        while True:
+            with self._cond:
+                if not self._closed and len(self._idle) >= self.size:
+                    self._cond.wait(min(self.max_idle / 2.0, 5))
+                if self._closed:
+                    return
+                missing = len(self._idle) < self.size
+            self._expire()
+            if not missing:
+                continue
+            try:
+                sock = self.connect()
+            except Exception:
+                # Proxy is unavailable, back off
+                retry_delay = min(retry_delay * 2 or 0.5, 30)
+                with self._cond:
+                    self._cond.wait(retry_delay)
+                continue
+            retry_delay = 0
+            with self._cond:
+                if self._closed:
+                    sock.close()
+                    return
+                self._idle.append((mtime(), sock))
+
+
+def _after_fork():
+    global _warm_pools_lock
+    # The fill threads of the parent do not exist in the child, the pools are
+    # started again by `get_warm_pool`, with the child's own connections
+    _warm_pools_lock = threading.Lock()
+    _warm_pools.clear()
+
+register_child_hook(_after_fork)
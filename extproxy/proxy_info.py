@@ -0,0 +1,167 @@
+"""Parse proxy URLs once into interned descriptors."""
+
+import base64
+import threading
+
+from .compat import urlparse, unquote, _parse_proxy
+from .fork import register_child_hook
+
+
+PROXY_TYPE_SOCKS4 = SOCKS4 = 1
+PROXY_TYPE_SOCKS5 = SOCKS5 = 2
+
+SOCKS_PROXY_TYPES = {
+    "socks4" : (SOCKS4, False),
+    "socks4a": (SOCKS4, True),
+    "socks"  : (SOCKS5, True),
+    "socks5" : (SOCKS5, True),
+    "socks5h": (SOCKS5, False)
+}
+
+DEFAULT_PORTS = {
+    "http"   : 80,
+    "https"  : 443,
+    "socks4" : 1080,
+    "socks4a": 1080,
+    "socks"  : 1080,
+    "socks5" : 1080,
+    "socks5h": 1080
+}
+
+_proxy_infos = {}
+_proxy_infos_lock = threading.Lock()
+_proxy_infos_maxsize = 1024
+
+
+class ProxyInfo(object):
+    """A parsed proxy URL, which has the attributes of `urlparse` results
+    used by extproxy, and the values precomputed for each request.
+
+    type
+        "https", "socks", or None for the types handled by urllib.
+    unix_path
+        The Unix domain socket path of "https+unix" and "socks5+unix" etc.
+        proxies, their scheme is without "+unix", and their hostname is
+        used to match the cert of HTTPS proxy, default "localhost".
+    normal_netloc
+        The netloc with the default port, or "unix:" with the socket path,
+        includes credentials.
+    key
+        The normal netloc without credentials.
+    hostport, http_url, proxy_auth
+        Used to set HTTP proxy for HTTP and HTTPS proxy, like `ProxyHandler`.
+    proxy_type, rdns
+        The values of `SOCKS_PROXY_TYPES`, for SOCKS proxy.
+    context
+        The resolved SSL context, for HTTPS proxy.
+    """
+
+    __slots__ = ("url", "scheme", "type", "netloc", "hostname", "port",
+                 "unix_path", "username", "password", "normal_netloc", "key",
+                 "hostport", "http_url", "proxy_auth", "proxy_type", "rdns",
+                 "context")
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.url = url
+        self.scheme = scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.hostname = parsed.hostname
+        self.unix_path = None
+        if scheme.endswith("+unix"):
+            self._parse_unix(parsed)
+            scheme = self.scheme
+        else:
+            try:
+                self.port = parsed.port
+            except ValueError:
+                if scheme == "https" or scheme in SOCKS_PROXY_TYPES:
+                    raise
+                self.port = None
+            if self.port is None and scheme in DEFAULT_PORTS:
+                self.normal_netloc = "%s:%d" % (self.netloc,
+                                                DEFAULT_PORTS[scheme])
+            else:
+                self.normal_netloc = self.netloc
+            self.key = self.normal_netloc.rpartition("@")[-1]
+        self.username = parsed.username
+        self.password = parsed.password
+        self.hostport = self.http_url = self.proxy_auth = None
+        self.proxy_type = self.rdns = None
+        self.context = None
+        if scheme in ("http", "https"):
+            self.type = "https" if scheme == "https" else None
+            if self.unix_path is None:
+                self.http_url = "http" + url[len(scheme):]
+            else:
+                self.http_url = "http://" + self.netloc
+            _, user, password, hostport = _parse_proxy(self.http_url)
+            self.hostport = unquote(hostport)
+            if user and password:
+                user_pass = "%s:%s" % (unquote(user), unquote(password))
+                creds = base64.b64encode(user_pass.encode()).decode("ascii")
+                self.proxy_auth = "Basic " + creds
+        elif scheme in SOCKS_PROXY_TYPES:
+            self.type = "socks"
+            self.proxy_type, self.rdns = SOCKS_PROXY_TYPES[scheme]
+        else:
+            self.type = None
+
+    def _parse_unix(self, parsed):
+        scheme = parsed.scheme[:-len("+unix")]
+        if scheme != "https" and scheme not in SOCKS_PROXY_TYPES:
+            raise ValueError("Unix socket is only supported by HTTPS and "
+                             "SOCKS proxies: %r" % self.url)
+        userinfo, _, host = parsed.netloc.rpartition("@")
+        path = unquote(parsed.path)
+        if not path:
+            # The path is percent-encoded as host, eg:
+            # socks5+unix://%2Frun%2Fegress.sock
+            path = unquote(host)
+            host = ""
+        if not path:
+            raise ValueError("No Unix socket path of proxy: %r" % self.url)
+        # The host is only used to match the cert of HTTPS proxy
+        self.hostname = host.lower() or "localhost"
+        self.netloc = "%s@%s" % (userinfo, self.hostname) if userinfo \
+                      else self.hostname
+        self.scheme = scheme
+        self.port = None
+        self.unix_path = path
+        self.key = "unix:" + path
+        self.normal_netloc = "%s@%s" % (userinfo, self.key) if userinfo \
+                             else self.key
+
+    def geturl(self):
+        return self.url
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.url)
+
+
+def get_proxy_info(proxy):
+    """Return the interned `ProxyInfo` of a proxy URL string, or of an
+    `urlparse` result."""
+    if isinstance(proxy, ProxyInfo):
+        return proxy
+    if isinstance(proxy, tuple):
+        proxy = proxy.geturl()
+    try:
+        return _proxy_infos[proxy]
+    except KeyError:
+        pass
+    info = ProxyInfo(proxy)
+    with _proxy_infos_lock:
+        if len(_proxy_infos) >= _proxy_infos_maxsize:
+            _proxy_infos.clear()
+        return _proxy_infos.setdefault(proxy, info)
+
+def iter_proxy_infos():
+    with _proxy_infos_lock:
+        return list(_proxy_infos.values())
+
+def _after_fork():
+    global _proxy_infos_lock
+    _proxy_infos_lock = threading.Lock()
+
+register_child_hook(_after_fork)
@@ -0,0 +1,203 @@
+"""A bounded DNS cache of `getaddrinfo` results, used by the connections to
+proxies and the locally resolved SOCKS destinations."""
+
+import socket
+import threading
+from collections import OrderedDict
+
+from .compat import mtime
+from .fork import register_child_hook
+from .util import is_ipv4
+
+
+__all__ = ["set_dns_cache", "clear_dns_cache"]
+
+
+class _Entry(object):
+    __slots__ = ("infos", "error", "expire", "refresh", "refreshing")
+
+    def __init__(self, infos, error, expire, refresh):
+        self.infos = infos
+        self.error = error
+        self.expire = expire
+        self.refresh = refresh
+        self.refreshing = False
+
+
+class _Lookup(object):
+    __slots__ = ("event", "infos", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.infos = self.error = None
+
+
+class Resolver(object):
+    """Cache `getaddrinfo` results per (host, family) in a bounded LRU.
+
+    ttl
+        Seconds to cache the results, 0 to disable caching.
+    negative_ttl
+        Seconds to cache the resolving failures.
+    refresh_ahead
+        The ratio of `ttl`, after that a hit refreshes the entry in the
+        background, so that hot names never expire.
+    maxsize
+        The max count of cached names.
+
+    Concurrent lookups of a name are merged, only one of them resolves.
+    """
+
+    def __init__(self, ttl=60, negative_ttl=5, refresh_ahead=0.75,
+                 maxsize=1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        # The lookups and refreshes of the parent's threads never finish
+        self._lookups = {}
+        for entry in self._cache.values():
+            entry.refreshing = False
+
+    def _resolve(self, key):
+        host, family = key
+        try:
+            return socket.getaddrinfo(host, 0, family, socket.SOCK_STREAM), \
+                   None
+        except socket.gaierror as e:
+            return None, e
+
+    def _store(self, key, infos, error):
+        now = mtime()
+        if error is None:
+            ttl = self.ttl
+        else:
+            ttl = self.negative_ttl
+        entry = _Entry(infos, error, now + ttl,
+                       now + ttl * self.refresh_ahead)
+        with self._lock:
+            if ttl > 0:
+                self._cache.pop(key, None)
+                self._cache[key] = entry
+                if len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+        self._release(key, infos, error)
+
+    def _release(self, key, infos, error):
+        with self._lock:
+            lookup = self._lookups.pop(key, None)
+        if lookup is not None:
+            lookup.infos, lookup.error = infos, error
+            lookup.event.set()
+
+    def _refresh(self, key):
+        infos, error = self._resolve(key)
+        if error is not None:
+            # Keep the stale entry until it expires
+            with self._lock:
+                entry = self._cache.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+            return
+        self._store(key, infos, error)
+
+    def _lookup(self, key):
+        now = mtime()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry.expire > now:
+                    self._cache.pop(key)
+                    self._cache[key] = entry
+                    if entry.error is None and entry.refresh <= now and \
+                            not entry.refreshing:
+                        entry.refreshing = True
+                        thread = threading.Thread(
+                                target=self._refresh, args=(key,),
+                                name="extproxy-dns-refresh")
+                        thread.daemon = True
+                        thread.start()
+                    return entry.infos, entry.error
+                del self._cache[key]
+            lookup = self._lookups.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = self._lookups[key] = _Lookup()
+        if owner:
+            try:
+                infos, error = self._resolve(key)
+            except BaseException as e:
+                # Not a resolving failure, do not cache it
+                self._release(key, None, e)
+                raise
+            self._store(key, infos, error)
+        else:
+            lookup.event.wait()
+        return lookup.infos, lookup.error
+
+    def cached(self, host, port, family=0):
+        """Return the cached results, or None if the name is not cached."""
+        with self._lock:
+            entry = self._cache.get((host, family))
+        if entry is None or entry.error is not None or entry.expire <= mtime():
+            return
+        return _with_port(entry.infos, port)
+
+    def getaddrinfo(self, host, port, family=0):
+        """Like `socket.getaddrinfo(host, port, family, SOCK_STREAM)`."""
+        if self.ttl <= 0 or is_ipv4(host) or ":" in host:
+            return socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)
+        infos, error = self._lookup((host, family))
+        if error is not None:
+            if isinstance(error, socket.gaierror):
+                raise socket.gaierror(*error.args)
+            raise error
+        return _with_port(infos, port)
+
+
+def _with_port(infos, port):
+    return [(af, socktype, proto, canonname, (sa[0], port) + sa[2:])
+            for af, socktype, proto, canonname, sa in infos]
+
+resolver = Resolver()
+register_child_hook(resolver._after_fork)
+
+def getaddrinfo(host, port, family=0):
+    return resolver.getaddrinfo(host, port, family)
+
+def set_dns_cache(ttl=60, negative_ttl=5, refresh_ahead=0.75, maxsize=1024):
+    """Used to set the DNS cache of proxy hosts and locally resolved SOCKS
+    destinations.
+
+    optional:
+
+    ttl
+        Seconds to cache the resolved addresses, 0 to disable the cache.
+    negative_ttl
+        Seconds to cache the resolving failures, 0 to disable.
+    refresh_ahead
+        The ratio of `ttl`, after that a cache hit refreshes the entry in
+        the background.
+    maxsize
+        The max count of cached names.
+    """
+    with resolver._lock:
+        resolver.ttl = ttl
+        resolver.negative_ttl = negative_ttl
+        resolver.refresh_ahead = refresh_ahead
+        resolver.maxsize = maxsize
+        resolver._cache.clear()
+
+def clear_dns_cache():
+    """Drop all cached DNS results."""
+    resolver.clear()
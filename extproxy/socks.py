@@ -1,64 +1,142 @@
-"""Using PySocks to create and set new SOCKS proxy connection."""
-
-import socket
-
-from .compat import socks
-from .util import is_ipv4
-
-
-_socks4_no_rdns = set()
-
-if socks is None:
-    SOCKS_PROXY_TYPES = {
-        "socks4" : None,
-        "socks4a": None,
-        "socks"  : None,
-        "socks5" : None,
-        "socks5h": None
-    }
-    def _set_tunnel_socks(self, proxy): pass
-
-else:
-    SOCKS_PROXY_TYPES = {
-        "socks4" : (socks.PROXY_TYPE_SOCKS4, False),
-        "socks4a": (socks.PROXY_TYPE_SOCKS4, True),
-        "socks"  : (socks.PROXY_TYPE_SOCKS5, True),
-        "socks5" : (socks.PROXY_TYPE_SOCKS5, True),
-        "socks5h": (socks.PROXY_TYPE_SOCKS5, False)
-    }
-
-    def _set_tunnel_socks(self, proxy):
-        proxy_type, proxy_rdns = SOCKS_PROXY_TYPES[proxy.scheme]
-        proxy_kw = {
-            "proxy_type": proxy_type,
-            "proxy_addr": proxy.hostname,
-            "proxy_port": proxy.port,
-            "proxy_rdns": proxy_rdns,
-            "proxy_username": proxy.username,
-            "proxy_password": proxy.password
-        }
-
-        def create_connection(dest_pair, timeout=None, source_address=None,
-                              proxy_kw=proxy_kw):
-            host, port = dest_pair
-            proxy_host = proxy_kw["proxy_addr"], proxy_kw["proxy_port"]
-            if proxy_kw["proxy_rdns"]:
-                proxy_kw["proxy_rdns"] = proxy_host not in _socks4_no_rdns
-            rdns = proxy_kw["proxy_rdns"]
-            socket_options = ((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1), )
-
-            while True:
-                try:
-                    return socks.create_connection(
-                            dest_pair, timeout, source_address,
-                            socket_options=socket_options, **proxy_kw)
-                except socks.SOCKS4Error as e:
-                    if rdns and e.msg[:4] == "0x5b" and not is_ipv4(host):
-                    # Maybe that SOCKS4 server doesn't support remote resolving
-                    # Disable rdns and try again
-                        proxy_kw["proxy_rdns"] = rdns = False
-                        _socks4_no_rdns.add(proxy_host)
-                    else:
-                        raise e
-
-        self._create_connection = create_connection
+"""Using a native SOCKS client to create and set new SOCKS proxy connection.
+
+The SOCKS client `socks_client` is imported on first use of a SOCKS proxy.
+"""
+
+from . import happy_eyeballs, metrics
+from .capabilities import proxy_capabilities
+from .compat import urlparse
+from .limits import limited_connect
+from .origin_sessions import mark_tunnel
+from .pool import get_warm_pool, _warm_pool_connectors
+from .proxy_info import SOCKS5, SOCKS_PROXY_TYPES, ProxyInfo, \
+                         get_proxy_info
+from .transport import DEFAULT_PROFILE
+from .util import create_unix_connection, is_ipv4
+
+
+_socks_proxy_settings = {}
+
+def set_socks_proxy(proxy, optimistic=False, fast_open=False, profile=None):
+    """Used to set SOCKS proxy's negotiation mode.
+
+    proxy
+        A SOCKS proxy of string, eg: socks5://id:pw@127.0.0.1:1080
+        The scheme name will be ignored, except a "+unix" suffix, eg:
+            socks5+unix:///run/egress.sock
+
+    optional:
+
+    optimistic
+        Whether to send SOCKS5 greeting, authentication and request in one
+        write, without waiting for replies. Only for the servers which are
+        known to support that.
+    fast_open
+        Whether to connect with TCP Fast Open, then the greeting is sent
+        with SYN once the proxy has given a TFO cookie, only on Linux.
+    profile
+        A `TransportProfile` object, the socket options of connections to
+        the proxy.
+    """
+
+    if not isinstance(proxy, (tuple, ProxyInfo)):
+        proxy = urlparse(proxy)
+    if proxy.scheme.endswith("+unix"):
+        proxy = get_proxy_info(proxy)
+    netloc = _get_normal_netloc(proxy)
+    _socks_proxy_settings[netloc] = optimistic, fast_open, profile
+
+def _get_normal_netloc(proxy):
+    if getattr(proxy, "unix_path", None):
+        return proxy.normal_netloc
+    if proxy.port is None:
+        return proxy.netloc + ":1080"
+    else:
+        return proxy.netloc
+
+def _get_socks_settings(proxy):
+    """Return (optimistic, fast_open, profile) of a proxy."""
+    settings = _socks_proxy_settings.get(proxy.normal_netloc)
+    if settings is None:
+        settings = _socks_proxy_settings.get(proxy.key,
+                                             (False, False, DEFAULT_PROFILE))
+    return settings
+
+def _connect_socks_proxy(proxy, timeout=None, source_address=None):
+    if proxy.unix_path:
+        return create_unix_connection(proxy.unix_path, timeout, proxy.key)
+    _, fast_open, profile = _get_socks_settings(proxy)
+    return happy_eyeballs.create_connection(
+            (proxy.hostname, proxy.port or 1080), timeout, source_address,
+            proxy.key, fast_open=fast_open,
+            profile=profile or DEFAULT_PROFILE)
+
+def _connect_warm_socks_proxy(proxy, timeout=None):
+    from .socks_client import socks5_authenticate
+    sock = _connect_socks_proxy(proxy, timeout)
+    if proxy.proxy_type == SOCKS5:
+        # Finish greeting and authentication, only request on checkout
+        try:
+            method = socks5_authenticate(sock, proxy.username, proxy.password)
+        except Exception:
+            sock.close()
+            raise
+        proxy_capabilities.set(proxy.key, "auth_method", method)
+    return sock
+
+for proxy_scheme in SOCKS_PROXY_TYPES:
+    _warm_pool_connectors[proxy_scheme] = _connect_warm_socks_proxy
+
+def _create_socks_connection(proxy, dest_pair, timeout=None,
+                             source_address=None):
+    return limited_connect(proxy.key, timeout, _negotiate_socks_tunnel,
+                           proxy, dest_pair, timeout, source_address)
+
+def _negotiate_socks_tunnel(proxy, dest_pair, timeout, source_address):
+    from .socks_client import SOCKS4Error, negotiate
+    host, port = dest_pair
+    proxy_key = proxy.key
+    rdns = proxy.rdns and proxy_capabilities.get(proxy_key, "rdns", True)
+    optimistic, _, _ = _get_socks_settings(proxy)
+    pool = None if source_address else get_warm_pool(proxy)
+
+    while True:
+        sock = pool.get(timeout) if pool is not None else None
+        authenticated = sock is not None
+        if sock is None:
+            sock = _connect_socks_proxy(proxy, timeout, source_address)
+        args = (sock, dest_pair, proxy.proxy_type, rdns, proxy.username,
+                proxy.password, optimistic, authenticated)
+        try:
+            if metrics.enabled:
+                _, method = metrics.timed("socks_negotiate", proxy_key,
+                                          negotiate, *args)
+            else:
+                _, method = negotiate(*args)
+        except SOCKS4Error as e:
+            sock.close()
+            if rdns and e.status == 0x5b and not is_ipv4(host):
+            # Maybe that SOCKS4 server doesn't support remote resolving
+            # Disable rdns and try again
+                rdns = False
+                proxy_capabilities.set(proxy_key, "rdns", False)
+                if metrics.enabled:
+                    metrics.emit("rdns_fallback", proxy_key, 1)
+            else:
+                raise e
+        except:
+            sock.close()
+            raise
+        else:
+            if method is not None:
+                proxy_capabilities.set(proxy_key, "auth_method", method)
+            mark_tunnel(sock, proxy_key)
+            return sock
+
+def _set_tunnel_socks(self, proxy):
+    def create_connection(dest_pair, timeout=None, source_address=None,
+                          proxy=proxy):
+        return _create_socks_connection(proxy, dest_pair, timeout,
+                                        source_address)
+
+    self._create_connection = create_connection
@@ -0,0 +1,227 @@
+"""A native SOCKS4/4a/5 client, which can pipeline the negotiation."""
+
+import socket
+import struct
+
+from .proxy_info import PROXY_TYPE_SOCKS4, PROXY_TYPE_SOCKS5, SOCKS4, SOCKS5
+from .resolver import getaddrinfo
+from .util import is_ipv4
+
+
+SOCKS4_ERRORS = {
+    0x5b: "Request rejected or failed",
+    0x5c: "Request rejected because SOCKS server cannot connect to identd "
+          "on the client",
+    0x5d: "Request rejected because the client program and identd report "
+          "different user-ids"
+}
+
+SOCKS5_ERRORS = {
+    0x01: "General SOCKS server failure",
+    0x02: "Connection not allowed by ruleset",
+    0x03: "Network unreachable",
+    0x04: "Host unreachable",
+    0x05: "Connection refused",
+    0x06: "TTL expired",
+    0x07: "Command not supported, or protocol error",
+    0x08: "Address type not supported"
+}
+
+# Bound address lengths of SOCKS5 replies, domain names are prefixed length
+SOCKS5_ADDRESS_LENGTHS = {0x01: 4, 0x04: 16}
+
+
+class ProxyError(socket.error):
+    """Base class of SOCKS negotiation errors."""
+
+    def __init__(self, msg, status=None):
+        socket.error.__init__(self, msg)
+        self.msg = msg
+        self.status = status
+
+    def __str__(self):
+        return self.msg
+
+class GeneralProxyError(ProxyError): pass
+class SOCKS5AuthError(ProxyError): pass
+
+class SOCKS5Error(ProxyError):
+    def __init__(self, status):
+        ProxyError.__init__(self, "%#04x: %s" % (
+            status, SOCKS5_ERRORS.get(status, "Unknown error")), status)
+
+class SOCKS4Error(ProxyError):
+    def __init__(self, status):
+        ProxyError.__init__(self, "%#04x: %s" % (
+            status, SOCKS4_ERRORS.get(status, "Unknown error")), status)
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+def _recv_exact(sock, count):
+    data = b""
+    while len(data) < count:
+        d = sock.recv(count - len(data))
+        if not d:
+            raise GeneralProxyError("Connection closed unexpectedly")
+        data += d
+    return data
+
+def socks5_greeting(username=None, password=None, optimistic=False):
+    if username and password:
+        # Only offer the method which will be used, if do not wait reply
+        return b"\x05\x01\x02" if optimistic else b"\x05\x02\x00\x02"
+    return b"\x05\x01\x00"
+
+def socks5_auth(username, password):
+    username = _to_bytes(username)
+    password = _to_bytes(password)
+    return (b"\x01" + struct.pack("B", len(username)) + username +
+            struct.pack("B", len(password)) + password)
+
+def socks5_request(host, port, rdns=True):
+    host = host.strip("[]")
+    if is_ipv4(host):
+        addr = b"\x01" + socket.inet_aton(host)
+    elif ":" in host:
+        addr = b"\x04" + socket.inet_pton(socket.AF_INET6, host)
+    elif rdns:
+        host = host.encode("idna")
+        addr = b"\x03" + struct.pack("B", len(host)) + host
+    else:
+        family, _, _, _, sa = getaddrinfo(host, port)[0]
+        if family == socket.AF_INET6:
+            addr = b"\x04" + socket.inet_pton(family, sa[0])
+        else:
+            addr = b"\x01" + socket.inet_aton(sa[0])
+    return b"\x05\x01\x00" + addr + struct.pack(">H", port)
+
+def socks4_request(host, port, rdns=True, username=None):
+    remote_host = b""
+    if is_ipv4(host):
+        addr = socket.inet_aton(host)
+    elif rdns:
+        # SOCKS4a extension
+        addr = b"\x00\x00\x00\x01"
+        remote_host = host.encode("idna") + b"\x00"
+    else:
+        sa = getaddrinfo(host, port, socket.AF_INET)[0][4]
+        addr = socket.inet_aton(sa[0])
+    userid = _to_bytes(username) if username else b""
+    return (struct.pack(">BBH", 0x04, 0x01, port) + addr + userid + b"\x00" +
+            remote_host)
+
+def socks5_parse_method(data, username=None, password=None):
+    version, method = struct.unpack("BB", data)
+    if version != 0x05:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    if method == 0x02:
+        if not (username and password):
+            raise SOCKS5AuthError("No username/password supplied. Server "
+                                  "requested username/password authentication")
+    elif method == 0xff:
+        raise SOCKS5AuthError("All offered authentication methods were "
+                              "rejected")
+    elif method != 0x00:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    return method
+
+def socks5_parse_auth(data):
+    version, status = struct.unpack("BB", data)
+    if version != 0x01:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    if status != 0x00:
+        raise SOCKS5AuthError("SOCKS5 authentication failed")
+
+def socks5_parse_reply(data):
+    """Check the first 4 bytes of a SOCKS5 reply, return the address type."""
+    version, status, _, atyp = struct.unpack("BBBB", data)
+    if version != 0x05:
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    if status != 0x00:
+        raise SOCKS5Error(status)
+    if atyp not in (0x01, 0x03, 0x04):
+        raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+    return atyp
+
+def socks5_parse_address(atyp, data):
+    if atyp == 0x01:
+        return socket.inet_ntoa(data)
+    elif atyp == 0x04:
+        return socket.inet_ntop(socket.AF_INET6, data)
+    return data.decode("idna")
+
+def socks4_parse_reply(data):
+    if data[0:1] != b"\x00":
+        raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
+    status = struct.unpack("B", data[1:2])[0]
+    if status != 0x5a:
+        raise SOCKS4Error(status)
+    return socket.inet_ntoa(data[4:]), struct.unpack(">H", data[2:4])[0]
+
+def socks5_read_method(sock, username=None, password=None):
+    return socks5_parse_method(_recv_exact(sock, 2), username, password)
+
+def socks5_read_auth(sock):
+    socks5_parse_auth(_recv_exact(sock, 2))
+
+def socks5_read_reply(sock):
+    atyp = socks5_parse_reply(_recv_exact(sock, 4))
+    if atyp == 0x03:
+        length = struct.unpack("B", _recv_exact(sock, 1))[0]
+    else:
+        length = SOCKS5_ADDRESS_LENGTHS[atyp]
+    addr = socks5_parse_address(atyp, _recv_exact(sock, length))
+    port = struct.unpack(">H", _recv_exact(sock, 2))[0]
+    return addr, port
+
+def socks4_read_reply(sock):
+    return socks4_parse_reply(_recv_exact(sock, 8))
+
+def socks5_authenticate(sock, username=None, password=None):
+    """Do SOCKS5 greeting and authentication, without a request.
+    Return the chosen authentication method."""
+    sock.sendall(socks5_greeting(username, password))
+    method = socks5_read_method(sock, username, password)
+    if method == 0x02:
+        sock.sendall(socks5_auth(username, password))
+        socks5_read_auth(sock)
+    return method
+
+def negotiate(sock, dest_pair, proxy_type, rdns=True, username=None,
+              password=None, optimistic=False, authenticated=False):
+    """Negotiate a CONNECT tunnel over a connected socket to SOCKS proxy.
+
+    optimistic
+        Send SOCKS5 greeting, authentication and request in one write, then
+        read the replies, only for the servers which support that.
+    authenticated
+        The SOCKS5 greeting and authentication has been done.
+
+    Return the bound address at the proxy, and the chosen SOCKS5
+    authentication method, None if it is not negotiated.
+    """
+    host, port = dest_pair
+    if proxy_type == SOCKS4:
+        sock.sendall(socks4_request(host, port, rdns, username))
+        return socks4_read_reply(sock), None
+
+    request = socks5_request(host, port, rdns)
+    method = None
+    if authenticated:
+        sock.sendall(request)
+    elif optimistic:
+        data = socks5_greeting(username, password, optimistic)
+        if username and password:
+            data += socks5_auth(username, password)
+        sock.sendall(data + request)
+        method = socks5_read_method(sock, username, password)
+        if method == 0x02:
+            socks5_read_auth(sock)
+    else:
+        method = socks5_authenticate(sock, username, password)
+        sock.sendall(request)
+    return socks5_read_reply(sock), method
@@ -1,17 +1,72 @@
 """Make build-in module ssl to wrap SSLSocket happy."""
 
 from ssl import SSLSocket
-from .util import forward_socket, socketpair
+from . import origin_sessions
+from .https import connect_pending
+from .limits import move_lease, new_throttle
+from .metrics import proxy_key_of
+from .transport import get_profile
+from .util import forward_socket, loaded_module, socketpair
 
 
 def _wrap_socket(self, sock, **kwargs):
-    if isinstance(sock, SSLSocket):
+    tunnel = sock
+    # Resume TLS sessions to origin server through the same proxy
+    session_key = None
+    if not kwargs.get("server_side"):
+        session_key = origin_sessions.get_session_key(
+                sock, kwargs.get("server_hostname"))
+        if session_key is not None and kwargs.get("session") is None:
+            kwargs["session"] = origin_sessions.get_session(session_key, self)
+    http2 = loaded_module("http2")
+    h2_stream = http2 is not None and isinstance(sock, http2.H2Stream)
+    if h2_stream or isinstance(sock, SSLSocket):
+        # The response of a optimistic CONNECT request must be read before
+        # the handshake, in the same thread. HTTP/2 streams are not sockets
+        if h2_stream or connect_pending(sock) or _memorybio_mode():
+            from .tls_in_tls import OriginTLSInTLSSocket, TLSInTLSSocket
+            if session_key is None:
+                return TLSInTLSSocket(self, sock, **kwargs)
+            ssock = OriginTLSInTLSSocket(self, sock, **kwargs)
+            return _session_wrapped(ssock, session_key, kwargs)
         # SSLSocket() can not be wrapped twice, pipe to a new socket().
-        # Whether to wait write/input data, because SSLSocket() has
-        # no data available on SSL layer but readable on low layer
-        # after do_handshake() with TLSv1.3.
-        wait_local = sock.version() == "TLSv1.3" and sock.pending() == 0
         ssock, csock = socketpair()
-        forward_socket(ssock, sock, wait_local=wait_local)
+        forwarder = loaded_module("forwarder")
+        forwarder = forwarder and forwarder.get_forwarder()
+        if forwarder is not None:
+            # Non-blocking forwarder does not need to wait local data.
+            forwarder.register(ssock, sock)
+        else:
+            # Whether to wait write/input data, because SSLSocket() has
+            # no data available on SSL layer but readable on low layer
+            # after do_handshake() with TLSv1.3.
+            wait_local = sock.version() == "TLSv1.3" and sock.pending() == 0
+            forward_socket(ssock, sock, wait_local=wait_local,
+                           throttle=new_throttle(proxy_key_of(sock)),
+                           **get_profile(sock).forward_options())
         sock = csock
-    return _wrap_socket.orig(self, sock, **kwargs)
+    if session_key is None:
+        ssock = _wrap_socket.orig(self, sock, **kwargs)
+    else:
+        if self.sslsocket_class is SSLSocket:
+            # Store the session when it is closed
+            ssock = origin_sessions.OriginSSLSocket._create(
+                    sock=sock, context=self, **kwargs)
+        else:
+            ssock = _wrap_socket.orig(self, sock, **kwargs)
+        ssock = _session_wrapped(ssock, session_key, kwargs)
+    if sock is tunnel:
+        # The tunnel has been detached, its slot goes to the new socket
+        move_lease(tunnel, ssock)
+    return ssock
+
+def _memorybio_mode():
+    tls_in_tls = loaded_module("tls_in_tls")
+    return tls_in_tls is not None and \
+           tls_in_tls.get_tls_in_tls_mode() == "memorybio"
+
+def _session_wrapped(ssock, session_key, kwargs):
+    ssock._extproxy_session_key = session_key
+    if kwargs.get("do_handshake_on_connect", True):
+        origin_sessions.handshaked(session_key, ssock)
+    return ssock
@@ -0,0 +1,248 @@
+"""Run a TLS session over an existing SSLSocket with ssl.MemoryBIO."""
+
+import io
+import socket
+import ssl
+
+
+__all__ = ["set_tls_in_tls_mode"]
+
+TLS_IN_TLS_MODES = ("socketpair", "memorybio")
+
+_tls_in_tls_mode = "socketpair"
+
+def set_tls_in_tls_mode(mode):
+    """Used to set how to wrap a SSLSocket to an HTTPS proxy again.
+
+    mode
+        "socketpair"
+            Pipe through a local socket pair and a forwarder, default.
+        "memorybio"
+            Run the inner TLS session over ssl.MemoryBIO on top of the
+            proxy connection, no extra thread and file descriptors, only
+            available with Python 3.5 and above.
+    """
+    global _tls_in_tls_mode
+    if mode not in TLS_IN_TLS_MODES:
+        raise ValueError("unknown TLS-in-TLS mode: %r" % mode)
+    if mode == "memorybio" and getattr(ssl, "MemoryBIO", None) is None:
+        raise RuntimeError("TLS-in-TLS mode 'memorybio' requires "
+                           "ssl.MemoryBIO")
+    _tls_in_tls_mode = mode
+
+def get_tls_in_tls_mode():
+    return _tls_in_tls_mode
+
+
+class TLSInTLSSocket(object):
+    """A socket-like object, which runs a TLS session as ssl.SSLObject over
+    a SSLSocket.
+    """
+
+    bufsize = 1024 * 16
+    # Whether the connection to proxy has been handed over by detach()
+    _detached = False
+
+    def __init__(self, context, sock, server_side=False,
+                 do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                 server_hostname=None, session=None):
+        self._sock = sock
+        self._context = context
+        self.suppress_ragged_eofs = suppress_ragged_eofs
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self._sslobj = context.wrap_bio(
+                self._incoming, self._outgoing, server_side=server_side,
+                server_hostname=server_hostname, session=session)
+        self._io_refs = 0
+        self._closed = False
+        if do_handshake_on_connect:
+            self.do_handshake()
+
+    def _flush(self):
+        data = self._outgoing.read()
+        if data:
+            self._sock.sendall(data)
+
+    def _io(self, func, *args):
+        while True:
+            try:
+                ret = func(*args)
+            except ssl.SSLWantReadError:
+                self._flush()
+                data = self._sock.recv(self.bufsize)
+                if data:
+                    self._incoming.write(data)
+                else:
+                    self._incoming.write_eof()
+            except ssl.SSLWantWriteError:
+                self._flush()
+            else:
+                self._flush()
+                return ret
+
+    def _read(self, len, buffer=None):
+        try:
+            if buffer is None:
+                return self._io(self._sslobj.read, len)
+            return self._io(self._sslobj.read, len, buffer)
+        except ssl.SSLZeroReturnError:
+            pass
+        except ssl.SSLEOFError:
+            if not self.suppress_ragged_eofs:
+                raise
+        return b"" if buffer is None else 0
+
+    @property
+    def context(self):
+        return self._context
+
+    @property
+    def server_side(self):
+        return self._sslobj.server_side
+
+    @property
+    def server_hostname(self):
+        return self._sslobj.server_hostname
+
+    @property
+    def session(self):
+        return self._sslobj.session
+
+    @property
+    def session_reused(self):
+        return self._sslobj.session_reused
+
+    def do_handshake(self):
+        self._io(self._sslobj.do_handshake)
+
+    def recv(self, buflen=1024, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to recv()")
+        return self._read(buflen)
+
+    def recv_into(self, buffer, nbytes=None, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to "
+                             "recv_into()")
+        if not nbytes:
+            nbytes = len(buffer)
+        return self._read(nbytes, buffer)
+
+    def read(self, len=1024, buffer=None):
+        return self._read(len, buffer)
+
+    def send(self, data, flags=0):
+        if flags:
+            raise ValueError("non-zero flags not allowed in calls to send()")
+        return self._io(self._sslobj.write, data)
+
+    def sendall(self, data, flags=0):
+        with memoryview(data) as view, view.cast("B") as byte_view:
+            amount = len(byte_view)
+            count = 0
+            while count < amount:
+                count += self.send(byte_view[count:], flags)
+
+    write = send
+
+    def pending(self):
+        return self._sslobj.pending()
+
+    def getpeercert(self, binary_form=False):
+        return self._sslobj.getpeercert(binary_form)
+
+    def selected_alpn_protocol(self):
+        return self._sslobj.selected_alpn_protocol()
+
+    def cipher(self):
+        return self._sslobj.cipher()
+
+    def shared_ciphers(self):
+        return self._sslobj.shared_ciphers()
+
+    def compression(self):
+        return self._sslobj.compression()
+
+    def version(self):
+        return self._sslobj.version()
+
+    def unwrap(self):
+        self._io(self._sslobj.unwrap)
+        return self._sock
+
+    def makefile(self, mode="r", buffering=None, encoding=None, errors=None,
+                 newline=None):
+        if not set(mode) <= {"r", "w", "b"}:
+            raise ValueError("invalid mode %r (only r, w, b allowed)" % mode)
+        writing = "w" in mode
+        reading = "r" in mode or not writing
+        binary = "b" in mode
+        rawmode = ""
+        if reading:
+            rawmode += "r"
+        if writing:
+            rawmode += "w"
+        raw = socket.SocketIO(self, rawmode)
+        self._io_refs += 1
+        if buffering is None or buffering < 0:
+            buffering = io.DEFAULT_BUFFER_SIZE
+        if buffering == 0:
+            if not binary:
+                raise ValueError("unbuffered streams must be binary")
+            return raw
+        if reading and writing:
+            buffer = io.BufferedRWPair(raw, raw, buffering)
+        elif reading:
+            buffer = io.BufferedReader(raw, buffering)
+        else:
+            buffer = io.BufferedWriter(raw, buffering)
+        if binary:
+            return buffer
+        text = io.TextIOWrapper(buffer, encoding, errors, newline)
+        text.mode = mode
+        return text
+
+    def _decref_socketios(self):
+        if self._io_refs > 0:
+            self._io_refs -= 1
+        if self._closed:
+            self.close()
+
+    def close(self):
+        self._closed = True
+        if self._io_refs <= 0 and not self._detached:
+            self._sock.close()
+
+    def detach(self):
+        """Shut down the TLS session, put this socket into closed state
+        without closing the connection to proxy, and return it."""
+        sock = self.unwrap()
+        self._detached = self._closed = True
+        return sock
+
+    def __getattr__(self, name):
+        # fileno, settimeout, setsockopt, getpeername, etc.
+        return getattr(self._sock, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "<%s over %r>" % (self.__class__.__name__, self._sock)
+
+
+class OriginTLSInTLSSocket(TLSInTLSSocket):
+    """A `TLSInTLSSocket` to origin server through a proxy, which stores
+    its TLS session when it is closed."""
+
+    _extproxy_session_key = None
+
+    def close(self):
+        if self._extproxy_session_key is not None and not self._closed:
+            from .origin_sessions import store_session
+            store_session(self._extproxy_session_key, self)
+        TLSInTLSSocket.close(self)
@@ -0,0 +1,133 @@
+"""Transport profiles, the socket options of connections to a proxy and the
+settings of forwarded tunnels through it."""
+
+import socket
+
+
+__all__ = ["TransportProfile"]
+
+# Not all platforms have these options, macOS names TCP_KEEPIDLE
+# TCP_KEEPALIVE
+_TCP_OPTIONS = {
+    "keepidle": getattr(socket, "TCP_KEEPIDLE",
+                        getattr(socket, "TCP_KEEPALIVE", None)),
+    "keepintvl": getattr(socket, "TCP_KEEPINTVL", None),
+    "keepcnt": getattr(socket, "TCP_KEEPCNT", None),
+    "quickack": getattr(socket, "TCP_QUICKACK", None),
+    "notsent_lowat": getattr(socket, "TCP_NOTSENT_LOWAT", None)
+}
+
+
+def _set_tcp_option(sock, name, value):
+    option = _TCP_OPTIONS[name]
+    if option is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except socket.error:
+        # Unsupported by the platform
+        pass
+
+def set_quickack(sock):
+    """Send ACKs at once, the kernel clears TCP_QUICKACK again after some
+    reads, so it is set after each read of forwarded tunnels."""
+    _set_tcp_option(sock, "quickack", 1)
+
+
+class TransportProfile(object):
+    """The socket options of connections to a proxy, and the settings of
+    forwarded tunnels through it, the options which are None are unchanged,
+    eg: a profile for bulk transfers
+        TransportProfile(rcvbuf=4194304, sndbuf=4194304, bufsize=65536,
+                         max_bufsize=1048576, idle_timeout=600)
+    and one for interactive small messages
+        TransportProfile(quickack=True, notsent_lowat=16384,
+                         keepalive=(30, 10, 3), bufsize=16384)
+
+    rcvbuf, sndbuf
+        SO_RCVBUF and SO_SNDBUF in bytes, set before connecting, so that the
+        TCP window scale is negotiated for them. Setting them disables the
+        buffer autotuning of the kernel.
+    nodelay
+        Whether to set TCP_NODELAY, default True.
+    keepalive
+        A tuple (idle, interval, count) of TCP keepalive, in seconds.
+    quickack
+        Whether to set TCP_QUICKACK, only on Linux.
+    notsent_lowat
+        TCP_NOTSENT_LOWAT in bytes, limits the unsent data of the send
+        buffer, which keeps the latency of new writes low.
+    bufsize
+        The initial read size of forwarded tunnels, it doubles when a read
+        fills it, up to max_bufsize, default the forwarder's bufsize.
+    max_bufsize
+        The max read size of forwarded tunnels, default bufsize.
+    idle_timeout
+        Close forwarded tunnels which have been idle for this many seconds,
+        default the forwarder's timeout.
+    """
+
+    __slots__ = ("rcvbuf", "sndbuf", "nodelay", "keepalive", "quickack",
+                 "notsent_lowat", "bufsize", "max_bufsize", "idle_timeout")
+
+    def __init__(self, rcvbuf=None, sndbuf=None, nodelay=True,
+                 keepalive=None, quickack=False, notsent_lowat=None,
+                 bufsize=None, max_bufsize=None, idle_timeout=None):
+        if keepalive is not None and len(keepalive) != 3:
+            raise ValueError("keepalive must be (idle, interval, count)")
+        if bufsize and max_bufsize and max_bufsize < bufsize:
+            raise ValueError("max_bufsize must not be less than bufsize")
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.quickack = quickack
+        self.notsent_lowat = notsent_lowat
+        self.bufsize = bufsize
+        self.max_bufsize = max_bufsize
+        self.idle_timeout = idle_timeout
+
+    def apply(self, sock):
+        """Set the socket options, before connecting."""
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.keepalive:
+            idle, interval, count = self.keepalive
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            _set_tcp_option(sock, "keepidle", idle)
+            _set_tcp_option(sock, "keepintvl", interval)
+            _set_tcp_option(sock, "keepcnt", count)
+        if self.notsent_lowat:
+            _set_tcp_option(sock, "notsent_lowat", self.notsent_lowat)
+        if self.quickack:
+            set_quickack(sock)
+
+    def forward_options(self):
+        """Return the keyword arguments of `forward_socket`."""
+        options = {}
+        if self.bufsize:
+            options["bufsize"] = self.bufsize
+        if self.max_bufsize:
+            options["max_bufsize"] = self.max_bufsize
+        if self.idle_timeout:
+            options["timeout"] = self.idle_timeout
+        if self.quickack:
+            options["quickack"] = True
+        return options
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, " ".join(
+                "%s=%r" % (name, getattr(self, name))
+                for name in self.__slots__
+                if getattr(self, name) not in (None, False)))
+
+
+DEFAULT_PROFILE = TransportProfile()
+
+def get_profile(sock):
+    """Return the profile of a connection to proxy."""
+    return getattr(sock, "_extproxy_profile", None) or DEFAULT_PROFILE
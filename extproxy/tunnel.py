@@ -0,0 +1,74 @@
+"""Send CONNECT requests to HTTP and HTTPS proxies, and parse responses."""
+
+import socket
+
+
+class TunnelError(socket.error):
+    """The HTTP proxy refused a CONNECT request."""
+
+    def __init__(self, status, reason):
+        socket.error.__init__(self, "Tunnel connection failed: %d %s"
+                                    % (status, reason))
+        self.status = status
+
+
+def connect_authority(dest_pair):
+    """Return the host:port of a CONNECT request to destination."""
+    host, port = dest_pair
+    host = host.encode("idna").decode("ascii")
+    if ":" in host and not host.startswith("["):
+        host = "[%s]" % host
+    return "%s:%d" % (host, port)
+
+def connect_request(dest_pair, headers=None):
+    """Return the bytes of a CONNECT request to destination."""
+    hostport = connect_authority(dest_pair)
+    request = ["CONNECT %s HTTP/1.1" % hostport]
+    headers = dict(headers or ())
+    if not any(name.lower() == "host" for name in headers):
+        request.append("Host: %s" % hostport)
+    request.extend("%s: %s" % header for header in headers.items())
+    return ("\r\n".join(request) + "\r\n\r\n").encode("latin-1")
+
+def parse_connect_response(response):
+    """Parse the received response of a CONNECT request, return None if its
+    header is incomplete, else the data after the header."""
+    header, sep, extra = response.partition(b"\r\n\r\n")
+    if not sep:
+        if len(response) > 65536:
+            raise socket.error("Tunnel connection failed: "
+                               "response too long")
+        return
+    status_line = header.split(b"\r\n", 1)[0].decode("latin-1")
+    try:
+        _, status, reason = (status_line.split(None, 2) + [""])[:3]
+        status = int(status)
+    except ValueError:
+        raise socket.error("Tunnel connection failed: bad status line %r"
+                           % status_line)
+    if status != 200:
+        raise TunnelError(status, reason.strip())
+    return extra
+
+def read_connect_response(sock):
+    """Read the response of a CONNECT request, return the data after the
+    header."""
+    response = b""
+    while True:
+        extra = parse_connect_response(response)
+        if extra is not None:
+            return extra
+        data = sock.recv(8192)
+        if not data:
+            raise socket.error("Tunnel connection failed: "
+                               "connection closed")
+        response += data
+
+def http_connect(sock, dest_pair, proxy_auth=None):
+    """Send a CONNECT request over a connected socket to HTTP proxy, and
+    read the response."""
+    headers = {"Proxy-Authorization": proxy_auth} if proxy_auth else None
+    sock.sendall(connect_request(dest_pair, headers))
+    if read_connect_response(sock):
+        # Destination protocols are client speak first
+        raise socket.error("Tunnel connection failed: unexpected data")
@@ -4,47 +4,101 @@ import socket
 import select
 import errno
 import threading
+import sys
+import time
 
-from .compat import PY3, mtime
+from . import metrics
+from .compat import PY3, mtime, selectors
+from .transport import set_quickack
 
 
+AF_UNIX = getattr(socket, "AF_UNIX", None)
+
+
+def loaded_module(name):
+    """Return the submodule of extproxy if it has been imported, else None.
+    The optional engines are imported on first use, there are none of their
+    objects before that."""
+    return sys.modules.get(__package__ + "." + name)
+
 def _forward_socket(local, remote, wait_local=False,
-                                   timeout=60, tick=4, bufsize=1024*32):
+                                   timeout=60, tick=4, bufsize=1024*32,
+                                   max_bufsize=None, quickack=False,
+                                   throttle=None):
     buf = memoryview(bytearray(bufsize))
+    max_bufsize = max(max_bufsize or bufsize, bufsize)
     maxpong = timeout
     allins = [local, remote]
     timecount = timeout
+    proxy = None
+    sent = received = 0
+    if metrics.enabled:
+        proxy = metrics.proxy_key_of(remote) or ""
+        metrics.emit("tunnel_open", proxy, 1)
+    selector = None
     try:
+        if selectors is not None:
+            # Unlike select(), works with file descriptors above FD_SETSIZE
+            selector = selectors.DefaultSelector()
+            for sock in allins:
+                selector.register(sock, selectors.EVENT_READ)
         if wait_local:
             r_timeout = local.gettimeout()
             if not r_timeout or r_timeout < timeout:
                 local.settimeout(timeout)
             ndata = local.recv_into(buf)
             remote.sendall(buf[:ndata])
+            sent += ndata
 
         while allins and timecount > 0:
             start_time = mtime()
-            ins, _, err = select.select(allins, [], allins, tick)
+            if selector is None:
+                ins, _, err = select.select(allins, [], allins, tick)
+                if err:
+                    raise socket.error(err)
+            else:
+                ins = [key.fileobj for key, _ in selector.select(tick)]
             t = mtime() - start_time
             timecount -= int(t)
-            if err:
-                raise socket.error(err)
             for sock in ins:
                 ndata = sock.recv_into(buf)
                 if ndata:
-                    other = local if sock is remote else remote
+                    if sock is remote:
+                        other = local
+                        received += ndata
+                        if quickack:
+                            set_quickack(remote)
+                    else:
+                        other = remote
+                        sent += ndata
                     other.sendall(buf[:ndata])
+                    if throttle is not None:
+                        delay = throttle.consume(ndata)
+                        if delay > 0:
+                            time.sleep(delay)
+                    if ndata == len(buf) < max_bufsize:
+                        # Grow the read buffer for bulk transfers
+                        buf = memoryview(bytearray(min(ndata * 2,
+                                                       max_bufsize)))
                 elif sock is remote:
                     return
                 else:
                     allins.remove(sock)
+                    if selector is not None:
+                        selector.unregister(sock)
             if ins and len(allins) == 2:
                 timecount = max(min(timecount * 2, maxpong), tick)
     except Exception:
         pass
     finally:
+        if selector is not None:
+            selector.close()
         local.close()
         remote.close()
+        if proxy is not None:
+            metrics.emit("tunnel_close", proxy, 1)
+            metrics.emit("bytes_sent", proxy, sent)
+            metrics.emit("bytes_received", proxy, received)
 
 def forward_socket(*args, **kwargs):
     threading._start_new_thread(_forward_socket, args, kwargs)
@@ -97,6 +151,15 @@ except AttributeError:
             lsock.close()
         return (ssock, csock)
 
+def is_readable(sock, timeout=0):
+    """Whether a socket is readable, also works with file descriptors above
+    FD_SETSIZE where poll() is available."""
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
 def is_ipv4(s):
     try:
         socket.inet_pton(socket.AF_INET, s)
@@ -104,3 +167,37 @@ def is_ipv4(s):
         return False
     else:
         return True
+
+class UnixSocket(socket.socket):
+    """A Unix domain socket, which ignores TCP options like TCP_NODELAY set
+    by http.client, so that it can be used as TCP connections."""
+
+    __slots__ = ()
+
+    def setsockopt(self, level, *args):
+        if level != socket.IPPROTO_TCP:
+            socket.socket.setsockopt(self, level, *args)
+
+
+def create_unix_connection(path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                           key=None):
+    """Connect to a Unix domain socket path, like `socket.create_connection`.
+
+    key
+        The key of the proxy, used by metrics.
+    """
+    if metrics.enabled:
+        return metrics.timed("connect", key, _create_unix_connection, path,
+                             timeout)
+    return _create_unix_connection(path, timeout)
+
+def _create_unix_connection(path, timeout):
+    sock = UnixSocket(AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(timeout)
+        sock.connect(path)
+    except:
+        sock.close()
+        raise
+    return sock
@@ -22,7 +22,7 @@ def get_version():
 
 here = os.path.abspath(os.path.dirname(__file__))
 package_name = "extproxy"
-requires = ["PySocks>=1.7.1"]
+requires = []
 
 setup(
     name="ExtProxy",
@@ -38,6 +38,7 @@ setup(
     keywords="urllib ProxyHandler HTTPS SOCKS proxy",
     packages=[package_name],
     install_requires=requires,
+    extras_require={"h2": ["h2"]},
     zip_safe=True,
     platforms="any",
     classifiers=[
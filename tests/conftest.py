@@ -0,0 +1,38 @@
+import shutil
+import tempfile
+
+import pytest
+
+import extproxy
+
+from .standins import CERTFILE, StandIns
+
+
+@pytest.fixture(scope="session")
+def standins():
+    unix_dir = tempfile.mkdtemp(prefix="extproxy-")
+    servers = StandIns(unix_dir=unix_dir)
+    servers.unix_dir = unix_dir
+    yield servers
+    servers.close()
+    shutil.rmtree(unix_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def origin_url(standins):
+    return "https://localhost:%d/" % standins.ports["origin"]
+
+
+@pytest.fixture
+def https_proxy(standins, request):
+    """A HTTPS proxy of the stand-in, which is set apart from the proxies of
+    the other tests by the credentials, they are not checked."""
+    proxy = "https://t%d:x@127.0.0.1:%d" % (id(request.node),
+                                          standins.ports["https"])
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE)
+    return proxy
+
+
+@pytest.fixture
+def socks_proxy(standins):
+    return "socks5://127.0.0.1:%d" % standins.ports["socks"]
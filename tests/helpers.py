@@ -0,0 +1,40 @@
+"""Clients of the stand-ins."""
+
+import socket
+import time
+from urllib.request import HTTPSHandler, ProxyHandler, build_opener
+
+from .standins import client_context
+
+
+def opener_of(proxy, handler=None):
+    if handler is None:
+        handler = HTTPSHandler(context=client_context())
+    return build_opener(ProxyHandler({"http": proxy, "https": proxy}),
+                        handler)
+
+def fetch(proxy, url, timeout=10, handler=None):
+    """Fetch url through proxy, return the body."""
+    response = opener_of(proxy, handler).open(url, timeout=timeout)
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+def dead_port():
+    """Return a port on which nothing listens."""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def wait_for(predicate, timeout=5):
+    """Wait until predicate() is true, for the work of background threads,
+    return its last value."""
+    deadline = time.time() + timeout
+    while True:
+        value = predicate()
+        if value or time.time() >= deadline:
+            return value
+        time.sleep(0.01)
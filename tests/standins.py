@@ -0,0 +1,379 @@
+"""Local stand-ins of a TLS origin, a HTTPS (CONNECT over TLS) proxy and a
+SOCKS4/4a/5 proxy, used by the tests and the benchmarks. If the package h2
+is installed, also a HTTPS proxy which serves CONNECT streams over HTTP/2,
+it refuses the streams of the user "refuse".
+
+All servers run on one asyncio event loop, in a thread of the calling
+process, or in a child process to keep the measured process clean. They
+listen on 127.0.0.1, and optionally the proxies on Unix domain sockets too.
+They use the self-signed certificate `localhost.pem`, which is issued to
+localhost and 127.0.0.1.
+"""
+
+import asyncio
+import base64
+import functools
+import multiprocessing
+import os
+import socket
+import ssl
+import struct
+import threading
+
+CERTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "localhost.pem")
+
+_CHUNK = b"x" * 65536
+
+
+def server_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(CERTFILE)
+    return context
+
+def client_context():
+    return ssl.create_default_context(cafile=CERTFILE)
+
+def h2_server_context():
+    context = server_context()
+    context.set_alpn_protocols(["h2", "http/1.1"])
+    return context
+
+
+async def _pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except (ConnectionError, OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def _relay(reader, writer, up_reader, up_writer):
+    await asyncio.gather(_pipe(reader, up_writer), _pipe(up_reader, writer))
+
+
+async def handle_origin(reader, writer):
+    """HTTP/1.1 with keep-alive, `GET /<n>` responds n bytes."""
+    try:
+        while True:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1]
+            size = int(path[1:] or 0)
+            close = b"connection: close" in request.lower()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n%s\r\n"
+                         % (size, b"Connection: close\r\n" if close else b""))
+            while size > 0:
+                writer.write(_CHUNK[:size])
+                size -= len(_CHUNK)
+                await writer.drain()
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, OSError, ValueError, IndexError,
+            asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    finally:
+        writer.close()
+
+async def handle_connect(reader, writer):
+    """HTTP CONNECT proxy, credentials are not checked."""
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        method, target = request.split(b" ", 2)[:2]
+        if method != b"CONNECT":
+            raise ValueError(method)
+        host, port = target.rsplit(b":", 1)
+        up_reader, up_writer = await asyncio.open_connection(
+            host.strip(b"[]").decode(), int(port))
+    except (ConnectionError, OSError, ValueError,
+            asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.write(b"HTTP/1.1 502 Bad Gateway\r\n\r\n")
+        writer.close()
+        return
+    writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+    await _relay(reader, writer, up_reader, up_writer)
+
+class _H2ConnectProxy(object):
+    """Serve CONNECT streams over an HTTP/2 connection."""
+
+    def __init__(self, reader, writer):
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+        from h2.settings import SettingCodes
+        self.reader = reader
+        self.writer = writer
+        self.conn = H2Connection(H2Configuration(client_side=False,
+                                                 header_encoding="latin-1"))
+        self.conn.initiate_connection()
+        self.conn.update_settings({SettingCodes.INITIAL_WINDOW_SIZE: 1 << 22})
+        self.conn.increment_flow_control_window(1 << 25)
+        self.upstreams = {}
+        # The data received before the upstream is connected
+        self.pending = {}
+        self.tasks = set()
+        self.window_waiters = []
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.writer.write(data)
+
+    async def run(self):
+        from h2.events import ConnectionTerminated, DataReceived, \
+                              RequestReceived, StreamEnded, StreamReset, \
+                              WindowUpdated
+        self.flush()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for event in self.conn.receive_data(data):
+                    if isinstance(event, RequestReceived):
+                        self.pending[event.stream_id] = []
+                        task = asyncio.ensure_future(self.open_stream(
+                                event.stream_id, dict(event.headers)))
+                        self.tasks.add(task)
+                        task.add_done_callback(self.tasks.discard)
+                    elif isinstance(event, DataReceived):
+                        upstream = self.upstreams.get(event.stream_id)
+                        if upstream is not None:
+                            upstream.write(event.data)
+                        elif event.stream_id in self.pending:
+                            self.pending[event.stream_id].append(event.data)
+                        self.conn.acknowledge_received_data(
+                                event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, StreamEnded):
+                        upstream = self.upstreams.get(event.stream_id)
+                        if upstream is not None and upstream.can_write_eof():
+                            upstream.write_eof()
+                    elif isinstance(event, StreamReset):
+                        upstream = self.upstreams.pop(event.stream_id, None)
+                        if upstream is not None:
+                            upstream.close()
+                    elif isinstance(event, WindowUpdated):
+                        self.wake_window_waiters()
+                    elif isinstance(event, ConnectionTerminated):
+                        return
+                self.flush()
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for upstream in self.upstreams.values():
+                upstream.close()
+            self.wake_window_waiters()
+            self.writer.close()
+
+    def wake_window_waiters(self):
+        for waiter in self.window_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        del self.window_waiters[:]
+
+    async def open_stream(self, stream_id, headers):
+        from h2.errors import ErrorCodes
+        auth = headers.get("proxy-authorization", "").partition(" ")[2]
+        if base64.b64decode(auth).startswith(b"refuse:"):
+            # Used to test the retrying of refused streams
+            self.pending.pop(stream_id, None)
+            self.conn.reset_stream(stream_id, ErrorCodes.REFUSED_STREAM)
+            self.flush()
+            return
+        try:
+            if headers[":method"] != "CONNECT":
+                raise ValueError(headers[":method"])
+            host, port = headers[":authority"].rsplit(":", 1)
+            up_reader, up_writer = await asyncio.open_connection(
+                host.strip("[]"), int(port))
+        except (ConnectionError, OSError, ValueError, KeyError):
+            self.pending.pop(stream_id, None)
+            self.conn.send_headers(stream_id, [(":status", "502")],
+                                   end_stream=True)
+            self.flush()
+            return
+        self.upstreams[stream_id] = up_writer
+        for data in self.pending.pop(stream_id, ()):
+            up_writer.write(data)
+        self.conn.send_headers(stream_id, [(":status", "200")])
+        self.flush()
+        await self.pump(stream_id, up_reader)
+
+    async def pump(self, stream_id, up_reader):
+        from h2.exceptions import ProtocolError
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                data = await up_reader.read(65536)
+                if not data:
+                    self.conn.end_stream(stream_id)
+                    self.flush()
+                    break
+                while data:
+                    window = self.conn.local_flow_control_window(stream_id)
+                    if window <= 0:
+                        waiter = loop.create_future()
+                        self.window_waiters.append(waiter)
+                        await waiter
+                        continue
+                    size = min(window, len(data),
+                               self.conn.max_outbound_frame_size)
+                    self.conn.send_data(stream_id, data[:size])
+                    data = data[size:]
+                    self.flush()
+                    await self.writer.drain()
+        except (ConnectionError, OSError, ProtocolError):
+            pass
+        finally:
+            upstream = self.upstreams.pop(stream_id, None)
+            if upstream is not None:
+                upstream.close()
+
+async def handle_h2_connect(reader, writer):
+    """HTTP CONNECT proxy over HTTP/2 if it is selected by ALPN, else over
+    HTTP/1.1."""
+    ssl_object = writer.get_extra_info("ssl_object")
+    if ssl_object.selected_alpn_protocol() != "h2":
+        await handle_connect(reader, writer)
+        return
+    await _H2ConnectProxy(reader, writer).run()
+
+async def _read_socks4_string(reader):
+    return (await reader.readuntil(b"\x00"))[:-1]
+
+async def handle_socks(reader, writer, auth=True):
+    """SOCKS4/4a/5 proxy, accepts any or no username/password, or if not
+    `auth`, only no authentication."""
+    try:
+        version = (await reader.readexactly(1))[0]
+        if version == 4:
+            _, port = struct.unpack(">BH", await reader.readexactly(3))
+            addr = await reader.readexactly(4)
+            await _read_socks4_string(reader)
+            if addr[:3] == b"\x00\x00\x00" and addr[3:] != b"\x00":
+                host = (await _read_socks4_string(reader)).decode("idna")
+            else:
+                host = socket.inet_ntoa(addr)
+            up_reader, up_writer = await asyncio.open_connection(host, port)
+            writer.write(b"\x00\x5a" + b"\x00" * 6)
+        elif version == 5:
+            count = (await reader.readexactly(1))[0]
+            methods = await reader.readexactly(count)
+            if auth and 2 in methods:
+                writer.write(b"\x05\x02")
+                await reader.readexactly(1)
+                await reader.readexactly((await reader.readexactly(1))[0])
+                await reader.readexactly((await reader.readexactly(1))[0])
+                writer.write(b"\x01\x00")
+            elif 0 in methods:
+                writer.write(b"\x05\x00")
+            else:
+                writer.write(b"\x05\xff")
+                raise ValueError(methods)
+            _, _, _, atyp = await reader.readexactly(4)
+            if atyp == 1:
+                host = socket.inet_ntoa(await reader.readexactly(4))
+            elif atyp == 3:
+                length = (await reader.readexactly(1))[0]
+                host = (await reader.readexactly(length)).decode("idna")
+            else:
+                host = socket.inet_ntop(socket.AF_INET6,
+                                        await reader.readexactly(16))
+            port = struct.unpack(">H", await reader.readexactly(2))[0]
+            up_reader, up_writer = await asyncio.open_connection(host, port)
+            writer.write(b"\x05\x00\x00\x01" + b"\x00" * 6)
+        else:
+            raise ValueError(version)
+    except (ConnectionError, OSError, ValueError,
+            asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        writer.close()
+        return
+    await _relay(reader, writer, up_reader, up_writer)
+
+
+async def _start_servers(unix_dir=None):
+    context = server_context()
+    if unix_dir is not None:
+        await asyncio.start_unix_server(
+            handle_connect, os.path.join(unix_dir, "https.sock"),
+            ssl=context)
+        await asyncio.start_unix_server(
+            handle_socks, os.path.join(unix_dir, "socks.sock"))
+    servers = {
+        "origin": await asyncio.start_server(handle_origin, "127.0.0.1", 0,
+                                             ssl=context, backlog=4096),
+        "https": await asyncio.start_server(handle_connect, "127.0.0.1", 0,
+                                            ssl=context, backlog=4096),
+        "socks": await asyncio.start_server(handle_socks, "127.0.0.1", 0,
+                                            backlog=4096),
+        "socks_noauth": await asyncio.start_server(
+            functools.partial(handle_socks, auth=False), "127.0.0.1", 0)
+    }
+    try:
+        import h2
+    except ImportError:
+        pass
+    else:
+        servers["h2"] = await asyncio.start_server(
+            handle_h2_connect, "127.0.0.1", 0, ssl=h2_server_context(),
+            backlog=4096)
+    return dict((name, server.sockets[0].getsockname()[1])
+                for name, server in servers.items())
+
+def _serve(callback, unix_dir=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    callback(loop.run_until_complete(_start_servers(unix_dir)))
+    loop.run_forever()
+
+def _serve_process(conn, unix_dir):
+    _serve(conn.send, unix_dir)
+
+
+class StandIns(object):
+    """Start the stand-ins, `ports` maps "origin", "https", "socks",
+    "socks_noauth" (a SOCKS proxy without authentication) and "h2" (if the
+    package h2 is installed) to their ports.
+
+    process
+        Run the servers in a child process instead of a thread.
+    unix_dir
+        A directory in which the HTTPS and SOCKS proxies listen on
+        "https.sock" and "socks.sock" too.
+    """
+
+    def __init__(self, process=False, unix_dir=None):
+        self._process = None
+        if process:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            self._process = multiprocessing.Process(target=_serve_process,
+                                                    args=(child_conn,
+                                                          unix_dir))
+            self._process.daemon = True
+            self._process.start()
+            self.ports = parent_conn.recv()
+        else:
+            ready = threading.Event()
+            result = []
+
+            def callback(ports):
+                result.append(ports)
+                ready.set()
+
+            thread = threading.Thread(target=_serve,
+                                      args=(callback, unix_dir),
+                                      name="standins")
+            thread.daemon = True
+            thread.start()
+            ready.wait()
+            self.ports = result[0]
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from extproxy.aio import open_connection
+from extproxy.tunnel import TunnelError
+
+from .standins import client_context
+
+
+def _get(proxy, port, size):
+    async def get():
+        reader, writer = await open_connection(
+            "localhost", port, proxy=proxy, ssl=client_context())
+        try:
+            writer.write(b"GET /%d HTTP/1.1\r\nHost: localhost\r\n"
+                         b"Connection: close\r\n\r\n" % size)
+            return await reader.read()
+        finally:
+            writer.close()
+    return asyncio.run(get())
+
+@pytest.mark.parametrize("scheme", ["socks4", "socks4a", "socks5",
+                                    "socks5h"])
+def test_socks(standins, scheme):
+    proxy = "%s://127.0.0.1:%d" % (scheme, standins.ports["socks"])
+    response = _get(proxy, standins.ports["origin"], 1000)
+    assert response.startswith(b"HTTP/1.1 200")
+    assert response.endswith(b"x" * 1000)
+
+def test_socks5_auth(standins):
+    proxy = "socks5://id:pw@127.0.0.1:%d" % standins.ports["socks"]
+    assert _get(proxy, standins.ports["origin"], 10).endswith(b"x" * 10)
+
+def test_https(standins, https_proxy):
+    response = _get(https_proxy, standins.ports["origin"], 300000)
+    assert response.endswith(b"x" * 300000)
+
+def test_refused_connect(standins, https_proxy):
+    with pytest.raises(TunnelError) as excinfo:
+        _get(https_proxy, 1, 10)
+    assert excinfo.value.status == 502
+
+def test_socks5_no_auth(standins):
+    # Credentials are offered along with no authentication, which is chosen
+    proxy = "socks5://id:pw@127.0.0.1:%d" % standins.ports["socks_noauth"]
+    assert _get(proxy, standins.ports["origin"], 10).endswith(b"x" * 10)
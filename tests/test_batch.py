@@ -0,0 +1,25 @@
+from extproxy.batch import fetch_many
+
+from .helpers import dead_port
+from .standins import client_context
+
+
+def test_fetch_many(standins, origin_url, socks_proxy, https_proxy):
+    urls = [origin_url + str(size) for size in range(0, 2000, 100)]
+    results = list(fetch_many(urls, [socks_proxy, https_proxy],
+                              concurrency=4, per_proxy_limit=2,
+                              context=client_context()))
+    assert sorted(result.url for result in results) == sorted(urls)
+    for result in results:
+        assert result.error is None
+        assert result.status == 200
+        assert len(result.body) == int(result.url.rpartition("/")[2])
+        assert result.proxy in (socks_proxy, https_proxy)
+
+def test_errors(standins, origin_url, socks_proxy):
+    url = "https://localhost:%d/" % dead_port()
+    results = list(fetch_many([url, origin_url + "10"], socks_proxy,
+                              timeout=5, context=client_context()))
+    errors = dict((result.url, result.error) for result in results)
+    assert errors[url] is not None
+    assert errors[origin_url + "10"] is None
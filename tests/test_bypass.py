@@ -0,0 +1,33 @@
+import pytest
+
+from extproxy.bypass import BypassMatcher, ProxyBypass
+
+
+@pytest.mark.parametrize("host, bypass", [
+    ("example.com", True),
+    ("www.example.com", True),
+    ("www.example.com:8080", True),
+    ("badexample.com", False),
+    ("example.org", False),
+    ("localhost", True),
+    ("10.1.2.3", True),
+    ("11.1.2.3", False),
+    ("[::1]", True),
+    ("[::2]", False),
+])
+def test_matcher(host, bypass):
+    matcher = BypassMatcher("example.com, .localhost, 10.0.0.0/8, ::1")
+    assert bool(matcher(host)) is bypass
+
+def test_matcher_all():
+    assert BypassMatcher("*")("example.com")
+
+def test_env_change(monkeypatch):
+    bypass = ProxyBypass()
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    monkeypatch.setenv("no_proxy", "example.com")
+    assert bypass("www.example.com")
+    assert not bypass("example.org")
+    monkeypatch.setenv("no_proxy", "example.org")
+    assert not bypass("www.example.com")
+    assert bypass("example.org")
@@ -0,0 +1,31 @@
+import time
+
+from extproxy.capabilities import CapabilityStore
+
+
+def test_get_set():
+    store = CapabilityStore()
+    assert store.get("p", "rdns") is None
+    assert store.get("p", "rdns", True) is True
+    store.set("p", "rdns", False)
+    assert store.get("p", "rdns") is False
+    store.discard("p", "rdns")
+    assert store.get("p", "rdns") is None
+
+def test_ttl():
+    store = CapabilityStore()
+    store.set("p", "rdns", True, ttl=-1)
+    assert store.get("p", "rdns") is None
+    assert store.items() == {"p": {}}
+
+def test_save_load(tmp_path):
+    path = str(tmp_path / "capabilities.json")
+    store = CapabilityStore()
+    store.set("p", "auth_method", 2)
+    store.set("p", "rdns", True, ttl=-1)
+    store.save(path)
+    loaded = CapabilityStore()
+    loaded.load(path)
+    assert loaded.items() == {"p": {"auth_method": 2}}
+    assert loaded.get("p", "auth_method") == 2
+    assert loaded._items["p"]["auth_method"][1] > time.time()
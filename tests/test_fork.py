@@ -0,0 +1,60 @@
+import os
+import threading
+
+import pytest
+
+import extproxy
+
+from .helpers import fetch
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"),
+                                reason="requires os.fork")
+
+
+def test_child(standins, origin_url, socks_proxy, https_proxy):
+    extproxy.enable_forwarder()
+    extproxy.set_proxy_limits(https_proxy, max_tunnels=1)
+    try:
+        fetch(https_proxy, origin_url + "10")
+        extproxy.prefork()
+        pid = os.fork()
+        if pid == 0:
+            status = 2
+            try:
+                sizes = [len(fetch(proxy, origin_url + "300000"))
+                         for proxy in (socks_proxy, https_proxy)]
+                status = 0 if sizes == [300000] * 2 else 1
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        # The parent keeps working
+        assert fetch(https_proxy, origin_url + "10") == b"x" * 10
+    finally:
+        extproxy.set_proxy_limits(https_proxy)
+        extproxy.disable_forwarder()
+
+def test_child_lazy(standins, origin_url, https_proxy):
+    from extproxy import forwarder, pool
+    extproxy.enable_forwarder()
+    extproxy.set_warm_pool(https_proxy, size=1)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            status = 2
+            try:
+                # No threads are started by the hooks, the forwarder and the
+                # warm pool are started again on first use
+                ok = (threading.active_count() == 1 and
+                      forwarder._forwarder is None and not pool._warm_pools)
+                ok = ok and len(fetch(https_proxy, origin_url + "10")) == 10
+                ok = ok and forwarder._forwarder is not None and \
+                     len(pool._warm_pools) == 1
+                status = 0 if ok else 1
+            finally:
+                os._exit(status)
+        _, status = os.waitpid(pid, 0)
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    finally:
+        extproxy.remove_warm_pool(https_proxy)
+        extproxy.disable_forwarder()
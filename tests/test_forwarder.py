@@ -0,0 +1,63 @@
+import pytest
+
+import extproxy
+from extproxy.forwarder import BufferPool, TimerWheel
+
+from .helpers import fetch, wait_for
+
+
+class _Entry(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+
+def test_timer_wheel_expires_passed_deadlines():
+    wheel = TimerWheel(1, slots=8)
+    now = wheel._current * 1.0
+    soon, later = _Entry(now + 2), _Entry(now + 20)
+    wheel.schedule(soon, soon.deadline)
+    wheel.schedule(later, later.deadline)
+    assert wheel.advance(now + 1) == []
+    assert wheel.advance(now + 3) == [soon]
+    # Rescheduled around the wheel until its deadline
+    assert wheel.advance(now + 19) == []
+    assert wheel.advance(now + 21) == [later]
+
+def test_timer_wheel_refreshed_deadline():
+    wheel = TimerWheel(1, slots=8)
+    now = wheel._current * 1.0
+    entry = _Entry(now + 2)
+    wheel.schedule(entry, entry.deadline)
+    entry.deadline = now + 5
+    assert wheel.advance(now + 3) == []
+    assert wheel.advance(now + 6) == [entry]
+
+def test_timer_wheel_discard():
+    wheel = TimerWheel(1)
+    now = wheel._current * 1.0
+    entry = _Entry(now + 2)
+    wheel.schedule(entry, entry.deadline)
+    wheel.discard(entry)
+    assert wheel.advance(now + 10) == []
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool(16, maxfree=1)
+    first, second = pool.acquire(), pool.acquire()
+    assert len(first) == 16
+    pool.release(first)
+    # Over maxfree, dropped
+    pool.release(second)
+    assert pool.acquire() is first
+    assert pool.acquire() is not second
+
+@pytest.fixture
+def forwarder():
+    extproxy.enable_forwarder(shards=2)
+    yield
+    extproxy.disable_forwarder()
+
+def test_forwarder_tunnels(forwarder, https_proxy, origin_url):
+    for size in (0, 100, 1 << 20):
+        assert len(fetch(https_proxy, origin_url + str(size))) == size
+    # The closed tunnels are dropped by the event loops
+    assert wait_for(lambda: extproxy.active_tunnels() == 0)
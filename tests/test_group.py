@@ -0,0 +1,59 @@
+from urllib.error import URLError
+
+import pytest
+
+import extproxy
+from extproxy.group import _is_destination_error
+from extproxy.socks_client import SOCKS5Error
+from extproxy.tunnel import TunnelError
+
+from .helpers import dead_port, fetch
+
+
+def test_failover(standins, origin_url, socks_proxy):
+    dead = "socks5://127.0.0.1:%d" % dead_port()
+    group = extproxy.ProxyGroup([dead, socks_proxy], failure_threshold=1)
+    # The dead proxy is tried first, while no latency is measured
+    group.members.sort(key=lambda member: member.proxy.url != dead)
+    assert fetch(group, origin_url + "10") == b"x" * 10
+    stats = group.stats()
+    assert stats[dead]["down"] is True
+    assert stats[dead]["failures"] == 1
+    assert stats[socks_proxy]["down"] is False
+    assert stats[socks_proxy]["latency"] is not None
+    # A down proxy is not selected again until recovery
+    assert fetch(group, origin_url + "10") == b"x" * 10
+    assert group.stats()[dead]["failures"] == 1
+
+def test_hedged(standins, origin_url, socks_proxy, https_proxy):
+    group = extproxy.ProxyGroup([socks_proxy, https_proxy], hedge_delay=0)
+    for size in (10, 300000):
+        assert len(fetch(group, origin_url + str(size))) == size
+
+def test_proxy_error_is_failure(https_proxy):
+    group = extproxy.ProxyGroup([https_proxy], failure_threshold=1)
+    # The stand-in responds 502 Bad Gateway
+    with pytest.raises(URLError, match="502"):
+        fetch(group, "https://localhost:%d/" % dead_port())
+    assert group.stats()[https_proxy]["down"] is True
+
+@pytest.mark.parametrize("error, destination", [
+    (TunnelError(403, "Forbidden"), True),
+    (TunnelError(404, "Not Found"), True),
+    (TunnelError(407, "Proxy Authentication Required"), False),
+    (TunnelError(502, "Bad Gateway"), False),
+    (TunnelError(503, "Service Unavailable"), False),
+    (SOCKS5Error(0x04), True),
+    (SOCKS5Error(0x01), False),
+])
+def test_destination_error(error, destination):
+    assert _is_destination_error(error) is destination
+
+def test_all_down(origin_url):
+    group = extproxy.ProxyGroup(["socks5://127.0.0.1:%d" % dead_port()])
+    with pytest.raises(URLError):
+        fetch(group, origin_url + "10", timeout=2)
+
+def test_empty():
+    with pytest.raises(ValueError):
+        extproxy.ProxyGroup([])
@@ -0,0 +1,105 @@
+import select
+import socket
+import time
+
+import pytest
+
+from extproxy import happy_eyeballs
+from extproxy.capabilities import proxy_capabilities
+from extproxy.happy_eyeballs import create_connection, sort_addrinfos
+
+from .helpers import dead_port
+
+
+def _info(family, host, port):
+    return family, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (host, port)
+
+@pytest.fixture
+def listener():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(8)
+    yield sock
+    sock.close()
+
+@pytest.fixture
+def attempts(monkeypatch):
+    """The families of the started connection attempts."""
+    families = []
+    start_connect = happy_eyeballs._start_connect
+
+    def _start_connect(info, *args):
+        families.append(info[0])
+        return start_connect(info, *args)
+
+    monkeypatch.setattr(happy_eyeballs, "_start_connect", _start_connect)
+    return families
+
+def _resolve_to(monkeypatch, infos):
+    monkeypatch.setattr(happy_eyeballs, "getaddrinfo",
+                        lambda *args: list(infos))
+
+def test_sort_addrinfos_interleaves_families():
+    v6 = [_info(socket.AF_INET6, "::%d" % i, 80) for i in (1, 2)]
+    v4 = [_info(socket.AF_INET, "10.0.0.%d" % i, 80) for i in (1, 2, 3)]
+    infos = v6 + v4
+    assert sort_addrinfos(infos) == [v6[0], v4[0], v6[1], v4[1], v4[2]]
+    assert sort_addrinfos(infos, socket.AF_INET) == \
+           [v4[0], v6[0], v4[1], v6[1], v4[2]]
+
+def test_unreachable_first_address(monkeypatch, listener, attempts):
+    port = listener.getsockname()[1]
+    _resolve_to(monkeypatch, [_info(socket.AF_INET, "127.0.0.1", dead_port()),
+                              _info(socket.AF_INET, "127.0.0.1", port)])
+    sock = create_connection(("proxy.test", port), 5)
+    try:
+        assert sock.getpeername() == ("127.0.0.1", port)
+    finally:
+        sock.close()
+    assert len(attempts) == 2
+
+def _connect_nowait(address):
+    sock = socket.socket()
+    sock.setblocking(False)
+    sock.connect_ex(address)
+    return sock
+
+def test_connection_attempt_delay(monkeypatch, listener):
+    # The accept queue of a listener with backlog 0 is full after one
+    # connection, then the SYNs are dropped and the connects hang
+    blackhole = socket.socket()
+    blackhole.bind(("127.0.0.1", 0))
+    blackhole.listen(0)
+    address = blackhole.getsockname()
+    queued = [_connect_nowait(address) for _ in range(2)]
+    port = listener.getsockname()[1]
+    _resolve_to(monkeypatch, [_info(socket.AF_INET, "127.0.0.1", address[1]),
+                              _info(socket.AF_INET, "127.0.0.1", port)])
+    try:
+        if select.select([], queued[1:], [], 0.1)[1]:
+            pytest.skip("the connects to a full accept queue do not hang")
+        start = time.time()
+        sock = create_connection(("proxy.test", port), 5)
+        elapsed = time.time() - start
+        sock.close()
+    finally:
+        for sock in queued:
+            sock.close()
+        blackhole.close()
+    assert happy_eyeballs.CONNECTION_ATTEMPT_DELAY <= elapsed < 1
+
+@pytest.mark.skipif(not socket.has_ipv6, reason="no IPv6")
+def test_remember_winning_family(monkeypatch, listener, attempts):
+    key = "proxy.test:%d" % id(attempts)
+    port = listener.getsockname()[1]
+    _resolve_to(monkeypatch, [_info(socket.AF_INET6, "::1", dead_port()),
+                              _info(socket.AF_INET, "127.0.0.1", port)])
+    try:
+        for _ in range(2):
+            create_connection(("proxy.test", port), 5, key=key).close()
+        assert proxy_capabilities.get(key, "address_family") == \
+               socket.AF_INET
+    finally:
+        proxy_capabilities.discard(key, "address_family")
+    # The second connection tries IPv4 first
+    assert attempts == [socket.AF_INET6, socket.AF_INET, socket.AF_INET]
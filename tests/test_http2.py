@@ -0,0 +1,88 @@
+import threading
+from urllib.error import HTTPError, URLError
+
+import pytest
+
+import extproxy
+from extproxy.proxy_info import get_proxy_info
+from extproxy.tunnel import TunnelError
+
+from .helpers import fetch
+from .standins import CERTFILE, client_context
+
+pytest.importorskip("h2")
+
+
+@pytest.fixture
+def h2_proxy(standins, request):
+    proxy = "https://t%d:x@127.0.0.1:%d" % (id(request.node),
+                                          standins.ports["h2"])
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, http2=True)
+    return proxy
+
+def test_multiplexing(standins, origin_url, h2_proxy):
+    from extproxy import http2
+    results = []
+    def worker():
+        for _ in range(4):
+            results.append(len(fetch(h2_proxy, origin_url + "1000")))
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert results == [1000] * 32
+    assert len(fetch(h2_proxy, origin_url + str(1 << 20))) == 1 << 20
+    # The streams share a few connections
+    pool = http2._pools[get_proxy_info(h2_proxy).normal_netloc]
+    assert 1 <= len(pool.conns) <= http2.MAX_CONNECTIONS
+
+def test_refused_stream_fallback(standins, origin_url):
+    # The stand-in refuses the streams of user "refuse"
+    proxy = "https://refuse:x@127.0.0.1:%d" % standins.ports["h2"]
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, http2=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_refused_stream_optimistic(standins, origin_url):
+    proxy = "https://refuse:y@127.0.0.1:%d" % standins.ports["h2"]
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, http2=True,
+                             optimistic=True)
+    with pytest.raises(URLError):
+        fetch(proxy, origin_url + "10")
+
+def test_given_context(standins, origin_url):
+    from extproxy import http2
+    proxy = "https://context:x@127.0.0.1:%d" % standins.ports["h2"]
+    extproxy.set_https_proxy(proxy, context=client_context(), http2=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+    assert get_proxy_info(proxy).normal_netloc in http2._pools
+    # Plain HTTP requests are sent over HTTP/1.1, the given context does not
+    # offer "h2", the stand-in responds 502 to anything but CONNECT
+    with pytest.raises(HTTPError) as info:
+        fetch(proxy, "http://localhost:%d/10" % standins.ports["origin"])
+    assert info.value.code == 502
+
+def test_given_context_refused_stream(standins, origin_url):
+    proxy = "https://refuse:z@127.0.0.1:%d" % standins.ports["h2"]
+    extproxy.set_https_proxy(proxy, context=client_context(), http2=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_not_negotiated(standins, origin_url):
+    # A proxy which does not negotiate h2 is used with HTTP/1.1
+    proxy = "https://h1:x@127.0.0.1:%d" % standins.ports["https"]
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, http2=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_refused_connect(standins, h2_proxy):
+    with pytest.raises(URLError, match="502"):
+        fetch(h2_proxy, "https://localhost:1/")
+
+def test_refused_connect_optimistic(standins, origin_url):
+    proxy = "https://optimistic:x@127.0.0.1:%d" % standins.ports["h2"]
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, http2=True,
+                             optimistic=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+    with pytest.raises(URLError) as info:
+        fetch(proxy, "https://localhost:1/")
+    assert isinstance(info.value.reason, TunnelError)
+    assert info.value.reason.status == 502
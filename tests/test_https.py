@@ -0,0 +1,72 @@
+import ssl
+from urllib.error import URLError
+
+import pytest
+
+import extproxy
+from extproxy import https
+from extproxy.proxy_info import get_proxy_info
+from extproxy.tunnel import TunnelError
+
+from .helpers import fetch, wait_for
+from .standins import CERTFILE, client_context
+
+
+def _netloc(proxy):
+    return proxy.partition("://")[2]
+
+def test_context_is_cached(https_proxy, origin_url):
+    fetch(https_proxy, origin_url + "10")
+    context = https._https_proxy_ssl_contexts[_netloc(https_proxy)]
+    fetch(https_proxy, origin_url + "10")
+    assert https._https_proxy_ssl_contexts[_netloc(https_proxy)] is context
+
+def test_set_https_proxy_rebuilds_context(https_proxy, origin_url):
+    fetch(https_proxy, origin_url + "10")
+    extproxy.set_https_proxy(https_proxy, cafile=CERTFILE)
+    assert _netloc(https_proxy) not in https._https_proxy_ssl_contexts
+    assert get_proxy_info(https_proxy).context is None
+
+def test_proxy_session_resumption(https_proxy, origin_url):
+    netloc = _netloc(https_proxy)
+    fetch(https_proxy, origin_url + "10")
+    # The session is stored when the tunnel is closed by its forwarder
+    assert wait_for(lambda: netloc in https._https_proxy_sessions)
+    for _ in range(2):
+        fetch(https_proxy, origin_url + "10")
+    stats = extproxy.https_proxy_session_stats()
+    assert stats[netloc]["misses"] == 1
+    assert stats[netloc]["hits"] == 2
+
+def test_given_context_is_not_changed(standins, origin_url):
+    proxy = "https://given:x@127.0.0.1:%d" % standins.ports["https"]
+    context = client_context()
+    extproxy.set_https_proxy(proxy, context=context)
+    fetch(proxy, origin_url + "10")
+    assert context.sslsocket_class is ssl.SSLSocket
+    assert wait_for(lambda: _netloc(proxy) in https._https_proxy_sessions)
+    fetch(proxy, origin_url + "10")
+    assert extproxy.https_proxy_session_stats()[_netloc(proxy)]["hits"] == 1
+
+def test_refused_connect(https_proxy):
+    # Raised by http.client
+    with pytest.raises(URLError, match="502 Bad Gateway"):
+        fetch(https_proxy, "https://localhost:1/")
+
+@pytest.mark.parametrize("fast_open", [False, True])
+def test_optimistic_connect(standins, origin_url, fast_open):
+    proxy = "https://opt%d:x@127.0.0.1:%d" % (fast_open,
+                                             standins.ports["https"])
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, fast_open=fast_open,
+                             optimistic=True)
+    for size in (10, 300000):
+        assert len(fetch(proxy, origin_url + str(size))) == size
+
+def test_optimistic_connect_refused(standins):
+    proxy = "https://optref:x@127.0.0.1:%d" % standins.ports["https"]
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, optimistic=True)
+    # The response is read before the handshake with destination
+    with pytest.raises(URLError) as excinfo:
+        fetch(proxy, "https://localhost:1/")
+    assert isinstance(excinfo.value.reason, TunnelError)
+    assert excinfo.value.reason.status == 502
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from bench_import import LAZY_MODULES
+
+
+def _imported(code, **env):
+    environ = dict(os.environ, PYTHONPATH=ROOT)
+    environ.pop("EXTPROXY_DEFER_PATCH", None)
+    environ.update(env)
+    output = subprocess.check_output(
+            [sys.executable, "-c", code + "; import sys; "
+             "print('\\n'.join(sys.modules))"], env=environ)
+    return set(output.decode().split())
+
+def test_lazy_modules():
+    modules = _imported("import extproxy")
+    assert "urllib.request" in modules
+    assert not modules.intersection(LAZY_MODULES)
+
+def test_deferred_patch():
+    modules = _imported("import extproxy", EXTPROXY_DEFER_PATCH="1")
+    assert "extproxy.extra" not in modules
+    modules = _imported("import extproxy; import urllib.request",
+                        EXTPROXY_DEFER_PATCH="1")
+    assert "extproxy.extra" in modules
+
+def test_lazy_fetch_many():
+    modules = _imported("import extproxy; extproxy.fetch_many")
+    assert "extproxy.batch" not in modules
+    assert "concurrent.futures" not in modules
@@ -0,0 +1,23 @@
+from extproxy.keepalive import ConnectionPool, KeepAliveHTTPSHandler
+
+from .helpers import fetch
+from .standins import client_context
+
+
+def test_reuse(standins, origin_url, socks_proxy, https_proxy):
+    for proxy in (socks_proxy, https_proxy):
+        pool = ConnectionPool()
+        handler = KeepAliveHTTPSHandler(context=client_context(), pool=pool)
+        for size in (10, 300000, 10):
+            assert len(fetch(proxy, origin_url + str(size),
+                             handler=handler)) == size
+        assert pool.stats() == {"idle": 1, "hits": 2, "misses": 1}
+        pool.clear()
+        assert len(pool) == 0
+
+def test_max_idle(standins, origin_url, socks_proxy):
+    pool = ConnectionPool(max_idle=0)
+    handler = KeepAliveHTTPSHandler(context=client_context(), pool=pool)
+    for _ in range(2):
+        fetch(socks_proxy, origin_url + "10", handler=handler)
+    assert pool.stats()["hits"] == 0
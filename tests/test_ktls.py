@@ -0,0 +1,115 @@
+import os
+import socket
+import ssl
+import threading
+
+import pytest
+
+import extproxy
+from extproxy import ktls
+from extproxy.forwarder import Forwarder
+
+from .helpers import fetch
+from .standins import client_context
+
+needs_ktls = pytest.mark.skipif(not ktls.supported,
+                                reason="kTLS is not supported")
+needs_splice = pytest.mark.skipif(not hasattr(os, "splice"),
+                                  reason="os.splice is not available")
+
+
+@needs_ktls
+def test_set_context_option(monkeypatch):
+    context = ssl.create_default_context()
+    ktls.set_context_option(context)
+    assert context.options & ktls.OP_ENABLE_KTLS
+    monkeypatch.setattr(ktls, "enabled", False)
+    ktls.set_context_option(context)
+    assert not context.options & ktls.OP_ENABLE_KTLS
+
+@needs_ktls
+def test_given_context_is_not_changed(standins, origin_url):
+    proxy = "https://ktls:x@127.0.0.1:%d" % standins.ports["https"]
+    context = client_context()
+    options = context.options
+    extproxy.set_https_proxy(proxy, context=context)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+    assert context.options == options
+
+@pytest.mark.skipif(ktls.supported, reason="kTLS is supported")
+def test_set_context_option_unsupported():
+    context = ssl.create_default_context()
+    options = context.options
+    ktls.set_context_option(context)
+    assert context.options == options
+    assert extproxy.set_ktls(True) is False
+    assert ktls.enabled is False
+
+def test_fallback(https_proxy, origin_url):
+    supported = extproxy.set_ktls(True)
+    try:
+        assert len(fetch(https_proxy, origin_url + "100000")) == 100000
+    finally:
+        extproxy.set_ktls(supported)
+
+@needs_splice
+def test_splice_pipe():
+    a, b = socket.socketpair()
+    c, d = socket.socketpair()
+    pipe = ktls.SplicePipe()
+    try:
+        a.sendall(b"spliced")
+        assert pipe.splice_from(b, 1024) == 7
+        assert pipe.pending == 7
+        assert pipe.splice_to(c) == 7
+        assert pipe.pending == 0
+        assert d.recv(1024) == b"spliced"
+    finally:
+        pipe.close()
+        for sock in (a, b, c, d):
+            sock.close()
+
+def _recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+@needs_splice
+def test_forwarder_splice(monkeypatch):
+    # Plain sockets stand in for offloaded connections, os.splice moves
+    # their data in both directions
+    monkeypatch.setattr(ktls, "offloaded", lambda sock: (True, True))
+    spliced = []
+    splice_from = ktls.SplicePipe.splice_from
+
+    def count_splice_from(pipe, sock, size):
+        ndata = splice_from(pipe, sock, size)
+        spliced.append(ndata)
+        return ndata
+
+    monkeypatch.setattr(ktls.SplicePipe, "splice_from", count_splice_from)
+    client, local = socket.socketpair()
+    remote, server = socket.socketpair()
+    for sock in (client, server):
+        sock.settimeout(5)
+    forwarder = Forwarder()
+    try:
+        forwarder.register(local, remote)
+        data = os.urandom(1 << 20)
+        client.sendall(b"request")
+        assert _recv_exactly(server, 7) == b"request"
+        sender = threading.Thread(target=server.sendall, args=(data,))
+        sender.start()
+        assert _recv_exactly(client, len(data)) == data
+        sender.join()
+        server.close()
+        # Closed by the remote side
+        assert client.recv(1) == b""
+        assert sum(spliced) == 7 + len(data)
+    finally:
+        forwarder.stop()
+        client.close()
+        server.close()
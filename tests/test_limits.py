@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import extproxy
+from extproxy.limits import TokenBucket, TunnelLimitError
+from extproxy.proxy_info import get_proxy_info
+
+from .helpers import fetch, wait_for
+from .standins import CERTFILE, client_context
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1000, 100)
+    assert bucket.consume(100) == 0
+    assert bucket.consume(100) > 0
+
+def _stats(proxy):
+    return extproxy.proxy_limits_stats()[get_proxy_info(proxy).key]
+
+def test_max_tunnels(standins, origin_url, socks_proxy):
+    proxy = socks_proxy.replace("://", "://limits:x@")
+    extproxy.set_proxy_limits(proxy, max_tunnels=1, max_waiting=0)
+    try:
+        for _ in range(3):
+            assert fetch(proxy, origin_url + "10") == b"x" * 10
+        assert wait_for(lambda: _stats(proxy)["active"] == 0)
+    finally:
+        extproxy.set_proxy_limits(proxy)
+
+def test_wait_timeout(standins, origin_url, socks_proxy):
+    proxy = socks_proxy.replace("://", "://timeout:x@")
+    extproxy.set_proxy_limits(proxy, max_tunnels=0, wait_timeout=0.1)
+    try:
+        with pytest.raises(Exception) as info:
+            fetch(proxy, origin_url + "10")
+        assert "timed out waiting" in str(info.value)
+        assert _stats(proxy)["rejected"] == 1
+        # Raising the cap wakes up the waiting connections
+        result = []
+        extproxy.set_proxy_limits(proxy, max_tunnels=0)
+        thread = threading.Thread(target=lambda: result.append(
+                fetch(proxy, origin_url + "10")))
+        thread.start()
+        assert wait_for(lambda: _stats(proxy)["waiting"] == 1)
+        extproxy.set_proxy_limits(proxy, max_tunnels=1)
+        thread.join(10)
+        assert result == [b"x" * 10]
+    finally:
+        extproxy.set_proxy_limits(proxy)
+
+def test_rate(standins, origin_url, socks_proxy):
+    extproxy.enable_forwarder()
+    proxy = socks_proxy.replace("://", "://rate:x@")
+    extproxy.set_proxy_limits(proxy, rate=1000000)
+    try:
+        assert len(fetch(proxy, origin_url + "300000")) == 300000
+    finally:
+        extproxy.set_proxy_limits(proxy)
+        extproxy.disable_forwarder()
+
+def test_limit_error_type():
+    assert issubclass(TunnelLimitError, OSError)
+
+@pytest.mark.parametrize("wrap", [False, True])
+def test_release_on_close(standins, wrap):
+    # The slot is released by close(), while the socket is still referenced.
+    # A wrapped HTTPS proxy tunnel is closed by its forwarding thread. The
+    # proxies are of host localhost, so that their counts of tunnels are
+    # not shared with the other tests
+    from extproxy.group import connect_proxy
+    dest_pair = "localhost", standins.ports["origin"]
+    socks_proxy = "socks5://localhost:%d" % standins.ports["socks"]
+    https_proxy = "https://localhost:%d" % standins.ports["https"]
+    extproxy.set_https_proxy(https_proxy, cafile=CERTFILE)
+    for proxy in (socks_proxy, https_proxy):
+        extproxy.set_proxy_limits(proxy, max_tunnels=1, max_waiting=0)
+        try:
+            socks = []
+            for _ in range(3):
+                sock = connect_proxy(get_proxy_info(proxy), dest_pair, 10)
+                if wrap:
+                    sock = client_context().wrap_socket(
+                            sock, server_hostname="localhost")
+                socks.append(sock)
+                assert _stats(proxy)["active"] == 1
+                sock.close()
+                if wrap and proxy == https_proxy:
+                    assert wait_for(lambda: _stats(proxy)["active"] == 0)
+                else:
+                    assert _stats(proxy)["active"] == 0
+        finally:
+            extproxy.set_proxy_limits(proxy)
@@ -0,0 +1,39 @@
+import extproxy
+from extproxy.metrics import Histogram
+from extproxy.proxy_info import get_proxy_info
+
+from .helpers import dead_port, fetch
+
+
+def test_histogram():
+    histogram = Histogram()
+    for value in (0.001, 0.002, 0.003, 0.1):
+        histogram.add(value)
+    summary = histogram.summary()
+    assert summary["count"] == 4
+    assert summary["max"] == 0.1
+    assert summary["p50"] <= summary["p90"] <= summary["p99"]
+
+def test_metrics(standins, origin_url, socks_proxy):
+    events = []
+    hook = lambda event, proxy, value: events.append((event, proxy))
+    extproxy.enable_metrics()
+    extproxy.add_metrics_hook(hook)
+    try:
+        fetch(socks_proxy, origin_url + "10")
+        key = get_proxy_info(socks_proxy).key
+        assert ("connect", key) in events
+        assert ("socks_negotiate", key) in events
+        latency = extproxy.get_metrics()[key]["latency"]
+        assert latency["connect"]["count"] >= 1
+        dead = "socks5://127.0.0.1:%d" % dead_port()
+        try:
+            fetch(dead, origin_url + "10", timeout=2)
+        except Exception:
+            pass
+        errors = extproxy.get_metrics()[get_proxy_info(dead).key]["errors"]
+        assert sum(errors.values()) >= 1
+    finally:
+        extproxy.remove_metrics_hook(hook)
+        extproxy.disable_metrics()
+    assert extproxy.get_metrics() == {}
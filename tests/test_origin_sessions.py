@@ -0,0 +1,34 @@
+from urllib.request import HTTPSHandler
+
+import pytest
+
+import extproxy
+from extproxy.proxy_info import get_proxy_info
+
+from .helpers import fetch
+from .standins import client_context
+
+
+def _hits(proxy):
+    stats = extproxy.origin_session_stats().get(get_proxy_info(proxy).key, {})
+    return stats.get("localhost", {}).get("hits", 0)
+
+@pytest.mark.parametrize("mode", ["socketpair", "memorybio"])
+def test_resumption(standins, origin_url, socks_proxy, https_proxy, mode):
+    extproxy.set_tls_in_tls_mode(mode)
+    try:
+        for proxy in (socks_proxy, https_proxy):
+            # Sessions are resumed with the context which has made them
+            handler = HTTPSHandler(context=client_context())
+            hits = _hits(proxy)
+            for _ in range(3):
+                fetch(proxy, origin_url + "10", handler=handler)
+            assert _hits(proxy) - hits >= 1
+    finally:
+        extproxy.set_tls_in_tls_mode("socketpair")
+
+def test_other_context(standins, origin_url, socks_proxy):
+    hits = _hits(socks_proxy)
+    for _ in range(2):
+        fetch(socks_proxy, origin_url + "10")
+    assert _hits(socks_proxy) == hits
@@ -0,0 +1,32 @@
+import pytest
+
+import extproxy
+from extproxy.compat import urlparse
+from extproxy.pool import get_warm_pool
+
+from .helpers import fetch, wait_for
+from .standins import CERTFILE
+
+
+@pytest.mark.parametrize("scheme", ["https", "socks5"])
+def test_warm_pool(standins, origin_url, scheme):
+    if scheme == "https":
+        proxy = "https://warm:x@127.0.0.1:%d" % standins.ports["https"]
+        extproxy.set_https_proxy(proxy, cafile=CERTFILE)
+    else:
+        proxy = "socks5://warm:x@127.0.0.1:%d" % standins.ports["socks"]
+    extproxy.set_warm_pool(proxy, size=2)
+    try:
+        pool = get_warm_pool(urlparse(proxy))
+        assert wait_for(lambda: len(pool) == 2)
+        assert len(fetch(proxy, origin_url + "1000")) == 1000
+        # Taken, then refilled in the background
+        assert wait_for(lambda: len(pool) == 2)
+    finally:
+        extproxy.remove_warm_pool(proxy)
+    assert get_warm_pool(urlparse(proxy)) is None
+    assert len(pool) == 0
+
+def test_warm_pool_unsupported_type():
+    with pytest.raises(ValueError):
+        extproxy.set_warm_pool("http://127.0.0.1:8080")
@@ -0,0 +1,44 @@
+import pytest
+
+from extproxy.proxy_info import get_proxy_info
+
+
+def test_interned():
+    info = get_proxy_info("socks5://127.0.0.1:1080")
+    assert get_proxy_info("socks5://127.0.0.1:1080") is info
+    assert get_proxy_info(info) is info
+
+@pytest.mark.parametrize("url, type, key", [
+    ("https://id:pw@proxy.local", "https", "proxy.local:443"),
+    ("socks5://proxy.local", "socks", "proxy.local:1080"),
+    ("http://proxy.local:3128", None, "proxy.local:3128"),
+])
+def test_parse(url, type, key):
+    info = get_proxy_info(url)
+    assert info.type == type
+    assert info.key == key
+
+def test_https_auth():
+    info = get_proxy_info("https://id:pw@127.0.0.1:8443")
+    assert info.proxy_auth == "Basic aWQ6cHc="
+    assert info.hostport == "127.0.0.1:8443"
+    assert info.normal_netloc == "id:pw@127.0.0.1:8443"
+
+@pytest.mark.parametrize("url, hostname, path", [
+    ("socks5+unix:///run/egress.sock", "localhost", "/run/egress.sock"),
+    ("socks5+unix://%2Frun%2Fegress.sock", "localhost", "/run/egress.sock"),
+    ("https+unix://id:pw@Proxy.local/run/egress.sock", "proxy.local",
+     "/run/egress.sock"),
+])
+def test_unix(url, hostname, path):
+    info = get_proxy_info(url)
+    assert info.scheme == url.partition("+")[0]
+    assert info.hostname == hostname
+    assert info.unix_path == path
+    assert info.key == "unix:" + path
+
+@pytest.mark.parametrize("url", ["http+unix:///run/egress.sock",
+                                 "socks5+unix://"])
+def test_unix_invalid(url):
+    with pytest.raises(ValueError):
+        get_proxy_info(url)
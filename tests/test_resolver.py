@@ -0,0 +1,49 @@
+import socket
+
+import pytest
+
+from extproxy.resolver import Resolver
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+    def getaddrinfo(host, port, family=0, type=0, *args):
+        calls.append(host)
+        if host == "missing.test":
+            raise socket.gaierror(socket.EAI_NONAME, "not found")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 ("192.0.2.1", port))]
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    return calls
+
+def test_cache(lookups):
+    resolver = Resolver()
+    infos = resolver.getaddrinfo("proxy.test", 1080)
+    assert infos[0][4] == ("192.0.2.1", 1080)
+    assert resolver.getaddrinfo("proxy.test", 443)[0][4] == \
+           ("192.0.2.1", 443)
+    assert resolver.cached("proxy.test", 80)[0][4] == ("192.0.2.1", 80)
+    assert lookups == ["proxy.test"]
+    resolver.clear()
+    resolver.getaddrinfo("proxy.test", 1080)
+    assert lookups == ["proxy.test"] * 2
+
+def test_negative_cache(lookups):
+    resolver = Resolver()
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            resolver.getaddrinfo("missing.test", 1080)
+    assert lookups == ["missing.test"]
+    assert resolver.cached("missing.test", 1080) is None
+
+def test_disabled(lookups):
+    resolver = Resolver(ttl=0)
+    resolver.getaddrinfo("proxy.test", 1080)
+    resolver.getaddrinfo("proxy.test", 1080)
+    assert lookups == ["proxy.test"] * 2
+
+def test_ip_not_cached(lookups):
+    resolver = Resolver()
+    resolver.getaddrinfo("127.0.0.1", 1080)
+    assert resolver.cached("127.0.0.1", 1080) is None
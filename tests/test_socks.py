@@ -0,0 +1,35 @@
+from urllib.error import URLError
+
+import pytest
+
+import extproxy
+
+from .helpers import dead_port, fetch
+
+
+@pytest.mark.parametrize("scheme", ["socks4", "socks4a", "socks", "socks5",
+                                    "socks5h"])
+def test_socks_types(standins, origin_url, scheme):
+    proxy = "%s://127.0.0.1:%d" % (scheme, standins.ports["socks"])
+    for size in (10, 300000):
+        assert len(fetch(proxy, origin_url + str(size))) == size
+
+def test_socks5_auth(standins, origin_url):
+    proxy = "socks5://id:pw@127.0.0.1:%d" % standins.ports["socks"]
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_socks5_optimistic(standins, origin_url):
+    proxy = "socks5://opt:pw@127.0.0.1:%d" % standins.ports["socks"]
+    extproxy.set_socks_proxy(proxy, optimistic=True)
+    assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_socks5_fast_open(standins, origin_url):
+    proxy = "socks5://tfo:pw@127.0.0.1:%d" % standins.ports["socks"]
+    extproxy.set_socks_proxy(proxy, optimistic=True, fast_open=True)
+    for _ in range(2):
+        assert fetch(proxy, origin_url + "10") == b"x" * 10
+
+def test_socks_proxy_down(origin_url):
+    proxy = "socks5://127.0.0.1:%d" % dead_port()
+    with pytest.raises(URLError):
+        fetch(proxy, origin_url + "10", timeout=2)
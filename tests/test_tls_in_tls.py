@@ -0,0 +1,41 @@
+import socket
+
+import pytest
+
+import extproxy
+from extproxy.tls_in_tls import TLSInTLSSocket, get_tls_in_tls_mode
+
+from .helpers import fetch
+from .standins import client_context
+
+
+@pytest.fixture(params=["socketpair", "memorybio"])
+def tls_in_tls_mode(request):
+    mode = get_tls_in_tls_mode()
+    extproxy.set_tls_in_tls_mode(request.param)
+    yield request.param
+    extproxy.set_tls_in_tls_mode(mode)
+
+def test_tls_over_https_proxy(tls_in_tls_mode, https_proxy, origin_url):
+    for size in (10, 300000):
+        assert len(fetch(https_proxy, origin_url + str(size))) == size
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        extproxy.set_tls_in_tls_mode("unknown")
+
+def test_detach(standins):
+    sock = socket.create_connection(("127.0.0.1", standins.ports["https"]),
+                                    10)
+    tunnel = client_context().wrap_socket(sock, server_hostname="localhost")
+    tunnel.sendall(b"CONNECT localhost:%d HTTP/1.1\r\n\r\n"
+                   % standins.ports["origin"])
+    assert tunnel.recv(1024).startswith(b"HTTP/1.1 200")
+    sock = TLSInTLSSocket(client_context(), tunnel,
+                          server_hostname="localhost")
+    assert sock.version()
+    assert sock.detach() is tunnel
+    sock.close()
+    # The connection to proxy is handed over, not closed
+    assert tunnel.fileno() != -1
+    tunnel.close()
@@ -0,0 +1,57 @@
+import socket
+
+import pytest
+
+import extproxy
+from extproxy.transport import TransportProfile
+
+from .helpers import fetch
+from .standins import CERTFILE
+
+
+def test_validation():
+    with pytest.raises(ValueError):
+        TransportProfile(keepalive=(30, 10))
+    with pytest.raises(ValueError):
+        TransportProfile(bufsize=65536, max_bufsize=16384)
+
+def test_forward_options():
+    profile = TransportProfile(bufsize=16384, max_bufsize=65536,
+                               idle_timeout=60, quickack=True)
+    assert profile.forward_options() == {"bufsize": 16384,
+                                         "max_bufsize": 65536,
+                                         "timeout": 60, "quickack": True}
+    assert TransportProfile().forward_options() == {}
+
+def test_apply():
+    sock = socket.socket()
+    try:
+        TransportProfile(keepalive=(30, 10, 3)).apply(sock)
+        assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    finally:
+        sock.close()
+
+def test_socks_profile(standins, origin_url, socks_proxy):
+    proxy = socks_proxy.replace("://", "://profile:x@")
+    extproxy.set_socks_proxy(proxy, profile=TransportProfile(
+            sndbuf=262144, keepalive=(30, 10, 3), bufsize=16384))
+    extproxy.enable_forwarder()
+    try:
+        assert len(fetch(proxy, origin_url + "300000")) == 300000
+    finally:
+        extproxy.disable_forwarder()
+
+@pytest.mark.parametrize("forwarder", [False, True])
+def test_https_profile(standins, origin_url, forwarder):
+    # Tunnels through HTTPS proxies are forwarded with the profile
+    proxy = "https://profile%d:x@127.0.0.1:%d" % (forwarder,
+                                                 standins.ports["https"])
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE, profile=TransportProfile(
+            bufsize=4096, max_bufsize=65536, idle_timeout=30, quickack=True))
+    if forwarder:
+        extproxy.enable_forwarder()
+    try:
+        assert len(fetch(proxy, origin_url + "300000")) == 300000
+    finally:
+        extproxy.disable_forwarder()
@@ -0,0 +1,27 @@
+import os
+
+import extproxy
+
+from .helpers import fetch
+from .standins import CERTFILE
+
+
+def test_socks(standins, origin_url):
+    proxy = "socks5+unix://" + os.path.join(standins.unix_dir, "socks.sock")
+    assert len(fetch(proxy, origin_url + "300000")) == 300000
+
+def test_https(standins, origin_url):
+    proxy = "https+unix://" + os.path.join(standins.unix_dir, "https.sock")
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE)
+    assert len(fetch(proxy, origin_url + "300000")) == 300000
+
+def test_forwarded(standins, origin_url):
+    # The tunnels through HTTPS proxies are forwarded
+    proxy = "https+unix://forwarded:x@localhost" + os.path.join(
+            standins.unix_dir, "https.sock")
+    extproxy.set_https_proxy(proxy, cafile=CERTFILE)
+    extproxy.enable_forwarder()
+    try:
+        assert len(fetch(proxy, origin_url + "300000")) == 300000
+    finally:
+        extproxy.disable_forwarder()